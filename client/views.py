@@ -16,7 +16,8 @@ from tastypie.serializers import Serializer
 
 from client import utils
 from panda.api.category import CategoryResource
-from panda.models import ActivityLog, Category, Dataset, SearchLog, UserProxy
+from panda.models import ActivityLog, Dataset, SearchLog, UserProxy
+from panda.utils.cache import search_stats
 
 def index(request):
     """
@@ -27,19 +28,7 @@ def index(request):
     serializer = Serializer()
     cr = CategoryResource()
 
-    categories = list(Category.objects.annotate(dataset_count=Count('datasets')))
-
-    bundles = [cr.build_bundle(obj=c) for c in categories]
-    categories_bootstrap = [cr.full_dehydrate(b) for b in bundles]
-
-    uncategorized = Category(
-        id=settings.PANDA_UNCATEGORIZED_ID,
-        slug=settings.PANDA_UNCATEGORIZED_SLUG,
-        name=settings.PANDA_UNCATEGORIZED_NAME)
-    uncategorized.__dict__['dataset_count'] = Dataset.objects.filter(categories=None).count() 
-    uncategorized_bundle = cr.full_dehydrate(cr.build_bundle(obj=uncategorized))
-
-    categories_bootstrap.append(uncategorized_bundle)
+    categories_bootstrap = cr.get_bootstrap_data()
 
     return render_to_response('index.html', {
         'settings': settings,
@@ -130,6 +119,8 @@ def dashboard(request):
         else:
             searches_by_day.append({ 'day': d, 'when__count': 0 })
 
+    search_cache_stats = search_stats()
+
     # Disk space
     root_disk = os.stat('/').st_dev
     upload_disk = os.stat(settings.MEDIA_ROOT).st_dev
@@ -171,6 +162,9 @@ def dashboard(request):
         'total_searches': total_searches,
         'most_searched_datasets': most_searched_datasets,
         'searches_by_day': searches_by_day,
+        'search_cache_hits': search_cache_stats['hits'],
+        'search_cache_misses': search_cache_stats['misses'],
+        'search_cache_hit_rate': '%.0f' % (search_cache_stats['hit_rate'] * 100),
         'root_disk_total': root_disk_total,
         'root_disk_free': root_disk_free,
         'root_disk_percent_used': root_disk_percent_used,
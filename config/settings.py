@@ -66,6 +66,19 @@ STATICFILES_FINDERS = (
 MEDIA_ROOT = '/tmp/panda'
 EXPORT_ROOT = '/tmp/panda_exports'
 
+# Caches for dataset and category listings (see panda.utils.cache)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/panda_cache',
+        'OPTIONS': {
+            # Culling is random and would drop generation keys with everything else
+            'MAX_ENTRIES': 100000,
+            'CULL_FREQUENCY': 10
+        }
+    }
+}
+
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = '-lyd+@8@=9oni01+gjvb(txz3%hh_7a9m5*n0q^ce5+&c1fkm('
 
@@ -156,6 +169,10 @@ CELERYBEAT_SCHEDULE = {
     'run_admin_alerts': {
         'task': 'panda.tasks.cron.run_admin_alerts',
         'schedule': crontab(minute=0, hour=4)
+    },
+    'reconcile_row_counts': {
+        'task': 'panda.tasks.cron.reconcile_row_counts',
+        'schedule': crontab(minute=15)
     }
 }
 
@@ -240,6 +257,14 @@ SOLR_ENDPOINT = 'http://localhost:8983/solr'
 SOLR_DATA_CORE = 'data'
 SOLR_DATASETS_CORE = 'datasets'
 SOLR_DIRECTORY = '/var/solr'
+SOLR_CONNECTION_POOL_SIZE = 4   # Keep-alive connections per process
+SOLR_TIMEOUT = None             # Seconds, None waits indefinitely
+SOLR_WRITER_THREADS = 2         # Threads adding batches during imports
+SOLR_WRITER_QUEUE_SIZE = 4      # Batches parsed ahead of the writer threads
+SOLR_COMMIT_WITHIN = 1000       # Milliseconds, for the 'within' commit policy
+SOLR_COMMIT_INTERVAL = 1        # Seconds between commits by the background committer
+SOLR_API_COMMIT_POLICY = 'within'       # How rows written via the API are committed, see panda.solr
+SOLR_TASK_COMMIT_POLICY = 'immediate'   # How imports and reindexes are committed when they finish
 
 # Miscellaneous configuration
 PANDA_VERSION = '1.1.2'
@@ -253,6 +278,22 @@ PANDA_ACTIVATION_PERIOD = datetime.timedelta(days=30)
 PANDA_AVAILABLE_SPACE_WARN = 1024 * 1024 * 1024 * 2 # 2GB
 PANDA_AVAILABLE_SPACE_CRITICAL = 1024 * 1024 * 1024 * 1 # 1GB
 PANDA_NOTIFICATIONS_TO_SHOW = 50
+PANDA_REINDEX_PARTITIONS = 4 # Processed in parallel if CELERYD_CONCURRENCY allows
+PANDA_REINDEX_PARTITION_MIN_ROWS = 100000
+PANDA_IMPORT_PARTITIONS = 4 # Large CSVs are split into this many chunks
+PANDA_IMPORT_PARTITION_MIN_SIZE = 1024 * 1024 * 64 # bytes
+PANDA_PARTITION_TIMEOUT = 60 * 10 # Seconds a partition running in a worker may go without reporting progress
+PANDA_LOCK_LEASE = 60 * 10 # Seconds a dataset lock lasts without a heartbeat
+PANDA_LOCK_WAIT = 5 # Seconds API writes wait for a locked dataset
+PANDA_QUEUED_WRITES_RETRY = 30 # Seconds between attempts to apply queued writes to a locked dataset
+PANDA_CATEGORIES_UPDATE_DELAY = 10 # Seconds category changes are collected before rows are updated
+PANDA_CATEGORIES_UPDATE_RETRY = 60 # Seconds between attempts to update the rows of a locked dataset
+PANDA_INGEST_MAX_ERRORS = 100 # Failed rows described in the response to a bulk ingest
+PANDA_STREAM_EXPORT_MAX_ROWS = 250000 # Larger exports must be run as a task
+PANDA_EXPORT_SEARCH_THREADS = 2 # Datasets read from Solr at once when exporting search results
+PANDA_CACHE_TIMEOUT = 60 * 60 # Seconds cached listings are kept, if not invalidated first
+PANDA_CACHE_GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+PANDA_SEARCH_CACHE_TIMEOUT = 60 * 10 # Seconds cached search results are kept, if not invalidated first
 
 PANDA_UNCATEGORIZED_ID = 0
 PANDA_UNCATEGORIZED_SLUG = 'uncategorized'
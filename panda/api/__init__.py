@@ -7,6 +7,7 @@ from panda.api.datasets import DatasetResource
 from panda.api.data_uploads import DataUploadResource
 from panda.api.exports import ExportResource
 from panda.api.notifications import NotificationResource
+from panda.api.queued_writes import QueuedWriteResource
 from panda.api.related_uploads import RelatedUploadResource
 from panda.api.search_subscriptions import SearchSubscriptionResource
 from panda.api.tasks import TaskResource
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.db.models import Count
 from tastypie.authorization import DjangoAuthorization
 
+from panda import utils
 from panda.api.utils import PandaAuthentication, SluggedModelResource, PandaSerializer
 from panda.models import Category, Dataset
 
@@ -35,9 +36,21 @@ class CategoryResource(SluggedModelResource):
         """
         Overriden from underlying implementation in order to insert a fake category
         for "Uncategorized" datasets.
+
+        Cached until a category, or the categories a dataset is in, changes.
+        """
+        to_be_serialized = utils.cache.get_or_set(
+            utils.cache.CATEGORIES,
+            ('list', sorted(request.GET.items())),
+            lambda: self.get_list_page(request, **kwargs)
+        )
+
+        return self.create_response(request, to_be_serialized)
+
+    def get_list_page(self, request, **kwargs):
+        """
+        Build a page of the category list, simplified for serialization.
         """
-        # TODO: Uncached for now. Invalidation that works for everyone may be
-        #       impossible.
         objects = self.obj_get_list(request=request, **self.remove_api_resource_names(kwargs))
         sorted_objects = self.apply_sorting(objects, options=request.GET)
 
@@ -60,5 +73,33 @@ class CategoryResource(SluggedModelResource):
 
         to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
 
-        return self.create_response(request, to_be_serialized)
+        return self._meta.serializer.to_simple(to_be_serialized, {})
+
+    def get_bootstrap_data(self):
+        """
+        Every category (including "Uncategorized") with its dataset count, for
+        bootstrapping the client application. Cached in the same way as the list.
+        """
+        return utils.cache.get_or_set(
+            utils.cache.CATEGORIES,
+            ('bootstrap',),
+            self.make_bootstrap_data
+        )
+
+    def make_bootstrap_data(self):
+        categories = list(Category.objects.annotate(dataset_count=Count('datasets')))
+
+        bundles = [self.build_bundle(obj=c) for c in categories]
+        categories_bootstrap = [self.full_dehydrate(b) for b in bundles]
+
+        uncategorized = Category(
+            id=settings.PANDA_UNCATEGORIZED_ID,
+            slug=settings.PANDA_UNCATEGORIZED_SLUG,
+            name=settings.PANDA_UNCATEGORIZED_NAME)
+        uncategorized.__dict__['dataset_count'] = Dataset.objects.filter(categories=None).count() 
+        uncategorized_bundle = self.full_dehydrate(self.build_bundle(obj=uncategorized))
+
+        categories_bootstrap.append(uncategorized_bundle)
+
+        return self._meta.serializer.to_simple(categories_bootstrap, {})
 
@@ -1,9 +1,8 @@
 #!/usr/bin/env python
 
-import re
-
 from django.conf import settings
 from django.core.urlresolvers import get_script_prefix, resolve, reverse
+from django.http import HttpResponse
 from django.utils import simplejson as json
 from django.utils.translation import ugettext_lazy as _
 from tastypie import fields, http
@@ -14,12 +13,16 @@ from tastypie.utils import dict_strip_unicode_keys
 from tastypie.utils.mime import build_content_type
 from tastypie.validation import Validation
 
-from panda import solr
+from panda import solr, utils
 from panda.api.datasets import DatasetResource
+from panda.api.queued_writes import QueuedWriteResource
 from panda.exceptions import DatasetLockedError
-from panda.api.utils import PandaAuthentication, PandaPaginator, PandaResource, PandaSerializer
-from panda.models import Category, Dataset, SearchLog, TaskStatus, UserProxy
-from panda.tasks import ExportSearchTask, PurgeDataTask
+from panda.api.utils import PANDA_CACHE_CONTROL, PandaAuthentication, PandaPaginator, PandaResource, PandaSerializer
+from panda.models import Category, Dataset, QueuedWrite, SearchLog, TaskStatus, UserProxy
+from panda.tasks import ApplyQueuedWritesTask, ExportSearchTask, PurgeDataTask
+
+# Stored fields needed to build search results
+SEARCH_FIELDS = ['dataset_slug', 'external_id', 'data']
 
 class SolrObject(object):
     """
@@ -49,6 +52,13 @@ class SolrObject(object):
     def to_dict(self):
         return self._data
 
+def splice_objects(envelope, objects):
+    """
+    Add a list of already serialized objects to a serialized JSON object
+    (which must not already have an ``objects`` key).
+    """
+    return u'%s, "objects": [%s]}' % (envelope[:-1], u', '.join(objects))
+
 class DataValidation(Validation):
     """
     Tastypie Validation for Data objects.
@@ -60,10 +70,10 @@ class DataValidation(Validation):
             errors['data'] = [_('The data field is required.')]
 
         if 'external_id' in bundle.data:
-            if not isinstance(bundle.data['external_id'], basestring):
-                errors['external_id'] = [_('external_id must be a string.')]
-            elif not re.match('^[\w\d_-]+$', bundle.data['external_id']):
-                errors['external_id'] = [_('external_id can only contain letters, numbers, underscores and dashes.')]
+            error = utils.ingest.validate_external_id(bundle.data['external_id'])
+
+            if error:
+                errors['external_id'] = [error]
 
         return errors
 
@@ -134,6 +144,38 @@ class DataResource(PandaResource):
 
         return dr._build_reverse_url('api_dataset_data_detail', kwargs=kwargs)
 
+    def dehydrate_rows_json(self, dataset, docs):
+        """
+        Serialize Solr documents from one dataset directly to JSON,
+        splicing in each row's stored data rather than decoding and
+        re-encoding it.
+
+        The output is the same as ``full_dehydrate`` followed by
+        serialization, at a fraction of the cost.
+        """
+        dataset_uri = json.dumps(DatasetResource().get_resource_uri(dataset))
+        data_uri = reverse('api_dataset_data_list', kwargs={ 'api_name': self._meta.api_name, 'dataset_resource_name': 'dataset', 'resource_name': 'data', 'dataset_slug': dataset.slug })
+
+        rows = []
+
+        for doc in docs:
+            external_id = doc.get('external_id', None)
+            resource_uri = '%s%s/' % (data_uri, external_id) if external_id else None
+
+            rows.append(u'{"data": %s, "dataset": %s, "external_id": %s, "resource_uri": %s}' % (doc['data'], dataset_uri, json.dumps(external_id), json.dumps(resource_uri)))
+
+        return rows
+
+    def create_json_response(self, request, content):
+        """
+        Build a response from content which has already been serialized to
+        JSON. See ``create_response``.
+        """
+        response = HttpResponse(content.encode('utf-8'), content_type=build_content_type('application/json'))
+        response['Cache-Control'] = PANDA_CACHE_CONTROL
+
+        return response
+
     def get_dataset_from_kwargs(self, bundle, **kwargs):
         """
         Extract a dataset from one of the variety of places it might be hiding.
@@ -192,6 +234,31 @@ class DataResource(PandaResource):
             response = http.HttpBadRequest(content=serialized, content_type=build_content_type(desired_format))
             raise ImmediateHttpResponse(response=response)
 
+    def write_or_queue(self, request, dataset, user, write, **queued_write):
+        """
+        Make a write by calling ``write``, unless the dataset is locked by an
+        import or reindex (see ``Dataset.should_queue_writes``). In that case
+        the write is queued and the request short-circuited with a 202
+        Accepted response describing the ``QueuedWrite``.
+        """
+        if not dataset.should_queue_writes():
+            try:
+                return write()
+            except DatasetLockedError:
+                if not dataset.is_locked_by_task():
+                    raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+
+        queued = QueuedWrite.objects.create(dataset=dataset, creator=user, **queued_write)
+
+        # If the task finished in the meantime nothing else will apply it
+        if not dataset.is_locked_by_task():
+            ApplyQueuedWritesTask.apply_async(args=[dataset.slug])
+
+        resource = QueuedWriteResource()
+        bundle = resource.full_dehydrate(resource.build_bundle(obj=queued, request=request))
+
+        raise ImmediateHttpResponse(response=resource.create_response(request, bundle, response_class=http.HttpAccepted))
+
     # Data access methods
 
     def get_object_list():
@@ -243,10 +310,9 @@ class DataResource(PandaResource):
         # not be a full User instance. To be sure, we fetch one.
         user = UserProxy.objects.get(id=request.user.id)
 
-        try:
-            row = dataset.add_row(user, bundle.data['data'], external_id=external_id)
-        except DatasetLockedError:
-            raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+        row = self.write_or_queue(request, dataset, user,
+            lambda: dataset.add_row(user, bundle.data['data'], external_id=external_id),
+            operation='add', data=[[bundle.data['data'], external_id]])
 
         bundle.obj = SolrObject(row)
 
@@ -274,10 +340,9 @@ class DataResource(PandaResource):
         # not be a full User instance. To be sure, we fetch one.
         user = UserProxy.objects.get(id=request.user.id)
 
-        try:
-            dataset.delete_row(user, kwargs['external_id'])
-        except DatasetLockedError:
-            raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+        self.write_or_queue(request, dataset, user,
+            lambda: dataset.delete_row(user, kwargs['external_id']),
+            operation='delete', external_id=kwargs['external_id'])
 
     def rollback(self, bundles):
         """
@@ -293,6 +358,9 @@ class DataResource(PandaResource):
 
         Bypasses ``obj_get_list``, making it unnecessary.
         """
+        if self.determine_format(request) == 'application/json':
+            return self.create_json_response(request, self.search_dataset_data(request, as_json=True, **kwargs))
+
         results = self.search_dataset_data(request, **kwargs)
 
         return self.create_response(request, results)
@@ -344,10 +412,9 @@ class DataResource(PandaResource):
         # not be a full User instance. To be sure, we fetch one.
         user = UserProxy.objects.get(id=request.user.id)
         
-        try:
-            solr_rows = dataset.add_many_rows(user, data)
-        except DatasetLockedError:
-            raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+        solr_rows = self.write_or_queue(request, dataset, user,
+            lambda: dataset.add_many_rows(user, data),
+            operation='add', data=[list(d) for d in data])
 
         for bundle, solr_row in zip(bundles, solr_rows):
             bundle.obj = SolrObject(solr_row)
@@ -396,16 +463,67 @@ class DataResource(PandaResource):
         # not be a full User instance. To be sure, we fetch one.
         user = UserProxy.objects.get(id=request.user.id)
         
-        try:
-            dataset.delete_all_rows(user) 
-        except DatasetLockedError:
-            raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+        self.write_or_queue(request, dataset, user,
+            lambda: dataset.delete_all_rows(user),
+            operation='delete_all')
 
         return http.HttpNoContent()
 
     def delete_detail(self, request, **kwargs):
         return super(DataResource, self).delete_detail(request, **kwargs)
 
+    def ingest_data(self, request, **kwargs):
+        """
+        A streaming alternative to ``put_list`` for large batches. Accepts
+        newline-delimited JSON (``application/x-ndjson``) or CSV
+        (``text/csv``) and indexes rows as the body is read.
+
+        Returns a summary of rows added, updated and failed rather than the
+        rows themselves.
+        """
+        self.method_check(request, allowed=['post', 'put'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        dataset = Dataset.objects.get(slug=kwargs['dataset_slug'])
+
+        if dataset.column_schema is None:
+            raise BadRequest(_('Can not create or modify data for a dataset without columns.'))
+
+        if dataset.initial_upload and not dataset.row_count:
+            raise BadRequest(_('Can not create or modify data for a dataset which has initial_upload, but has not completed the import process.'))
+
+        content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+
+        if content_type == 'application/x-ndjson':
+            rows = utils.ingest.iter_ndjson(request)
+        elif content_type == 'text/csv':
+            try:
+                external_id_field_index = int(request.GET['external_id_field_index'])
+            except KeyError:
+                external_id_field_index = None
+            except ValueError:
+                raise BadRequest(_('external_id_field_index must be an integer.'))
+
+            header = request.GET.get('header', 'true').lower() == 'true'
+
+            rows = utils.ingest.iter_csv(request, external_id_field_index=external_id_field_index, header=header)
+        else:
+            raise BadRequest(_('Data must be sent as application/x-ndjson or text/csv.'))
+
+        # Because users may have authenticated via headers the request.user may
+        # not be a full User instance. To be sure, we fetch one.
+        user = UserProxy.objects.get(id=request.user.id)
+
+        try:
+            summary = dataset.ingest_rows(user, rows)
+        except DatasetLockedError:
+            raise ImmediateHttpResponse(response=http.HttpForbidden(_('Dataset is currently locked by another process.')))
+
+        self.log_throttled_access(request)
+
+        return self.create_response(request, summary)
+
     # Search
 
     def search_all_data(self, request, **kwargs):
@@ -428,20 +546,22 @@ class DataResource(PandaResource):
         group_limit = int(request.GET.get('group_limit', settings.PANDA_DEFAULT_SEARCH_ROWS_PER_GROUP))
         group_offset = int(request.GET.get('group_offset', 0))
         export = bool(request.GET.get('export', False))
+        as_json = self.determine_format(request) == 'application/json'
 
-        solr_query_bits = [query]
-
+        # Categories are indexed on every row, so a category is one filter
+        # however many datasets it contains
         if category:
             if category != 'uncategorized':
                 category = Category.objects.get(slug=category)
-                dataset_slugs = category.datasets.values_list('slug', flat=True)
+                category_id = category.id
             else:
-                dataset_slugs = Dataset.objects.filter(categories=None).values_list('slug', flat=True) 
+                category_id = settings.PANDA_UNCATEGORIZED_ID
 
-            solr_query_bits.append('dataset_slug:(%s)' % ' '.join(dataset_slugs))
+            filters = utils.solr.make_filters(since=since, category_id=category_id)
+        else:
+            category_id = None
 
-        if since:
-            solr_query_bits.append('last_modified:[' + since + 'Z TO *]')
+            filters = utils.solr.make_filters(since=since)
 
         # Because users may have authenticated via headers the request.user may
         # not be a full User instance. To be sure, we fetch one.
@@ -462,14 +582,23 @@ class DataResource(PandaResource):
                 task_id=task.id
             )
         else:
-            response = solr.query_grouped(
-                settings.SOLR_DATA_CORE,
-                ' AND '.join(solr_query_bits),
-                'dataset_slug',
-                offset=offset,
-                limit=limit,
-                group_limit=group_limit,
-                group_offset=group_offset
+            solr_query = utils.solr.make_search_query(request.GET.get('q', None))
+
+            # Cached until data in the category searched (or any data at all) changes
+            response = utils.cache.get_search(
+                (utils.cache.normalize_query(solr_query), filters, offset, limit, group_limit, group_offset),
+                lambda: solr.query_grouped(
+                    settings.SOLR_DATA_CORE,
+                    solr_query,
+                    'dataset_slug',
+                    offset=offset,
+                    limit=limit,
+                    group_limit=group_limit,
+                    group_offset=group_offset,
+                    fields=SEARCH_FIELDS,
+                    filters=filters
+                ),
+                category_id=category_id
             )
             groups = response['grouped']['dataset_slug']['groups']
 
@@ -504,22 +633,31 @@ class DataResource(PandaResource):
                 dataset_bundle = dataset_resource.full_dehydrate(dataset_bundle)
                 dataset_bundle = dataset_resource.simplify_bundle(dataset_bundle)
 
-                objects = [SolrObject(obj) for obj in results['docs']]
-                
                 dataset_search_url = reverse('api_dataset_data_list', kwargs={ 'api_name': self._meta.api_name, 'dataset_resource_name': 'dataset', 'resource_name': 'data', 'dataset_slug': dataset.slug })
 
                 data_page = PandaPaginator(
                     { 'limit': str(group_limit), 'offset': str(group_offset), 'q': query },
-                    objects,
+                    results['docs'],
                     resource_uri=dataset_search_url,
                     count=results['numFound']
                 ).page()
 
                 dataset_bundle.data.update(data_page)
+
+                if as_json:
+                    del dataset_bundle.data['objects']
+
+                    datasets.append(splice_objects(
+                        self._meta.serializer.to_json(dataset_bundle),
+                        self.dehydrate_rows_json(dataset, results['docs'])
+                    ))
+
+                    continue
+
                 dataset_bundle.data['objects'] = []
 
-                for obj in objects:
-                    data_bundle = self.build_bundle(obj=obj, request=request)
+                for obj in results['docs']:
+                    data_bundle = self.build_bundle(obj=SolrObject(obj), request=request)
                     data_bundle = self.full_dehydrate(data_bundle)
                     dataset_bundle.data['objects'].append(data_bundle)
 
@@ -534,13 +672,20 @@ class DataResource(PandaResource):
 
         if export:
             return self.create_response(request, _('Export queued.'))
+        elif as_json:
+            del page['objects']
+
+            return self.create_json_response(request, splice_objects(self._meta.serializer.to_json(page), datasets))
         else:
             return self.create_response(request, page)
 
-    def search_dataset_data(self, request, **kwargs):
+    def search_dataset_data(self, request, as_json=False, **kwargs):
         """
         Perform a full-text search on only one dataset.
 
+        If ``as_json`` is True the results are returned already serialized
+        to JSON, see ``dehydrate_rows_json``.
+
         See ``get_list``.
         """
         dataset = Dataset.objects.get(slug=kwargs['dataset_slug'])
@@ -555,18 +700,21 @@ class DataResource(PandaResource):
         offset = int(request.GET.get('offset', 0))
         sort = request.GET.get('sort', '_docid_ asc')
 
-        solr_query_bits = [query]
-        solr_query_bits.append('dataset_slug:%s' % dataset.slug)
-
-        if since:
-            solr_query_bits.append('last_modified:[' + since + 'Z TO *]')
+        solr_query = utils.solr.make_search_query(request.GET.get('q', None))
+        filters = utils.solr.make_filters([dataset.slug], since)
 
-        response = solr.query(
-            settings.SOLR_DATA_CORE,
-            ' AND '.join(solr_query_bits),
-            offset=offset,
-            sort=sort,
-            limit=limit
+        response = utils.cache.get_search(
+            (utils.cache.normalize_query(solr_query), filters, offset, limit, sort),
+            lambda: solr.query(
+                settings.SOLR_DATA_CORE,
+                solr_query,
+                offset=offset,
+                sort=sort,
+                limit=limit,
+                fields=SEARCH_FIELDS,
+                filters=filters
+            ),
+            dataset_slug=dataset.slug
         )
 
         dataset_resource = DatasetResource()
@@ -574,22 +722,33 @@ class DataResource(PandaResource):
         dataset_bundle = dataset_resource.full_dehydrate(dataset_bundle)
         dataset_bundle = dataset_resource.simplify_bundle(dataset_bundle)
        
-        results = [SolrObject(d) for d in response['response']['docs']]
+        docs = response['response']['docs']
 
         page = PandaPaginator(
             request.GET,
-            results,
+            docs,
             resource_uri=request.path_info,
             count=response['response']['numFound']
         ).page() 
         
         dataset_bundle.data.update(page)
-        dataset_bundle.data['objects'] = []
 
-        for obj in results:
-            bundle = self.build_bundle(obj=obj, request=request)
-            bundle = self.full_dehydrate(bundle)
-            dataset_bundle.data['objects'].append(bundle.data)
+        if as_json:
+            del dataset_bundle.data['objects']
+
+            results = splice_objects(
+                self._meta.serializer.to_json(dataset_bundle),
+                self.dehydrate_rows_json(dataset, docs)
+            )
+        else:
+            dataset_bundle.data['objects'] = []
+
+            for obj in docs:
+                bundle = self.build_bundle(obj=SolrObject(obj), request=request)
+                bundle = self.full_dehydrate(bundle)
+                dataset_bundle.data['objects'].append(bundle.data)
+
+            results = dataset_bundle
 
         # Because users may have authenticated via headers the request.user may
         # not be a full User instance. To be sure, we fetch one.
@@ -597,5 +756,5 @@ class DataResource(PandaResource):
         
         SearchLog.objects.create(user=user, dataset=dataset, query=query)
 
-        return dataset_bundle
+        return results
 
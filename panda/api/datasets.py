@@ -2,6 +2,7 @@
 
 from django.conf import settings
 from django.conf.urls.defaults import url
+from django.http import HttpResponse
 from django.utils.translation import ugettext_lazy as _
 from tastypie import fields
 from tastypie import http
@@ -10,7 +11,7 @@ from tastypie.exceptions import BadRequest, ImmediateHttpResponse
 from tastypie.utils.urls import trailing_slash
 from tastypie.validation import Validation
 
-from panda import solr
+from panda import solr, utils
 from panda.api.utils import PandaAuthentication, PandaPaginator, JSONApiField, SluggedModelResource, PandaSerializer
 from panda.exceptions import DataImportError, DatasetLockedError
 from panda.models import Category, Dataset, DataUpload, UserProxy
@@ -44,6 +45,7 @@ class DatasetResource(SluggedModelResource):
 
     slug = fields.CharField(attribute='slug')
     column_schema = JSONApiField(attribute='column_schema', readonly=True, null=True)
+    column_schema_indexed = fields.BooleanField(attribute='column_schema_indexed', readonly=True)
     sample_data = JSONApiField(attribute='sample_data', readonly=True, null=True)
     row_count = fields.IntegerField(attribute='row_count', readonly=True, null=True)
     creation_date = fields.DateTimeField(attribute='creation_date', readonly=True, null=True)
@@ -56,6 +58,7 @@ class DatasetResource(SluggedModelResource):
     class Meta:
         queryset = Dataset.objects.all()
         resource_name = 'dataset'
+        excludes = ['lock_id']
         allowed_methods = ['get', 'post', 'put', 'delete']
         always_return_data = True
 
@@ -89,9 +92,11 @@ class DatasetResource(SluggedModelResource):
             url(r"^(?P<resource_name>%s)/(?P<slug>[\w\d_-]+)%s$" % (self._meta.resource_name, trailing_slash()), self.wrap_view('dispatch_detail'), name="api_dispatch_detail"),
             url(r'^(?P<resource_name>%s)/(?P<slug>[\w\d_-]+)/import/(?P<upload_id>\d+)%s$' % (self._meta.resource_name, trailing_slash()), self.wrap_view('import_data'), name='api_import_data'),
             url(r'^(?P<resource_name>%s)/(?P<slug>[\w\d_-]+)/export%s$' % (self._meta.resource_name, trailing_slash()), self.wrap_view('export_data'), name='api_export_data'),
+            url(r'^(?P<resource_name>%s)/(?P<slug>[\w\d_-]+)/download%s$' % (self._meta.resource_name, trailing_slash()), self.wrap_view('download_data'), name='api_download_data'),
             url(r'^(?P<resource_name>%s)/(?P<slug>[\w\d_-]+)/reindex%s$' % (self._meta.resource_name, trailing_slash()), self.wrap_view('reindex_data'), name='api_reindex_data'),
             
             # Nested urls for accessing data
+            url(r'^(?P<dataset_resource_name>%s)/(?P<dataset_slug>[\w\d_-]+)/ingest%s$' % (self._meta.resource_name, trailing_slash()), data_resource.wrap_view('ingest_data'), name='api_dataset_data_ingest'),
             url(r'^(?P<dataset_resource_name>%s)/(?P<dataset_slug>[\w\d_-]+)/(?P<resource_name>%s)%s$' % (self._meta.resource_name, data_resource._meta.resource_name, trailing_slash()), data_resource.wrap_view('dispatch_list'), name='api_dataset_data_list'),
             url(r'^(?P<dataset_resource_name>%s)/(?P<dataset_slug>[\w\d_-]+)/(?P<resource_name>%s)/(?P<external_id>[\w\d_-]+)%s$' % (self._meta.resource_name, data_resource._meta.resource_name, trailing_slash()), data_resource.wrap_view('dispatch_detail'), name='api_dataset_data_detail'),
             url(r'^data%s' % trailing_slash(), data_resource.wrap_view('search_all_data'), name='api_data_search')
@@ -100,6 +105,20 @@ class DatasetResource(SluggedModelResource):
     def get_list(self, request, **kwargs):
         """
         List endpoint using Solr. Provides full-text search via the "q" parameter."
+
+        Pages are cached until any dataset (or object embedded in one) changes.
+        """
+        page = utils.cache.get_or_set(
+            utils.cache.DATASETS,
+            (request.path_info, sorted(request.GET.items())),
+            lambda: self.get_list_page(request)
+        )
+
+        return self.create_response(request, page)
+
+    def get_list_page(self, request):
+        """
+        Build a page of the dataset list, simplified for serialization.
         """
         limit = int(request.GET.get('limit', settings.PANDA_DEFAULT_SEARCH_ROWS))
         offset = int(request.GET.get('offset', 0))
@@ -115,23 +134,27 @@ class DatasetResource(SluggedModelResource):
         else:
             category_id = None
 
-        if category_id is not None and query:
-            q = 'categories:%s %s' % (category_id, query)
-        elif category_id is not None:
-            q = 'categories:%s' % category_id
+        q = utils.solr.make_search_query(query)
+
+        if category_id is not None:
+            filters = ['categories:%i' % category_id]
         else:
-            q = query
+            filters = None
 
         if creator_email:
             datasets = Dataset.objects.filter(creator__email=creator_email)
             count = datasets.count()
-            datasets = datasets[offset:offset + limit]
+            datasets = self.load_related(datasets[offset:offset + limit])
         else:
-            response = solr.query(settings.SOLR_DATASETS_CORE, q, offset=offset, limit=limit, sort='creation_date desc')
+            response = solr.query(settings.SOLR_DATASETS_CORE, q, offset=offset, limit=limit, sort='creation_date desc', fields=['slug'], filters=filters)
             count = response['response']['numFound']
             
             dataset_slugs = [d['slug'] for d in response['response']['docs']]
-            datasets = Dataset.objects.filter(slug__in=dataset_slugs)
+            datasets = self.load_related(Dataset.objects.filter(slug__in=dataset_slugs))
+
+            # Restore Solr's ordering, which the database query discards
+            datasets_by_slug = dict((d.slug, d) for d in datasets)
+            datasets = [datasets_by_slug[slug] for slug in dataset_slugs if slug in datasets_by_slug]
 
         paginator = PandaPaginator(request.GET, datasets, resource_uri=request.path_info, count=count)
         page = paginator.page()
@@ -150,7 +173,28 @@ class DatasetResource(SluggedModelResource):
 
         page['objects'] = objects
 
-        return self.create_response(request, page)
+        return self._meta.serializer.to_simple(page, {})
+
+    def load_related(self, datasets):
+        """
+        Evaluate a queryset of datasets, loading every object embedded in
+        their full representation in a fixed number of queries, rather
+        than several per dataset.
+        """
+        datasets = list(datasets
+            .select_related('creator', 'last_modified_by', 'initial_upload', 'current_task', 'current_task__creator')
+            .prefetch_related('categories', 'data_uploads__creator', 'related_uploads__creator'))
+
+        # Uploads link back to their dataset, which would otherwise be
+        # fetched again for each of them
+        for dataset in datasets:
+            for upload in dataset.data_uploads.all():
+                upload.dataset = dataset
+
+            for upload in dataset.related_uploads.all():
+                upload.dataset = dataset
+
+        return datasets
 
     def put_detail(self, request, **kwargs):
         """
@@ -348,3 +392,37 @@ class DatasetResource(SluggedModelResource):
 
         return self.create_response(request, bundle)
 
+    def download_data(self, request, **kwargs):
+        """
+        Stream a dataset (or dataset search results, with a query arg) as CSV.
+
+        Rows are fetched from Solr a page at a time and written to the
+        response as they arrive, so nothing is written to disk. Exports of
+        more than ``PANDA_STREAM_EXPORT_MAX_ROWS`` rows must go through
+        ``export_data`` instead.
+        """
+        # Allow POST so csrf token can come through
+        self.method_check(request, allowed=['get', 'post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        dataset = Dataset.objects.get(slug=kwargs['slug'])
+
+        if dataset.column_schema is None:
+            raise BadRequest(_('This dataset has no data to download.'))
+
+        query = request.GET.get('q', '')
+        since = request.GET.get('since', None)
+
+        q, filters = dataset.get_export_query(query, since)
+
+        if solr.count(settings.SOLR_DATA_CORE, q, filters) > settings.PANDA_STREAM_EXPORT_MAX_ROWS:
+            raise BadRequest(_('Too many rows to download directly. Use the export endpoint instead.'))
+
+        self.log_throttled_access(request)
+
+        response = HttpResponse(utils.csvdata.iter_csv_chunks(dataset.iter_export_rows(query, since)), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=%s.csv' % dataset.slug
+
+        return response
+
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+from tastypie import fields
+from tastypie.authorization import DjangoAuthorization
+
+from panda.api.datasets import DatasetResource
+from panda.api.utils import PandaAuthentication, PandaSerializer, PandaModelResource
+from panda.models import QueuedWrite
+
+class QueuedWriteResource(PandaModelResource):
+    """
+    API resource for writes to data which are waiting for a task to
+    finish before they can be applied.
+    """
+    from panda.api.users import UserResource
+
+    dataset = fields.ForeignKey(DatasetResource, 'dataset')
+    creator = fields.ForeignKey(UserResource, 'creator')
+
+    class Meta:
+        queryset = QueuedWrite.objects.all()
+        resource_name = 'queued_write'
+        allowed_methods = ['get']
+        excludes = ['data']
+
+        filtering = {
+            'dataset': ('exact', ),
+            'status': ('exact', 'in', )
+        }
+
+        authentication = PandaAuthentication()
+        authorization = DjangoAuthorization()
+        serializer = PandaSerializer()
+
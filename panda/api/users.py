@@ -111,7 +111,7 @@ class UserResource(PandaModelResource):
 
             resource = DatasetResource()
 
-            datasets = user.datasets.all()
+            datasets = resource.load_related(user.datasets.all())
 
             bundles = [resource.build_bundle(obj=d) for d in datasets]
             datasets = [resource.simplify_bundle(resource.full_dehydrate(b)) for b in bundles]
@@ -20,6 +20,9 @@ from panda.models import UserProxy
 
 PANDA_CACHE_CONTROL = 'max-age=0,no-cache,no-store'
 
+# Content types whose bodies may carry a csrf token
+FORM_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
 class JSONApiField(ApiField):
     """
     Custom ApiField for dealing with data from custom JSONFields.
@@ -132,9 +135,13 @@ class PandaAuthentication(ApiKeyAuthentication):
             if not same_origin(referer, good_referer):
                 return False
 
-        # Tastypie docstring says accessing POST here isn't safe, but so far it's not causing any problems...
-        # This is necessary for downloads that post the csrf token from an iframe
-        request_csrf_token = request.META.get('HTTP_X_CSRFTOKEN', '') or request.POST.get('csrfmiddlewaretoken', '')
+        request_csrf_token = request.META.get('HTTP_X_CSRFTOKEN', '')
+
+        # This is necessary for downloads that post the csrf token from an iframe.
+        # Only forms are parsed, as reading POST buffers the whole body of any other
+        # content type (such as a streaming ingest)
+        if not request_csrf_token and request.META.get('CONTENT_TYPE', '').startswith(FORM_CONTENT_TYPES):
+            request_csrf_token = request.POST.get('csrfmiddlewaretoken', '')
 
         if not constant_time_compare(request_csrf_token, csrf_token):
             return False
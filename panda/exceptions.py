@@ -7,6 +7,13 @@ class DatasetLockedError(Exception):
     """
     pass
 
+class PartitionTimeoutError(Exception):
+    """
+    Exception raised when a partition of a task running in a worker stops
+    reporting progress.
+    """
+    pass
+
 class DataUploadNotDeletable(Exception):
     """
     Exception raised when a DataUpload can not be deleted.
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import ugettext as _
+
+from panda.models import Dataset
+
+class Command(NoArgsCommand):
+    help = _('Update the categories indexed on every dataset\'s data')
+
+    def handle_noargs(self, **options):
+        for dataset in Dataset.objects.all():
+            dataset.update_data_categories()
+            self.stdout.write(_('Queued: %s\n') % dataset.name)
+        
+        self.stdout.write(_('Done!\n'))
@@ -7,12 +7,14 @@ from django.utils.timezone import now
 from tastypie.models import ApiKey
 
 from panda import config # Needed for autodiscovery
+from panda.utils import cache
 from panda.models.activity_log import ActivityLog
 from panda.models.category import Category
 from panda.models.dataset import Dataset
 from panda.models.data_upload import DataUpload
 from panda.models.export import Export
 from panda.models.notification import Notification 
+from panda.models.queued_write import QueuedWrite
 from panda.models.related_upload import RelatedUpload
 from panda.models.search_log import SearchLog
 from panda.models.search_subscription import SearchSubscription
@@ -20,7 +22,7 @@ from panda.models.task_status import TaskStatus
 from panda.models.user_profile import UserProfile
 from panda.models.user_proxy import UserProxy
 
-__all__ = ['ActivityLog', 'Category', 'Dataset', 'DataUpload', 'Export', 'Notification', 'RelatedUpload', 'SearchLog', 'SearchSubscription', 'TaskStatus', 'UserProfile', 'UserProxy']
+__all__ = ['ActivityLog', 'Category', 'Dataset', 'DataUpload', 'Export', 'Notification', 'QueuedWrite', 'RelatedUpload', 'SearchLog', 'SearchSubscription', 'TaskStatus', 'UserProfile', 'UserProxy']
 
 @receiver(models.signals.post_save, sender=UserProxy)
 def on_user_post_save(sender, instance, created, **kwargs):
@@ -49,3 +51,82 @@ def on_user_post_save(sender, instance, created, **kwargs):
         if not instance.has_usable_password():
             user_profile.send_activation_email()
 
+@receiver(models.signals.post_save, sender=Dataset)
+def on_dataset_post_save(sender, instance, created, **kwargs):
+    """
+    Invalidate cached listings and searches when a Dataset is saved.
+    Category counts only change when a Dataset is created.
+    """
+    if created:
+        cache.invalidate(cache.DATASETS, cache.CATEGORIES)
+    else:
+        cache.invalidate(cache.DATASETS)
+
+    # Every import, write, delete or reindex ends by saving the dataset
+    cache.invalidate_dataset(instance.slug, instance.get_category_ids())
+
+@receiver(models.signals.post_delete, sender=Dataset)
+@receiver(models.signals.post_save, sender=Category)
+@receiver(models.signals.post_delete, sender=Category)
+@receiver(models.signals.m2m_changed, sender=Dataset.categories.through)
+def on_categories_changed(sender, **kwargs):
+    """
+    Invalidate cached listings and category counts when a Dataset or
+    Category is deleted, a Category is saved or a Dataset's categories change.
+    """
+    if kwargs.get('action', 'post_').startswith('post_'):
+        cache.invalidate(cache.DATASETS, cache.CATEGORIES)
+
+@receiver(models.signals.m2m_changed, sender=Dataset.categories.through)
+def on_dataset_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Update the categories indexed on a Dataset's data when its categories
+    change. Changes may be made from either side of the relation.
+    """
+    if action == 'pre_clear' and reverse:
+        # A Category is being emptied, remember what was in it
+        instance._cleared_datasets = list(instance.datasets.all())
+
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        datasets = [instance]
+    elif action == 'post_clear':
+        datasets = instance._cleared_datasets
+    else:
+        datasets = Dataset.objects.filter(pk__in=pk_set)
+
+    for dataset in datasets:
+        dataset.update_data_categories()
+
+@receiver(models.signals.pre_delete, sender=Category)
+def on_category_pre_delete(sender, instance, **kwargs):
+    """
+    Deleting a Category removes it from its Datasets without sending
+    ``m2m_changed``, so remember them to update after it's gone.
+    """
+    instance._deleted_datasets = list(instance.datasets.all())
+
+@receiver(models.signals.post_delete, sender=Category)
+def on_category_post_delete(sender, instance, **kwargs):
+    """
+    Update the data of the Datasets a deleted Category contained.
+    """
+    for dataset in getattr(instance, '_deleted_datasets', []):
+        dataset.update_data_categories()
+
+@receiver(models.signals.post_save, sender=DataUpload)
+@receiver(models.signals.post_delete, sender=DataUpload)
+@receiver(models.signals.post_save, sender=RelatedUpload)
+@receiver(models.signals.post_delete, sender=RelatedUpload)
+@receiver(models.signals.post_save, sender=TaskStatus)
+@receiver(models.signals.post_save, sender=UserProxy)
+def on_dataset_related_changed(sender, **kwargs):
+    """
+    Invalidate cached dataset listings when an object embedded in them
+    is changed.
+    """
+    cache.invalidate(cache.DATASETS)
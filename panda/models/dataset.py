@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+from copy import deepcopy
+from datetime import timedelta
+import time
 from urllib import unquote
+from uuid import uuid4
 
 from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.utils.timezone import now 
 from django.utils.translation import ugettext_lazy as _
 
@@ -14,10 +19,19 @@ from panda.models.category import Category
 from panda.models.slugged_model import SluggedModel
 from panda.models.task_status import TaskStatus
 from panda.models.user_proxy import UserProxy
-from panda.tasks import get_import_task_type_for_upload, ExportCSVTask, PurgeDataTask, ReindexTask 
-from panda.utils.column_schema import make_column_schema, update_indexed_names
+from panda.tasks import get_import_task_type_for_upload, ExportCSVTask, PurgeDataTask, ReindexTask, UpdateDataCategoriesTask
+from panda.utils.column_schema import diff_column_schemas, make_column_schema, update_indexed_names
 from panda.utils.typecoercion import DataTyper
 
+# Seconds between attempts to take a lock while waiting for it
+LOCK_POLL_INTERVAL = 0.1
+
+# Rows typed and sent to Solr at a time by ``Dataset.ingest_rows``
+INGEST_BATCH_SIZE = 500
+
+# Rows fetched from Solr at a time by ``Dataset.iter_export_rows``
+EXPORT_PAGE_SIZE = 500
+
 class Dataset(SluggedModel):
     """
     A PANDA dataset (one table & associated metadata).
@@ -33,6 +47,8 @@ class Dataset(SluggedModel):
         verbose_name=_('initial_upload'))
     column_schema = JSONField(_('column_schema'), null=True, default=None,
         help_text=_('Metadata about columns.'))
+    column_schema_indexed = models.BooleanField(_('column_schema_indexed'), default=True,
+        help_text=_('Is every row in Solr typed according to the column schema? False while a reindex is incomplete.'))
     sample_data = JSONField(_('sample_data'), null=True, default=None,
         help_text=_('Example data rows from the dataset.'))
     row_count = models.IntegerField(_('row_count'), null=True, blank=True,
@@ -40,6 +56,9 @@ class Dataset(SluggedModel):
     current_task = models.ForeignKey(TaskStatus, blank=True, null=True,
         help_text=_('The currently executed or last finished task related to this dataset.'),
         verbose_name=_('current_task')) 
+    categories_task = models.ForeignKey(TaskStatus, blank=True, null=True, related_name='+', on_delete=models.SET_NULL,
+        help_text=_('The running or last finished task updating the categories indexed on this dataset\'s data.'),
+        verbose_name=_('categories_task'))
     creation_date = models.DateTimeField(_('creation_date'), null=True,
         help_text=_('The date this dataset was initially created.'))
     creator = models.ForeignKey(UserProxy, related_name='datasets',
@@ -59,6 +78,8 @@ class Dataset(SluggedModel):
         help_text=_('Is this table locked for writing?'))
     locked_at = models.DateTimeField(_('locked_at'), null=True, default=None,
         help_text=_('Time this dataset was last locked.'))
+    lock_id = models.CharField(_('lock_id'), max_length=32, null=True, default=None,
+        help_text=_('Identifies the current holder of the lock, if any.'))
     related_links = JSONField(default=[])
 
     class Meta:
@@ -79,44 +100,191 @@ class Dataset(SluggedModel):
 
         super(Dataset, self).save(*args, **kwargs)
 
-    def lock(self):
+    def lock(self, timeout=0, lock_id=None):
         """
         Obtain an editing lock on this dataset.
+
+        The lock is taken with a single conditional update, so two processes
+        can never both get it. A lock expires if it is not renewed (see
+        ``heartbeat``) within ``PANDA_LOCK_LEASE`` seconds, so a crashed
+        worker can't leave a dataset locked forever.
+
+        Each lock has a ``lock_id``. Tasks are passed the id of the lock
+        taken when they were queued and resume it when they start, which
+        also renews its lease. The lease may have expired while they were
+        queued, in which case the lock is only resumed if nobody else has
+        taken it since.
+
+        If the dataset is locked, waits up to ``timeout`` seconds for it to
+        be unlocked before raising ``DatasetLockedError``.
+
+        Locks are re-entrant for the same ``Dataset`` instance, so several
+        writes can be made under one lock. Each ``lock`` must be matched by
+        an ``unlock``.
         """
-        # Ensure latest state has come over from the database
-        before_lock = self.__class__.objects.get(pk=self.pk)
-        self.locked = before_lock.locked
-        self.locked_at = before_lock.locked_at
+        if getattr(self, '_lock_depth', 0):
+            self._lock_depth += 1
+
+            return
+
+        deadline = time.time() + timeout
+        new_lock_id = lock_id or uuid4().hex
 
-        if self.locked:
-            # Already locked
-            raise DatasetLockedError(_('This dataset is currently locked by another process.'))
+        while True:
+            new_locked_at = now()
+            expired = new_locked_at - timedelta(seconds=settings.PANDA_LOCK_LEASE)
 
-        new_locked_at = now()
+            available = Q(locked=False) | Q(locked_at__isnull=True) | Q(locked_at__lt=expired)
+
+            if lock_id:
+                available |= Q(lock_id=lock_id)
+
+            if self.__class__.objects.filter(available, pk=self.pk).update(locked=True, locked_at=new_locked_at, lock_id=new_lock_id):
+                break
+
+            if time.time() >= deadline:
+                raise DatasetLockedError(_('This dataset is currently locked by another process.'))
+
+            time.sleep(LOCK_POLL_INTERVAL)
 
         self.locked = True
         self.locked_at = new_locked_at
+        self.lock_id = new_lock_id
+        self._heartbeat_at = time.time()
+        self._lock_depth = 1
 
-        self.save()
+        # Locks are taken without saving, so no signal is sent
+        utils.cache.invalidate(utils.cache.DATASETS)
+
+        # Row counts are maintained incrementally, so start from the latest
+        self.row_count = self.__class__.objects.filter(pk=self.pk).values_list('row_count', flat=True)[0]
 
-        # Refresh from database
-        after_lock = Dataset.objects.get(id=self.id)
-        self.locked = after_lock.locked
-        self.locked_at = after_lock.locked_at
+    def heartbeat(self):
+        """
+        Renew the lease on this dataset's lock. Long running tasks should
+        call this regularly, it only touches the database a few times per
+        lease.
+        """
+        if time.time() - getattr(self, '_heartbeat_at', 0) < settings.PANDA_LOCK_LEASE / 10.0:
+            return
 
-        if self.locked_at != new_locked_at:
-            # Somebody else got the lock
-            raise DatasetLockedError(_('This dataset is currently locked by another process.'))
+        self._heartbeat_at = time.time()
+        self.locked_at = now()
 
-    def unlock(self):
+        self.__class__.objects.filter(pk=self.pk, locked=True, lock_id=self.lock_id).update(locked_at=self.locked_at)
+
+        utils.cache.invalidate(utils.cache.DATASETS)
+
+    def unlock(self, lock_id=None):
         """
-        Unlock this dataset so it can be edited.
+        Unlock this dataset so it can be edited, and save it.
+
+        Only this instance's lock (or the lock ``lock_id``, for a lock
+        taken by another process) is released. If its lease expired and
+        someone else has locked the dataset since, their lock is kept.
         """
-        self.locked = False
-        self.lock_id = None
+        if getattr(self, '_lock_depth', 0) > 1:
+            self._lock_depth -= 1
+
+            return
+
+        self._lock_depth = 0
+
+        self.__class__.objects.filter(pk=self.pk, locked=True, lock_id=lock_id or self.lock_id).update(locked=False, lock_id=None)
+
+        # Save other changes without overwriting the current state of the lock
+        self.locked, self.locked_at, self.lock_id = self.__class__.objects.filter(pk=self.pk).values_list('locked', 'locked_at', 'lock_id')[0]
 
         self.save()
 
+    def is_locked_by_task(self):
+        """
+        Is this dataset locked by an import, reindex or categories update
+        which hasn't finished? Reads the latest state from the database. A
+        lock whose lease has expired doesn't count, as its task has
+        presumably died.
+        """
+        dataset = self.__class__.objects.select_related('current_task', 'categories_task').get(pk=self.pk)
+
+        if not dataset.locked or dataset.locked_at is None:
+            return False
+
+        if dataset.locked_at < now() - timedelta(seconds=settings.PANDA_LOCK_LEASE):
+            return False
+
+        for task in (dataset.current_task, dataset.categories_task):
+            if task is not None and task.end is None:
+                return True
+
+        return False
+
+    def has_queued_writes(self):
+        """
+        Are there writes to this dataset which have been queued, but not yet applied?
+        """
+        return self.queued_writes.filter(status='PENDING').exists()
+
+    def should_queue_writes(self):
+        """
+        Should writes made via the API be queued rather than applied now?
+        True while an import, reindex or categories update holds the lock,
+        and until any writes queued during it have been applied, so that
+        writes stay in order.
+        """
+        leased = now() - timedelta(seconds=settings.PANDA_LOCK_LEASE)
+        running = Q(current_task__isnull=False, current_task__end__isnull=True) | Q(categories_task__isnull=False, categories_task__end__isnull=True)
+
+        return self.__class__.objects.filter(
+            Q(queued_writes__status='PENDING') | (Q(locked=True, locked_at__gte=leased) & running),
+            pk=self.pk
+        ).exists()
+
+    def apply_queued_writes(self):
+        """
+        Apply every pending queued write to this dataset, in the order they
+        were made.
+        """
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
+
+        try:
+            for queued_write in self.queued_writes.filter(status='PENDING').order_by('id'):
+                queued_write.apply(self)
+        finally:
+            self.unlock()
+
+    def has_row_ids(self):
+        """
+        Can this dataset's data be read in order of id? Otherwise it is read
+        in the order it was indexed. See ``utils.solr.has_row_ids``.
+        """
+        return utils.solr.has_row_ids(settings.SOLR_DATA_CORE, utils.solr.make_filters([self.slug]))
+
+    def get_category_ids(self):
+        """
+        Get the ids of the categories containing this dataset, as they are
+        indexed on its data. Uncategorized datasets are indexed under
+        ``PANDA_UNCATEGORIZED_ID``.
+        """
+        # Unsaved datasets can't have any categories
+        if self.pk is None:
+            return [settings.PANDA_UNCATEGORIZED_ID]
+
+        category_ids = sorted(self.categories.values_list('id', flat=True))
+
+        return category_ids or [settings.PANDA_UNCATEGORIZED_ID]
+
+    def update_data_categories(self):
+        """
+        Update the categories indexed on this dataset's data in the
+        background. Changes made within ``PANDA_CATEGORIES_UPDATE_DELAY``
+        seconds of each other are applied by one task.
+        """
+        if utils.cache.claim('data_categories:%s' % self.slug, settings.PANDA_CATEGORIES_UPDATE_DELAY * 10):
+            UpdateDataCategoriesTask.apply_async(
+                args=[self.slug],
+                countdown=settings.PANDA_CATEGORIES_UPDATE_DELAY
+            )
+
     def update_full_text(self, commit=True):
         """
         Update the full-text search metadata for this dataset stored in Solr.
@@ -156,6 +324,10 @@ class Dataset(SluggedModel):
             'full_text': full_text
         }], commit=commit)
 
+        # Listings which were cached after this dataset was saved, but
+        # before Solr was updated, may be out of date
+        utils.cache.invalidate(utils.cache.DATASETS)
+
     def delete(self, *args, **kwargs):
         """
         Cancel any in progress task.
@@ -217,7 +389,7 @@ class Dataset(SluggedModel):
 
             task_type.apply_async(
                 args=[self.slug, upload.id],
-                kwargs={ 'external_id_field_index': external_id_field_index },
+                kwargs={ 'external_id_field_index': external_id_field_index, 'lock_id': self.lock_id },
                 task_id=self.current_task.id
             )
         except:
@@ -233,6 +405,7 @@ class Dataset(SluggedModel):
         task_type = ReindexTask
 
         try:
+            old_column_schema = deepcopy(self.column_schema)
             typed_column_count = 0
 
             if typed_columns:
@@ -248,6 +421,16 @@ class Dataset(SluggedModel):
 
             self.column_schema = update_indexed_names(self.column_schema)
 
+            # Rows left behind by an aborted or failed reindex may be typed
+            # with any mix of schemas, so all of them must be retyped
+            if self.column_schema_indexed:
+                changed_columns = diff_column_schemas(old_column_schema, self.column_schema)
+            else:
+                changed_columns = None
+
+            # Until the reindex succeeds
+            self.column_schema_indexed = False
+
             self.current_task = TaskStatus.objects.create(
                 task_name=task_type.name,
                 task_description=_('Reindex %(slug)s with %(typed_column_count)i column filters.') \
@@ -259,13 +442,44 @@ class Dataset(SluggedModel):
 
             task_type.apply_async(
                 args=[self.slug],
-                kwargs={},
+                kwargs={ 'changed_columns': changed_columns, 'lock_id': self.lock_id },
                 task_id=self.current_task.id
             )
         except:
             self.unlock()
             raise
 
+    def get_export_query(self, query=None, since=None):
+        """
+        Build the Solr query for exporting this ``Dataset``'s data, optionally
+        limited to the results of a search and to rows modified ``since``
+        a time. Returns a tuple of ``(q, filters)``.
+        """
+        return utils.solr.make_search_query(query), utils.solr.make_filters([self.slug], since)
+
+    def iter_export_rows(self, query=None, since=None):
+        """
+        Iterate over the rows of data in this ``Dataset`` (or matching
+        ``query`` and ``since``), in order, starting with a header. Rows
+        are fetched from Solr a page at a time.
+        """
+        yield [c['name'] for c in self.column_schema]
+
+        q, filters = self.get_export_query(query, since)
+
+        pages = utils.solr.iter_data(
+            settings.SOLR_DATA_CORE,
+            q,
+            fields=['data'],
+            page_size=EXPORT_PAGE_SIZE,
+            filters=filters,
+            by_id=self.has_row_ids()
+        )
+
+        for docs, rows in pages:
+            for row in rows:
+                yield row
+
     def export_data(self, user, query=None, filename=None):
         """
         Execute the data export task for this ``Dataset``.
@@ -307,7 +521,7 @@ class Dataset(SluggedModel):
         """
         Add (or overwrite) a row to this dataset.
         """
-        self.lock()
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
 
         try:
             data_typer = DataTyper(self.column_schema)
@@ -315,7 +529,12 @@ class Dataset(SluggedModel):
             solr_row = utils.solr.make_data_row(self, data, external_id=external_id)
             solr_row = data_typer(solr_row, data)
 
-            solr.add(settings.SOLR_DATA_CORE, [solr_row], commit=True)
+            if external_id:
+                added = 1 - self._count_existing_ids([solr_row['id']])
+            else:
+                added = 1
+
+            solr.add(settings.SOLR_DATA_CORE, [solr_row], commit=settings.SOLR_API_COMMIT_POLICY)
 
             self.schema = data_typer.schema
 
@@ -325,9 +544,7 @@ class Dataset(SluggedModel):
             if len(self.sample_data) < 5:
                 self.sample_data.append(data)
 
-            old_row_count = self.row_count
-            self.row_count = self._count_rows()
-            added = self.row_count - (old_row_count or 0)
+            self.row_count = (self.row_count or 0) + added
             self.last_modified = now()
             self.last_modified_by = user
             self.last_modification = _('1 row %s') % ('added' if added else 'updated')
@@ -343,15 +560,22 @@ class Dataset(SluggedModel):
 
         ``data`` must be an array of tuples in the format (data_array, external_id)
         """
-        self.lock()
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
 
         try:
             data_typer = DataTyper(self.column_schema)
 
-            solr_rows = [utils.solr.make_data_row(self, d[0], external_id=d[1]) for d in data]
-            solr_rows = [data_typer(s, d[0]) for s, d in zip(solr_rows, data)]
+            category_ids = self.get_category_ids()
+
+            solr_rows = [utils.solr.make_data_row(self, d[0], external_id=d[1], category_ids=category_ids) for d in data]
+            solr_rows = data_typer.type_batch(solr_rows, [d[0] for d in data])
 
-            solr.add(settings.SOLR_DATA_CORE, solr_rows, commit=True)
+            # Rows with an external id overwrite any existing row with the same id, including earlier rows in this batch
+            ids = [r['id'] for r in solr_rows if 'external_id' in r]
+            unique_ids = set(ids)
+            added = len(solr_rows) - len(ids) + len(unique_ids) - self._count_existing_ids(unique_ids)
+
+            solr.add(settings.SOLR_DATA_CORE, solr_rows, commit=settings.SOLR_API_COMMIT_POLICY)
             
             self.schema = data_typer.schema
 
@@ -362,14 +586,12 @@ class Dataset(SluggedModel):
                 needed = 5 - len(self.sample_data)
                 self.sample_data.extend([d[0] for d in data[:needed]])
 
-            old_row_count = self.row_count
-            self.row_count = self._count_rows()
-            added = self.row_count - (old_row_count or 0)
+            self.row_count = (self.row_count or 0) + added
             updated = len(data) - added
             self.last_modified = now()
             self.last_modified_by = user
 
-            if added and updated: 
+            if added and updated:
                 self.last_modification = _('%(added)i rows added and %(updated)i updated') \
                     % {'added': added, 'updated': updated}
             elif added:
@@ -383,16 +605,120 @@ class Dataset(SluggedModel):
         finally:
             self.unlock()
         
+    def ingest_rows(self, user, rows):
+        """
+        Add (or overwrite) rows in bulk from an iterable of
+        ``(row_number, data, external_id, error)`` tuples, such as one of the
+        parsers in ``panda.utils.ingest``. Rows are typed and sent to Solr in
+        fixed size batches as they are read, so memory use does not depend
+        on the number of rows.
+
+        Rows which could not be parsed or have the wrong number of fields
+        are skipped. Returns a summary of the number of rows added, updated
+        and failed, with the errors for the first ``PANDA_INGEST_MAX_ERRORS``
+        failed rows.
+        """
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
+
+        try:
+            data_typer = DataTyper(self.column_schema)
+            field_count = len(self.column_schema)
+
+            if not self.sample_data:
+                self.sample_data = []
+
+            encoder = utils.solr.DataBatchEncoder(self, data_typer)
+            row_buffer = []
+            external_id_buffer = []
+            written = 0
+            failed = 0
+            errors = []
+
+            writer = utils.solr.SolrWriter(settings.SOLR_DATA_CORE)
+
+            try:
+                for row_number, data, external_id, error in rows:
+                    if error is None and len(data) != field_count:
+                        error = _('Got %(field_count)i data fields. Expected %(expected_field_count)i.') \
+                            % {'field_count': len(data), 'expected_field_count': field_count}
+
+                    if error is not None:
+                        failed += 1
+
+                        if len(errors) < settings.PANDA_INGEST_MAX_ERRORS:
+                            errors.append({ 'row': row_number, 'error': unicode(error) })
+
+                        continue
+
+                    row_buffer.append(data)
+                    external_id_buffer.append(external_id)
+
+                    if len(self.sample_data) < 5:
+                        self.sample_data.append(data)
+
+                    if len(row_buffer) == INGEST_BATCH_SIZE:
+                        writer.add(encoder.encode(row_buffer, external_ids=external_id_buffer))
+                        written += len(row_buffer)
+
+                        row_buffer = []
+                        external_id_buffer = []
+
+                        self.heartbeat()
+
+                if row_buffer:
+                    writer.add(encoder.encode(row_buffer, external_ids=external_id_buffer))
+                    written += len(row_buffer)
+
+                # Wait for all batches to be sent
+                writer.close()
+            except:
+                writer.abort()
+                raise
+
+            # One commit for the whole request, after which rows can simply be counted
+            solr.commit(settings.SOLR_DATA_CORE)
+
+            old_row_count = self.row_count or 0
+            self.row_count = self._count_rows()
+            added = self.row_count - old_row_count
+            updated = written - added
+
+            self.column_schema = data_typer.schema
+            self.last_modified = now()
+            self.last_modified_by = user
+
+            if added and updated:
+                self.last_modification = _('%(added)i rows added and %(updated)i updated') \
+                    % {'added': added, 'updated': updated}
+            elif added:
+                self.last_modification = _('%i rows added') % added
+            else:
+                self.last_modification = _('%i rows updated') % updated
+
+            self.save()
+
+            return {
+                'added': added,
+                'updated': updated,
+                'failed': failed,
+                'errors': errors
+            }
+        finally:
+            self.unlock()
+
     def delete_row(self, user, external_id):
         """
         Delete a row in this dataset.
         """
-        self.lock()
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
 
         try:
-            solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s AND external_id:%s' % (self.slug, external_id), commit=True)
+            q = 'dataset_slug:%s AND external_id:%s' % (self.slug, external_id)
+            deleted = solr.count(settings.SOLR_DATA_CORE, q)
+
+            solr.delete(settings.SOLR_DATA_CORE, q, commit=settings.SOLR_API_COMMIT_POLICY)
         
-            self.row_count = self._count_rows()
+            self.row_count = max((self.row_count or 0) - deleted, 0)
             self.last_modified = now()
             self.last_modified_by = user
             self.last_modification = _('1 row deleted')
@@ -404,10 +730,10 @@ class Dataset(SluggedModel):
         """
         Delete all rows in this dataset.
         """
-        self.lock()
+        self.lock(timeout=settings.PANDA_LOCK_WAIT)
 
         try:
-            solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % self.slug, commit=True)
+            solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % self.slug, commit=settings.SOLR_API_COMMIT_POLICY)
 
             old_row_count = self.row_count
             self.row_count = 0
@@ -422,5 +748,22 @@ class Dataset(SluggedModel):
         Count the number of rows currently stored in Solr for this Dataset.
         Useful for sanity checks.
         """
-        return solr.query(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % self.slug)['response']['numFound']
+        return solr.count(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % self.slug)
+
+    def _count_existing_ids(self, ids):
+        """
+        Count how many of the given row ids are already stored in Solr.
+
+        Only committed rows can be seen, so counts based on this may drift
+        when writes aren't committed immediately. See ``ReconcileRowCountsTask``.
+        """
+        ids = list(ids)
+        existing = 0
+
+        # Stay well under Solr's limit of 1024 clauses per query
+        for i in range(0, len(ids), 500):
+            q = 'id:(%s)' % ' OR '.join([solr.quote(unicode(row_id)) for row_id in ids[i:i + 500]])
+            existing += solr.count(settings.SOLR_DATA_CORE, q)
+
+        return existing
 
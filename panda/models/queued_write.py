@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from django.db import models
+from django.utils.timezone import now 
+from django.utils.translation import ugettext_lazy as _
+
+from panda.fields import JSONField
+from panda.models.dataset import Dataset
+from panda.models.user_proxy import UserProxy
+
+QUEUED_WRITE_OPERATION_CHOICES = (
+    ('add', 'add'),
+    ('delete', 'delete'),
+    ('delete_all', 'delete_all')
+)
+
+QUEUED_WRITE_STATUS_CHOICES = (
+    ('PENDING', 'PENDING'),
+    ('APPLIED', 'APPLIED'),
+    ('FAILED', 'FAILED')
+)
+
+class QueuedWrite(models.Model):
+    """
+    A change to a dataset's data, made via the API while the dataset was
+    locked by an import or reindex. Queued writes are applied in the order
+    they were made once the dataset is unlocked.
+    """
+    dataset = models.ForeignKey(Dataset, related_name='queued_writes',
+        help_text=_('The dataset this write will be applied to.'),
+        verbose_name=_('dataset'))
+    creator = models.ForeignKey(UserProxy, related_name='queued_writes',
+        help_text=_('The user who made this write.'),
+        verbose_name=_('creator'))
+    operation = models.CharField(_('operation'), max_length=16, choices=QUEUED_WRITE_OPERATION_CHOICES,
+        help_text=_('The type of write: add (or overwrite) rows, delete a row or delete all rows.'))
+    data = JSONField(_('data'), null=True, default=None,
+        help_text=_('Rows to be added, as a list of [data, external_id] pairs.'))
+    external_id = models.CharField(_('external_id'), max_length=256, null=True, blank=True, default=None,
+        help_text=_('The external id of the row to be deleted.'))
+    status = models.CharField(_('status'), max_length=50, default='PENDING', choices=QUEUED_WRITE_STATUS_CHOICES,
+        help_text=_('Whether this write is still waiting, has been applied or failed.'))
+    message = models.TextField(_('message'), blank=True, null=True, default=None,
+        help_text=_('Why this write failed, if it did.'))
+    creation_date = models.DateTimeField(_('creation_date'),
+        help_text=_('The date this write was made.'))
+    applied_date = models.DateTimeField(_('applied_date'), null=True, default=None,
+        help_text=_('The date this write was applied, or failed.'))
+
+    class Meta:
+        app_label = 'panda'
+        ordering = ['id']
+        verbose_name = _('QueuedWrite')
+        verbose_name_plural = _('QueuedWrites')
+
+    def __unicode__(self):
+        return _('%(operation)s on %(dataset)s by %(creator)s') \
+            % {'operation': self.operation, 'dataset': self.dataset, 'creator': self.creator}
+
+    def save(self, *args, **kwargs):
+        """
+        Save the date of creation.
+        """
+        if not self.creation_date:
+            self.creation_date = now()
+
+        super(QueuedWrite, self).save(*args, **kwargs)
+
+    def apply(self, dataset):
+        """
+        Apply this write to its dataset and record the outcome. ``dataset``
+        must be locked by the caller.
+        """
+        try:
+            if self.operation == 'add':
+                dataset.add_many_rows(self.creator, [(d, external_id) for d, external_id in self.data])
+            elif self.operation == 'delete':
+                dataset.delete_row(self.creator, self.external_id)
+            elif self.operation == 'delete_all':
+                dataset.delete_all_rows(self.creator)
+        except Exception, e:
+            self.status = 'FAILED'
+            self.message = unicode(e)
+        else:
+            self.status = 'APPLIED'
+
+        self.applied_date = now()
+        self.save()
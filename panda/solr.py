@@ -5,7 +5,12 @@ Ultra-lightweight wrapper around Solr's JSON API.
 
 Replaces sunburnt in PANDA. Not a generic solution.
 """
+import atexit
 import datetime
+import logging
+import os
+import threading
+import time
 
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
@@ -44,70 +49,374 @@ class SolrError(Exception):
     def __unicode__(self):
         return self.response_body
 
-def add(core, documents, commit=False):
+JSON_HEADERS = { 'Content-Type': 'application/json' }
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_urls = {}
+
+def get_session():
     """
-    Add a document or list of documents to Solr.
+    Get the pooled HTTP session used to talk to Solr.
+
+    A single session (and thus a single keep-alive connection pool) is
+    shared by all threads in a process. Connection pools can not survive a
+    fork, so a new session is created the first time it is requested in
+    each new process (e.g. a Celery worker).
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = requests.session(
+                    timeout=settings.SOLR_TIMEOUT,
+                    config={
+                        'keep_alive': True,
+                        'pool_maxsize': settings.SOLR_CONNECTION_POOL_SIZE
+                    }
+                )
+                _session_pid = pid
+
+    return _session
+
+def get_url(core, handler):
+    """
+    Get the url for a handler on a Solr core. Urls are only built once.
+    """
+    key = (settings.SOLR_ENDPOINT, core, handler)
+
+    try:
+        return _urls[key]
+    except KeyError:
+        url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/', handler])
+        _urls[key] = url
 
-    Does not commit changes by default.
+        return url
+
+def connection_stats():
+    """
+    Report how well the connection pool for this process is being reused.
+    """
+    pool = get_session().poolmanager.connection_from_url(settings.SOLR_ENDPOINT)
+
+    if pool.num_requests:
+        reuse_rate = 1.0 - float(pool.num_connections) / pool.num_requests
+    else:
+        reuse_rate = 0.0
+
+    return {
+        'requests': pool.num_requests,
+        'connections': pool.num_connections,
+        'reuse_rate': max(reuse_rate, 0.0)
+    }
+
+def _request(method, url, data=None, params=None, parse=True):
+    """
+    Make a request against Solr using the pooled session.
+
+    Response content is always read immediately so that the connection
+    is released back to the pool. It is decoded from JSON unless ``parse``
+    is ``False``.
     """
-    url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/update'])
-    params = { 'commit': 'true' } if commit else {}
-    response = requests.post(url, dumps(documents), params=params, headers={ 'Content-Type': 'application/json' })
+    response = get_session().request(method, url, data=data, params=params, headers=JSON_HEADERS)
 
     if response.status_code != 200:
         raise SolrError(response)
-    
+
+    if not parse:
+        return response.content
+
     return loads(response.content)
 
-def commit(core):
+COMMIT_IMMEDIATE = 'immediate'
+COMMIT_WITHIN = 'within'
+COMMIT_DEFERRED = 'deferred'
+COMMIT_NONE = 'none'
+
+COMMIT_POLICIES = (COMMIT_IMMEDIATE, COMMIT_WITHIN, COMMIT_DEFERRED, COMMIT_NONE)
+
+def get_commit_policy(commit):
+    """
+    Normalize the ``commit`` argument of a write to one of ``COMMIT_POLICIES``.
+
+    ``True`` and ``False`` are accepted for backwards compatibility and mean
+    ``COMMIT_IMMEDIATE`` and ``COMMIT_NONE``, respectively:
+
+    * ``COMMIT_IMMEDIATE``: commit as part of the request. Changes are
+      visible as soon as the request returns, at the cost of opening a new
+      searcher every time.
+    * ``COMMIT_WITHIN``: ask Solr to commit within ``SOLR_COMMIT_WITHIN``
+      milliseconds, so a burst of writes shares one commit.
+    * ``COMMIT_DEFERRED``: have this process's background committer commit
+      within ``SOLR_COMMIT_INTERVAL`` seconds.
+    * ``COMMIT_NONE``: leave committing to the caller.
+    """
+    if commit is True:
+        return COMMIT_IMMEDIATE
+    elif commit is False or commit is None:
+        return COMMIT_NONE
+    elif commit in COMMIT_POLICIES:
+        return commit
+
+    raise ValueError('Unknown commit policy: %s' % commit)
+
+class DeferredCommitter(object):
+    """
+    Commits cores with pending changes from a background thread, at most
+    once every ``SOLR_COMMIT_INTERVAL`` seconds per core, however many
+    writes were made in between.
+
+    Like the connection pool, the thread does not survive a fork and is
+    restarted the first time it is needed in each new process. Anything
+    still pending when the process exits is committed then.
+    """
+    def __init__(self):
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def schedule(self, core):
+        """
+        Commit ``core`` the next time the committer runs.
+        """
+        with self.lock:
+            self.pending.add(core)
+
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.SOLR_COMMIT_INTERVAL)
+
+            self.flush()
+
+    def flush(self):
+        """
+        Commit every pending core now.
+        """
+        with self.lock:
+            cores = self.pending
+            self.pending = set()
+
+        for core in cores:
+            try:
+                commit(core)
+            except Exception:
+                logging.getLogger('panda.solr').exception('Deferred commit failed, core: %s' % core)
+
+                with self.lock:
+                    self.pending.add(core)
+
+committer = DeferredCommitter()
+
+atexit.register(committer.flush)
+
+def _commit_params(core, policy):
+    """
+    Get the request parameters for a write with the given commit policy,
+    scheduling a deferred commit if necessary.
+    """
+    if policy == COMMIT_IMMEDIATE:
+        return { 'commit': 'true' }
+    elif policy == COMMIT_DEFERRED:
+        committer.schedule(core)
+
+    return {}
+
+def add(core, documents, commit=False):
+    """
+    Add a document or list of documents to Solr.
+
+    ``documents`` may also be a string holding a JSON array of documents
+    which has already been encoded (see ``panda.utils.solr.DataBatchEncoder``),
+    except with ``COMMIT_WITHIN``.
+
+    ``commit`` may be a boolean or any of ``COMMIT_POLICIES``. Does not
+    commit changes by default.
+    """
+    policy = get_commit_policy(commit)
+
+    if isinstance(documents, basestring):
+        if policy == COMMIT_WITHIN:
+            raise ValueError('Encoded documents can not be added with the %s commit policy.' % COMMIT_WITHIN)
+
+        body = documents
+    elif policy == COMMIT_WITHIN:
+        if isinstance(documents, dict):
+            documents = [documents]
+
+        # Solr 3 only accepts commitWithin as part of an add command. The
+        # command may be repeated within one object, which a dict can't express.
+        within = settings.SOLR_COMMIT_WITHIN
+        body = '{%s}' % ','.join(['"add":{"doc":%s,"commitWithin":%i}' % (dumps(d), within) for d in documents])
+    else:
+        body = dumps(documents)
+
+    return _request('POST', get_url(core, 'update'), body, _commit_params(core, policy))
+
+def commit(core, policy=COMMIT_IMMEDIATE):
     """
     Commit all staged changes to the Solr index.
+
+    Commits immediately by default. Given any other policy, changes are
+    committed the same way a write with that policy would be.
     """
-    url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/update'])
-    response = requests.post(url, '[]', params={ 'commit': 'true' }, headers={ 'Content-Type': 'application/json' })
+    policy = get_commit_policy(policy)
 
-    if response.status_code != 200:
-        raise SolrError(response)
-    
-    return loads(response.content)
+    if policy == COMMIT_IMMEDIATE:
+        return _request('POST', get_url(core, 'update'), '[]', { 'commit': 'true' })
+    elif policy in (COMMIT_WITHIN, COMMIT_DEFERRED):
+        committer.schedule(core)
 
 def delete(core, q, commit=True):
     """
     Delete documents by query from the Solr index.
 
-    Commits changes by default.
+    ``commit`` may be a boolean or any of ``COMMIT_POLICIES``. Commits
+    changes by default. Solr 3 does not support commitWithin for deletes,
+    so ``COMMIT_WITHIN`` deletes are committed by the background committer.
     """
-    url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/update'])
-    params = { 'commit': 'true' } if commit else {}
-    response = requests.post(url, dumps({ 'delete': { 'query': q } }), params=params, headers={ 'Content-Type': 'application/json' })
-    
-    if response.status_code != 200:
-        raise SolrError(response)
-    
-    return loads(response.content)
+    policy = get_commit_policy(commit)
+
+    if policy == COMMIT_WITHIN:
+        policy = COMMIT_DEFERRED
+
+    return _request('POST', get_url(core, 'update'), dumps({ 'delete': { 'query': q } }), _commit_params(core, policy))
+
+def _select_params(q, fields=None, filters=None, omit_header=True, wt='json'):
+    """
+    Build the parameters shared by every select request.
+
+    ``fields`` limits the stored fields returned for each document (by
+    default all are). ``filters`` is a list of filter queries, which are
+    cached by Solr independently of ``q``. The response header, which echoes
+    every parameter back, is omitted unless ``omit_header`` is ``False``.
+    """
+    params = { 'q': q, 'mm': '1', 'wt': wt }
+
+    if fields:
+        params['fl'] = ','.join(fields)
+
+    if filters:
+        params['fq'] = list(filters)
+
+    if omit_header:
+        params['omitHeader'] = 'true'
+
+    return params
 
-def query(core, q, limit=10, offset=0, sort='_docid_ asc'):
+def query(core, q, limit=10, offset=0, sort='_docid_ asc', fields=None, filters=None, omit_header=True, wt='json'):
     """
     Execute a simple, raw query against the Solr index.
+
+    See ``_select_params`` for the remaining arguments. Responses in any
+    format (``wt``) other than JSON are returned without being decoded.
     """
-    url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/select'])
-    response = requests.get(url, params={ 'q': q, 'mm': '1', 'start': offset, 'rows': limit, 'sort': sort }, headers={ 'Content-Type': 'application/json' })
+    params = _select_params(q, fields, filters, omit_header, wt)
+    params.update({ 'start': offset, 'rows': limit, 'sort': sort })
 
-    if response.status_code != 200:
-        raise SolrError(response)
-    
-    return loads(response.content)
+    return _request('GET', get_url(core, 'select'), params=params, parse=(wt == 'json'))
 
-def query_grouped(core, q, group_field, limit=10, offset=0, sort='_docid_ asc', group_limit=settings.PANDA_DEFAULT_SEARCH_ROWS_PER_GROUP, group_offset=0):
+def query_grouped(core, q, group_field, limit=10, offset=0, sort='_docid_ asc', group_limit=settings.PANDA_DEFAULT_SEARCH_ROWS_PER_GROUP, group_offset=0, fields=None, filters=None, omit_header=True):
     """
     Execute a query and return results in a grouped format
     appropriate for the PANDA API.
     """
-    url = ''.join([settings.SOLR_ENDPOINT, '/', core, '/select'])
-    response = requests.get(url, params={ 'q': q, 'mm': '1', 'start': offset, 'rows': limit, 'sort': sort, 'group': 'true', 'group.field': group_field, 'group.limit': group_limit, 'group.offset': group_offset, 'group.ngroups': 'true' }, headers={ 'Content-Type': 'application/json' })
+    params = _select_params(q, fields, filters, omit_header)
+    params.update({ 'start': offset, 'rows': limit, 'sort': sort, 'group': 'true', 'group.field': group_field, 'group.limit': group_limit, 'group.offset': group_offset, 'group.ngroups': 'true' })
 
-    if response.status_code != 200:
-        raise SolrError(response)
+    return _request('GET', get_url(core, 'select'), params=params)
 
-    return loads(response.content)
+def count(core, q, filters=None):
+    """
+    Count the documents matching a query, without fetching any of them.
+    """
+    return query(core, q, limit=0, fields=['id'], filters=filters)['response']['numFound']
+
+def quote(value):
+    """
+    Quote a value for use as a term in a Solr query.
+    """
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+def iter_pages(core, q, fields=None, page_size=500, after=None, until=None, filters=None, by_id=True):
+    """
+    Iterate over every document matching a query, in order of ``id``, a
+    page (list of documents) at a time.
+
+    Rather than paging with an offset, which gets slower the deeper Solr
+    has to go, each page is fetched with a range filter that starts just
+    after the last ``id`` seen. ``after`` and ``until`` optionally bound
+    the range of ids (exclusive and inclusive, respectively). ``filters``
+    are applied to every page.
+
+    If ``by_id`` is ``False`` documents are instead paged with an offset,
+    in the order they were indexed (``_docid_``), for documents whose ids
+    don't follow the order they were added. Ranges of ids can't be used.
+    """
+    params = _select_params(q, set(fields) | set(['id']) if fields else None)
+    params.update({ 'rows': page_size, 'sort': 'id asc' })
+
+    filters = list(filters or [])
+
+    if not by_id:
+        if after is not None or until is not None:
+            raise ValueError('Ranges of ids can only be read in order of id.')
+
+        params.update({ 'sort': '_docid_ asc', 'fq': filters })
+        offset = 0
+
+        while True:
+            params['start'] = offset
 
+            response = _request('GET', get_url(core, 'select'), params=params)
+            docs = response['response']['docs']
+
+            if docs:
+                yield docs
+
+            if len(docs) < page_size:
+                break
+
+            offset += len(docs)
+
+        return
+
+    if until is not None:
+        filters.append('id:[* TO %s]' % quote(until))
+
+    while True:
+        params['fq'] = list(filters)
+
+        if after is not None:
+            params['fq'].append('id:{%s TO *}' % quote(after))
+
+        response = _request('GET', get_url(core, 'select'), params=params)
+        docs = response['response']['docs']
+
+        if docs:
+            yield docs
+
+        if len(docs) < page_size:
+            break
+
+        after = docs[-1]['id']
+
+def iter_docs(core, q, fields=None, page_size=500, after=None, until=None, filters=None, by_id=True):
+    """
+    Iterate over every document matching a query, in order of ``id``. See
+    ``iter_pages``.
+    """
+    for docs in iter_pages(core, q, fields, page_size, after, until, filters, by_id):
+        for doc in docs:
+            yield doc
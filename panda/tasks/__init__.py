@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 
+from panda.tasks.apply_queued_writes import ApplyQueuedWritesTask
 from panda.tasks.export_csv import ExportCSVTask
 from panda.tasks.export_search import ExportSearchTask
-from panda.tasks.import_csv import ImportCSVTask
+from panda.tasks.import_csv import ImportCSVTask, ImportCSVChunkTask
 from panda.tasks.import_xls import ImportXLSTask
 from panda.tasks.import_xlsx import ImportXLSXTask
 from panda.tasks.purge_data import PurgeDataTask
 from panda.tasks.purge_orphaned_uploads import PurgeOrphanedUploadsTask
-from panda.tasks.reindex import ReindexTask
+from panda.tasks.reconcile_row_counts import ReconcileRowCountsTask
+from panda.tasks.reindex import ReindexTask, ReindexPartitionTask
 from panda.tasks.run_admin_alerts import RunAdminAlertsTask
 from panda.tasks.run_subscriptions import RunSubscriptionsTask
+from panda.tasks.update_data_categories import UpdateDataCategoriesTask
 
 TASKS_BY_TYPE = {
     'csv': ImportCSVTask,
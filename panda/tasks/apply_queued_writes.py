@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import logging
+
+from panda.tasks.base import Task
+from django.conf import settings
+
+from panda.exceptions import DatasetLockedError
+
+class ApplyQueuedWritesTask(Task):
+    """
+    Apply API writes which were queued while a dataset was locked by a task.
+    """
+    name = 'panda.tasks.apply_queued_writes'
+
+    # Retried for as long as the dataset is locked by something that won't apply them
+    max_retries = None
+    default_retry_delay = settings.PANDA_QUEUED_WRITES_RETRY
+
+    def run(self, dataset_slug, *args, **kwargs):
+        from panda.models import Dataset
+
+        log = logging.getLogger(self.name)
+        log.info('Applying queued writes, dataset_slug: %s' % dataset_slug)
+
+        try:
+            dataset = Dataset.objects.get(slug=dataset_slug)
+        except Dataset.DoesNotExist:
+            log.warning('Queued writes not applied due to Dataset being deleted, dataset_slug: %s' % dataset_slug)
+
+            return
+
+        # More writes may be queued while the first ones are applied
+        while dataset.has_queued_writes():
+            # The task holding the lock will apply them when it finishes
+            if dataset.is_locked_by_task():
+                log.info('Dataset locked by a task, queued writes deferred, dataset_slug: %s' % dataset_slug)
+
+                return
+
+            try:
+                dataset.apply_queued_writes()
+            except DatasetLockedError:
+                log.info('Dataset locked, retrying queued writes, dataset_slug: %s' % dataset_slug)
+
+                self.retry(args=[dataset_slug], kwargs=kwargs)
+
+        log.info('Finished applying queued writes, dataset_slug: %s' % dataset_slug)
@@ -8,7 +8,6 @@ import time
 
 from csvkit import CSVKitWriter
 from django.conf import settings
-from django.utils import simplejson as json
 from django.utils.translation import ugettext
 from livesettings import config_value
 
@@ -57,56 +56,32 @@ class ExportCSVTask(ExportFileTask):
         f = open(path, 'w')
         writer = CSVKitWriter(f)
 
-        # Header
-        writer.writerow([c['name'] for c in dataset.column_schema])
-
-        solr_query_bits = []
-
-        if query:
-            solr_query_bits.append('(%s)' % query) 
-
-        solr_query_bits.append('dataset_slug:%s' % dataset_slug)
-
-        solr_query = ' AND '.join(solr_query_bits)
-
-        response = solr.query(
-            settings.SOLR_DATA_CORE,
-            solr_query,
-            offset=0,
-            limit=0
-        )
-
-        total_count = response['response']['numFound']
+        q, filters = dataset.get_export_query(query)
+        total_count = solr.count(settings.SOLR_DATA_CORE, q, filters)
         n = 0
         throttle = config_value('PERF', 'TASK_THROTTLE')
 
-        while n < total_count:
-            response = solr.query(
-                settings.SOLR_DATA_CORE,
-                solr_query,
-                offset=n,
-                limit=SOLR_PAGE_SIZE
-            )
+        rows = dataset.iter_export_rows(query)
 
-            results = response['response']['docs']
+        # Header
+        writer.writerow(rows.next())
 
-            for row in results:
-                data = json.loads(row['data'])
+        for row in rows:
+            writer.writerow(row)
 
-                writer.writerow(data)
+            n += 1
 
-            task_status.update(ugettext('%.0f%% complete') % floor(float(n) / float(total_count) * 100))
+            if n % SOLR_PAGE_SIZE == 0:
+                task_status.update(ugettext('%.0f%% complete') % floor(float(n) / float(total_count) * 100))
 
-            if self.is_aborted():
-                task_status.abort(ugettext('Aborted after exporting %.0f%%') % floor(float(n) / float(total_count) * 100))
+                if self.is_aborted():
+                    task_status.abort(ugettext('Aborted after exporting %.0f%%') % floor(float(n) / float(total_count) * 100))
 
-                log.warning('Export aborted, dataset_slug: %s' % dataset_slug)
+                    log.warning('Export aborted, dataset_slug: %s' % dataset_slug)
 
-                return
+                    return
 
-            n += SOLR_PAGE_SIZE
-            
-            time.sleep(throttle)
+                time.sleep(throttle)
 
         f.close()
 
@@ -1,22 +1,22 @@
 #!/usr/bin/env python
 
+from itertools import izip
 import logging
 from math import floor
 import os.path
 import time
 from traceback import format_tb
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
 from panda.tasks.base import AbortableTask
-from csvkit import CSVKitWriter
 from django.conf import settings
-from django.utils import simplejson as json
 from django.utils.timezone import now 
 from django.utils.translation import ugettext
 from livesettings import config_value
 
-from panda import solr
+from panda import solr, utils
 from panda.utils.notifications import notify
+from panda.utils.zipstream import OrderedProducers, write_entry
 
 SOLR_PAGE_SIZE = 500
 
@@ -43,19 +43,16 @@ class ExportSearchTask(AbortableTask):
 
         zip_name = '%s.zip' % filename
 
-        path = os.path.join(settings.EXPORT_ROOT, filename)
         zip_path = os.path.join(settings.EXPORT_ROOT, zip_name)
 
         try:
-            os.makedirs(os.path.realpath(path))
+            os.makedirs(os.path.realpath(settings.EXPORT_ROOT))
         except:
             pass
-        
-        zipfile = ZipFile(zip_path, 'w')
 
         response = solr.query_grouped(
             settings.SOLR_DATA_CORE,
-            query,
+            utils.solr.make_search_query(query),
             'dataset_slug',
             offset=0,
             limit=1000,
@@ -72,78 +69,68 @@ class ExportSearchTask(AbortableTask):
 
             datasets[dataset_slug] = count
 
-        total_n = 0
+        total_n = [0]
+        total_count = sum(datasets.values())
         throttle = config_value('PERF', 'TASK_THROTTLE')
 
+        found = []
+
         for dataset_slug in datasets:
             try:
-                dataset = Dataset.objects.get(slug=dataset_slug)
+                found.append(Dataset.objects.get(slug=dataset_slug))
             except Dataset.DoesNotExist:
                 log.warning('Skipping part of export due to Dataset being deleted, dataset_slug: %s' % dataset_slug)
 
-                continue
-
-            filename = '%s.csv' % dataset_slug
-            file_path = os.path.join(path, filename)
+        # Each dataset's CSV is encoded in the background and compressed
+        # straight into the zip, so no temporary files are needed
+        producers = OrderedProducers(
+            [self.iter_csv_chunks(dataset, query) for dataset in found],
+            threads=settings.PANDA_EXPORT_SEARCH_THREADS
+        )
 
-            f = open(file_path, 'w')
-            writer = CSVKitWriter(f)
-            
-            # Header
-            writer.writerow([c['name'] for c in dataset.column_schema])
-                
-            response = solr.query(
-                settings.SOLR_DATA_CORE,
-                query,
-                offset=0,
-                limit=0
-            )
+        zipfile = ZipFile(zip_path, 'w', ZIP_DEFLATED, allowZip64=True)
 
-            # Update dataset and total counts for progress tracking
-            datasets[dataset_slug] = response['response']['numFound']
-            total_count = sum(datasets.values())
+        aborted = [False]
 
-            n = 0
+        def progress(chunks):
+            for rows, chunk in chunks:
+                yield chunk
 
-            while n < datasets[dataset_slug]:
+                total_n[0] += rows
 
-                response = solr.query(
-                    settings.SOLR_DATA_CORE,
-                    'dataset_slug:%s AND (%s)' % (dataset_slug, query),
-                    offset=n,
-                    limit=SOLR_PAGE_SIZE
-                )
+                task_status.update(ugettext('%.0f%% complete') % floor(float(total_n[0]) / float(total_count) * 100))
 
-                results = response['response']['docs']
+                if self.is_aborted():
+                    aborted[0] = True
 
-                for row in results:
-                    data = json.loads(row['data'])
+                    return
 
-                    writer.writerow(data)
+                time.sleep(throttle)
 
-                task_status.update(ugettext('%.0f%% complete') % floor(float(total_n) / float(total_count) * 100))
+        try:
+            for dataset, chunks in izip(found, producers):
+                write_entry(zipfile, '%s.csv' % dataset.slug, progress(chunks))
 
-                if self.is_aborted():
-                    task_status.abort(ugettext('Aborted after exporting %.0f%%') % floor(float(total_n) / float(total_count) * 100))
+                if aborted[0]:
+                    break
+        except:
+            producers.abort()
+            zipfile.close()
+            os.remove(zip_path)
 
-                    log.warning('Export aborted, query: %s' % query)
+            raise
 
-                    return
+        producers.abort()
+        zipfile.close()
 
-                n += SOLR_PAGE_SIZE
-                total_n += response['response']['numFound'] 
-                
-                time.sleep(throttle)
+        if aborted[0]:
+            os.remove(zip_path)
 
-            f.close()
+            task_status.abort(ugettext('Aborted after exporting %.0f%%') % floor(float(total_n[0]) / float(total_count) * 100))
 
-            # Add to zip and nuke temp file
-            zipfile.write(file_path, filename)
-            os.remove(file_path)
+            log.warning('Export aborted, query: %s' % query)
 
-        # Finish zip file and nuke temp directory
-        zipfile.close()
-        os.rmdir(path)
+            return
 
         task_status.update(ugettext('100% complete'))
 
@@ -151,6 +138,28 @@ class ExportSearchTask(AbortableTask):
 
         return zip_name
 
+    def iter_csv_chunks(self, dataset, query):
+        """
+        Encode the rows of a dataset which match a query as CSV. Yields
+        ``(rows, data)`` tuples, where ``rows`` is the number of rows of data
+        encoded since the previous tuple.
+        """
+        counted = [0]
+
+        def count(rows):
+            for row in rows:
+                counted[0] += 1
+
+                yield row
+
+        # The header is not counted
+        previous = 1
+
+        for chunk in utils.csvdata.iter_csv_chunks(count(dataset.iter_export_rows(query)), SOLR_PAGE_SIZE):
+            yield counted[0] - previous, chunk
+
+            previous = counted[0]
+
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         """
         Save final status, results, etc.
@@ -2,6 +2,7 @@
 
 import logging
 from math import floor
+import os.path
 import time
 
 from csvkit import CSVKitReader
@@ -11,32 +12,164 @@ from livesettings import config_value
 
 from panda import solr, utils
 from panda.exceptions import DataImportError
-from panda.tasks.import_file import ImportFileTask 
+from panda.tasks.import_file import ImportFileTask
+from panda.tasks.partitioned import PartitionTask, run_partitions
 from panda.utils.typecoercion import DataTyper
 
 SOLR_ADD_BUFFER_SIZE = 500
 
+def import_rows(dataset, upload, reader, progress, external_id_field_index=None, first_row=0, timestamp=None):
+    """
+    Import every row from a CSV reader into Solr.
+
+    ``first_row`` is the number of rows in the file before the reader's
+    first row, for error messages. If ``timestamp`` is given row ids are
+    built from it and the row number, so rows imported in parallel still
+    sort in file order. ``progress`` is called with the number of rows
+    imported after each batch and the import stops if it returns ``False``.
+
+    Returns a tuple of ``(data_typer, rows)``, or ``None`` if aborted.
+    """
+    row_buffer = []
+    external_id_buffer = []
+    row_id_buffer = []
+    data_typer = DataTyper(dataset.column_schema)
+    encoder = utils.solr.DataBatchEncoder(dataset, data_typer, data_upload=upload)
+    throttle = config_value('PERF', 'TASK_THROTTLE')
+
+    # Batches are sent to Solr in the background while parsing continues
+    writer = utils.solr.SolrWriter(settings.SOLR_DATA_CORE)
+
+    i = 0
+
+    try:
+        while True:
+            # The row number which is about to be read, for error handling and indexing
+            i += 1
+
+            try:
+                row = reader.next()
+            except StopIteration:
+                i -= 1
+                break
+            except UnicodeDecodeError:
+                raise DataImportError(ugettext('This CSV file contains characters that are not %(encoding)s encoded in or after row %(row)i. You need to re-upload this file and input the correct encoding in order to import data from this file.') % { 'encoding': upload.encoding, 'row': first_row + i })
+
+            external_id = None
+
+            if external_id_field_index is not None:
+                external_id = row[external_id_field_index]
+
+            row_id = None
+
+            if timestamp is not None:
+                row_id = utils.solr.make_row_id(timestamp, first_row + i)
+
+            row_buffer.append(row)
+            external_id_buffer.append(external_id)
+            row_id_buffer.append(row_id)
+
+            if i % SOLR_ADD_BUFFER_SIZE == 0:
+                writer.add(encoder.encode(row_buffer, external_ids=external_id_buffer, row_ids=row_id_buffer))
+
+                row_buffer = []
+                external_id_buffer = []
+                row_id_buffer = []
+
+                if not progress(i):
+                    writer.abort()
+
+                    return None
+
+                time.sleep(throttle)
+
+        if row_buffer:
+            writer.add(encoder.encode(row_buffer, external_ids=external_id_buffer, row_ids=row_id_buffer))
+            row_buffer = []
+            external_id_buffer = []
+            row_id_buffer = []
+
+        # Wait for all batches to be sent
+        writer.close()
+    except:
+        writer.abort()
+        raise
+
+    return data_typer, i
+
+class ImportCSVChunkTask(PartitionTask):
+    """
+    Task to import one chunk of a large CSV.
+    """
+    name = 'panda.tasks.partition.import.csv'
+
+    @classmethod
+    def process(cls, progress, dataset_slug, upload_id, start, end, first_row, timestamp):
+        """
+        Import every row in the chunk.
+        """
+        from panda.models import Dataset, DataUpload
+
+        dataset = Dataset.objects.get(slug=dataset_slug)
+        upload = DataUpload.objects.get(id=upload_id)
+
+        with open(upload.get_path(), 'r') as f:
+            reader = CSVKitReader(utils.csvdata.FileRange(f, start, end), encoding=upload.encoding, **upload.dialect_as_parameters())
+
+            # Skip headers
+            if start == 0:
+                reader.next()
+
+            result = import_rows(dataset, upload, reader, progress, first_row=first_row, timestamp=timestamp)
+
+        if result is None:
+            return None
+
+        # Results are pickled, so only plain data is returned
+        data_typer, i = result
+
+        return data_typer.get_stats(), i
+
 class ImportCSVTask(ImportFileTask):
     """
     Task to import all data for a dataset from a CSV.
     """
     name = 'panda.tasks.import.csv'
 
-    def _count_lines(self, filename):
+    def get_chunks(self, upload, external_id_field_index):
         """
-        Efficiently count the number of lines in a file.
+        Split a large upload into chunks which can be imported in parallel.
+
+        Returns a tuple of ``(chunks, row_count)`` or ``None`` if the upload
+        should be imported serially.
         """
-        with open(filename) as f:
-            for i, l in enumerate(f):
-                pass
-        return i + 1
+        path = upload.get_path()
+        dialect = upload.dialect_as_parameters()
+
+        if settings.PANDA_IMPORT_PARTITIONS < 2 or os.path.getsize(path) < settings.PANDA_IMPORT_PARTITION_MIN_SIZE:
+            return None
+
+        # Which of several rows with the same external id is imported last
+        # must not depend on timing
+        if external_id_field_index is not None:
+            return None
+
+        if not utils.csvdata.is_splittable(upload.encoding, dialect):
+            return None
+
+        chunks, row_count = utils.csvdata.find_chunks(path, dialect, settings.PANDA_IMPORT_PARTITIONS)
+
+        if len(chunks) < 2:
+            return None
+
+        return chunks, row_count
 
     def run(self, dataset_slug, upload_id, external_id_field_index=None, *args, **kwargs):
         """
         Execute import.
         """
         from panda.models import Dataset, DataUpload
-        
+
         log = logging.getLogger(self.name)
         log.info('Beginning import, dataset_slug: %s' % dataset_slug)
 
@@ -49,10 +182,13 @@ class ImportCSVTask(ImportFileTask):
 
         upload = DataUpload.objects.get(id=upload_id)
 
+        # Resume the lock taken when this task was queued, renewing its lease
+        dataset.lock(timeout=settings.PANDA_LOCK_WAIT, lock_id=kwargs.get('lock_id'))
+
         task_status = dataset.current_task
         task_status.begin(ugettext('Preparing to import'))
 
-        line_count = self._count_lines(upload.get_path())
+        chunks = self.get_chunks(upload, external_id_field_index)
 
         if self.is_aborted():
             task_status.abort('Aborted during preperation')
@@ -61,62 +197,64 @@ class ImportCSVTask(ImportFileTask):
 
             return
 
-        f = open(upload.get_path(), 'r')
+        percent_complete = [0]
 
-        reader = CSVKitReader(f, encoding=upload.encoding, **upload.dialect_as_parameters())
-        reader.next()
+        if chunks:
+            chunks, row_count = chunks
+            timestamp = int(time.time() * 1000000)
 
-        add_buffer = []
-        data_typer = DataTyper(dataset.column_schema)
-        throttle = config_value('PERF', 'TASK_THROTTLE')
+            def update(i):
+                dataset.heartbeat()
 
-        i = 0
+                percent = floor(float(i) / float(max(row_count, i, 1)) * 100)
 
-        while True:
-            # The row number which is about to be read, for error handling and indexing
-            i += 1
+                if percent != percent_complete[0]:
+                    percent_complete[0] = percent
+                    task_status.update(ugettext('%.0f%% complete') % percent)
 
-            try:
-                row = reader.next()
-            except StopIteration:
-                i -= 1
-                break
-            except UnicodeDecodeError:
-                raise DataImportError(ugettext('This CSV file contains characters that are not %(encoding)s encoded in or after row %(row)i. You need to re-upload this file and input the correct encoding in order to import data from this file.') % { 'encoding': upload.encoding, 'row': i })
+            partitions = [(dataset_slug, upload_id, start, end, first_row, timestamp) for start, end, first_row in chunks]
+            results = run_partitions(self, task_status, ImportCSVChunkTask, partitions, update)
 
-            external_id = None
+            if results is None:
+                result = None
+            else:
+                data_typer = DataTyper(dataset.column_schema)
+                i = 0
 
-            if external_id_field_index is not None:
-                external_id = row[external_id_field_index]
+                for stats, rows in results:
+                    data_typer.merge(stats)
+                    i += rows
 
-            data = utils.solr.make_data_row(dataset, row, data_upload=upload, external_id=external_id)
-            data = data_typer(data, row)
+                result = (data_typer, i)
+        else:
+            # Progress is estimated from how far into the file the reader is
+            file_size = max(os.path.getsize(upload.get_path()), 1)
 
-            add_buffer.append(data)
+            with open(upload.get_path(), 'r') as f:
+                reader = CSVKitReader(f, encoding=upload.encoding, **upload.dialect_as_parameters())
+                reader.next()
 
-            if i % SOLR_ADD_BUFFER_SIZE == 0:
-                solr.add(settings.SOLR_DATA_CORE, add_buffer)
+                def progress(i):
+                    dataset.heartbeat()
 
-                add_buffer = []
+                    percent_complete[0] = min(floor(float(f.tell()) / float(file_size) * 100), 99)
 
-                task_status.update(ugettext('%.0f%% complete (estimated)') % floor(float(i) / float(line_count) * 100))
+                    task_status.update(ugettext('%.0f%% complete (estimated)') % percent_complete[0])
 
-                if self.is_aborted():
-                    task_status.abort(ugettext('Aborted after importing %.0f%% (estimated)') % floor(float(i) / float(line_count) * 100))
+                    return not self.is_aborted()
 
-                    log.warning('Import aborted, dataset_slug: %s' % dataset_slug)
+                result = import_rows(dataset, upload, reader, progress, external_id_field_index=external_id_field_index)
 
-                    return
+        if result is None:
+            task_status.abort(ugettext('Aborted after importing %.0f%% (estimated)') % percent_complete[0])
 
-                time.sleep(throttle)
+            log.warning('Import aborted, dataset_slug: %s' % dataset_slug)
 
-        if add_buffer:
-            solr.add(settings.SOLR_DATA_CORE, add_buffer)
-            add_buffer = []
+            return
 
-        solr.commit(settings.SOLR_DATA_CORE)
+        data_typer, i = result
 
-        f.close()
+        solr.commit(settings.SOLR_DATA_CORE, settings.SOLR_TASK_COMMIT_POLICY)
 
         task_status.update('100% complete')
 
@@ -143,7 +281,6 @@ class ImportCSVTask(ImportFileTask):
         upload.imported = True
         upload.save()
 
-        log.info('Finished import, dataset_slug: %s' % dataset_slug)
+        log.info('Finished import, dataset_slug: %s, solr connection reuse: %.0f%%' % (dataset_slug, solr.connection_stats()['reuse_rate'] * 100))
 
         return data_typer
-
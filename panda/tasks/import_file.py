@@ -8,6 +8,7 @@ from django.conf import settings
 from django.utils.translation import ugettext
 
 from panda import solr
+from panda.tasks.apply_queued_writes import ApplyQueuedWritesTask
 from panda.utils.notifications import notify
 
 SOLR_ADD_BUFFER_SIZE = 500
@@ -46,11 +47,16 @@ class ImportFileTask(AbortableTask):
             try:
                 self.send_notifications(dataset, retval, einfo)
             finally:
-                # If import failed, clear any data that might be staged
-                if dataset.current_task.status == 'FAILURE':
+                # If import failed, clear any data that might be staged, unless
+                # it failed because someone else had taken the lock
+                if dataset.current_task.status == 'FAILURE' and dataset.lock_id == kwargs.get('lock_id'):
                     solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % args[0], commit=True)
         finally:
-            dataset.unlock()
+            dataset.unlock(lock_id=kwargs.get('lock_id'))
+
+            # Apply any writes made via the API while the dataset was locked
+            if dataset.has_queued_writes():
+                ApplyQueuedWritesTask.apply_async(args=[dataset.slug])
 
     def send_notifications(self, dataset, retval, einfo):
         """
@@ -40,6 +40,9 @@ class ImportXLSXTask(ImportFileTask):
 
         upload = DataUpload.objects.get(id=upload_id)
 
+        # Resume the lock taken when this task was queued, renewing its lease
+        dataset.lock(timeout=settings.PANDA_LOCK_WAIT, lock_id=kwargs.get('lock_id'))
+
         task_status = dataset.current_task
         task_status.begin(ugettext('Preparing to import'))
 
@@ -48,7 +51,9 @@ class ImportXLSXTask(ImportFileTask):
         row_count = sheet.get_highest_row()
         
         add_buffer = []
+        row_buffer = []
         data_typer = DataTyper(dataset.column_schema)
+        category_ids = dataset.get_category_ids()
         throttle = config_value('PERF', 'TASK_THROTTLE')
 
         for i, row in enumerate(sheet.iter_rows()):
@@ -77,16 +82,18 @@ class ImportXLSXTask(ImportFileTask):
             if external_id_field_index is not None:
                 external_id = values[external_id_field_index]
 
-            data = utils.solr.make_data_row(dataset, values, data_upload=upload, external_id=external_id)
-            data = data_typer(data, values)
+            data = utils.solr.make_data_row(dataset, values, data_upload=upload, external_id=external_id, category_ids=category_ids)
 
             add_buffer.append(data)
+            row_buffer.append(values)
 
             if i % SOLR_ADD_BUFFER_SIZE == 0:
-                solr.add(settings.SOLR_DATA_CORE, add_buffer)
+                solr.add(settings.SOLR_DATA_CORE, data_typer.type_batch(add_buffer, row_buffer))
                 add_buffer = []
+                row_buffer = []
 
                 task_status.update(ugettext('%.0f%% complete') % floor(float(i) / float(row_count) * 100))
+                dataset.heartbeat()
 
                 if self.is_aborted():
                     task_status.abort(ugettext('Aborted after importing %.0f%%') % floor(float(i) / float(row_count) * 100))
@@ -98,10 +105,11 @@ class ImportXLSXTask(ImportFileTask):
                 time.sleep(throttle)
 
         if add_buffer:
-            solr.add(settings.SOLR_DATA_CORE, add_buffer)
+            solr.add(settings.SOLR_DATA_CORE, data_typer.type_batch(add_buffer, row_buffer))
             add_buffer = []
+            row_buffer = []
 
-        solr.commit(settings.SOLR_DATA_CORE)
+        solr.commit(settings.SOLR_DATA_CORE, settings.SOLR_TASK_COMMIT_POLICY)
 
         task_status.update(ugettext('100% complete'))
 
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import logging
+import time
+import traceback
+
+from celery.contrib.abortable import AbortableAsyncResult
+from celery.exceptions import TimeoutError
+from django.conf import settings
+from django.utils.timezone import now
+from django.utils.translation import ugettext
+
+from panda.exceptions import PartitionTimeoutError
+from panda.tasks.base import AbortableTask
+
+PARTITION_POLL_INTERVAL = 1 # seconds
+
+def claim_partition(task_id):
+    """
+    Mark a partition as started, unless another process already has.
+
+    Returns ``True`` if the caller won the claim and should process the
+    partition. The update is a single conditional query, so exactly one
+    process can win.
+    """
+    from panda.models import TaskStatus
+
+    return TaskStatus.objects.filter(id=task_id, status='PENDING').update(status='STARTED', start=now()) == 1
+
+class PartitionTask(AbortableTask):
+    """
+    Base type for tasks which process one partition of a larger job
+    started by ``run_partitions``.
+
+    Every partition is queued, but whichever process claims a partition
+    first (an idle worker or the coordinating task itself) processes it.
+    Subclasses implement ``process``.
+    """
+    abstract = True
+    ignore_result = False
+
+    # All subclasses should be within this namespace
+    name = 'panda.tasks.partition'
+
+    def run(self, parent_id, *args, **kwargs):
+        """
+        Execute partition, if it has not already been claimed.
+        """
+        from panda.models import TaskStatus
+
+        if not claim_partition(self.request.id):
+            return None
+
+        task_status = TaskStatus.objects.get(id=self.request.id)
+        parent = AbortableAsyncResult(parent_id)
+
+        def progress(done):
+            self.update_state(state='PROGRESS', meta={ 'done': done })
+
+            return not parent.is_aborted()
+
+        try:
+            result = self.process(progress, *args, **kwargs)
+        except Exception, e:
+            task_status.exception(ugettext('Partition failed'), u'%s\n\nTraceback:\n%s' % (unicode(e), traceback.format_exc()))
+
+            raise
+
+        if result is None:
+            task_status.abort(ugettext('Aborted'))
+        else:
+            task_status.complete(ugettext('Complete'))
+
+        return result
+
+    @classmethod
+    def process(cls, progress, *args, **kwargs):
+        """
+        Process a partition. May be called from a worker or inline by the
+        coordinating task, so must not depend on task state. ``progress``
+        should be called periodically
+        with the number of rows processed so far and processing should stop
+        (returning ``None``) if it returns ``False``.
+
+        Should return a tuple of ``(result, rows)`` on success.
+        """
+        raise NotImplementedError()
+
+def run_partitions(parent, task_status, partition_task, partitions, update):
+    """
+    Queue a ``PartitionTask`` for each set of arguments in ``partitions``
+    and wait for all of them to finish.
+
+    While waiting, ``parent`` (the coordinating task) claims and processes
+    any partitions that no worker has started, so a job always completes
+    even if no other worker is free. ``update`` is called periodically with
+    the total number of rows processed so far.
+
+    Returns a list of the ``(result, rows)`` tuples returned by each
+    partition, in order, or ``None`` if the parent task was aborted.
+
+    If a partition running in a worker reports no progress for
+    ``PANDA_PARTITION_TIMEOUT`` seconds (for instance because the worker
+    died or its result was lost) the other partitions are stopped and
+    ``PartitionTimeoutError`` is raised.
+    """
+    from panda.models import TaskStatus
+
+    log = logging.getLogger(partition_task.name)
+
+    parent_id = parent.request.id
+    count = len(partitions)
+    statuses = []
+
+    for n in range(count):
+        statuses.append(TaskStatus.objects.create(
+            task_name=partition_task.name,
+            task_description=ugettext('%(description)s (partition %(n)i of %(count)i)') \
+                % {'description': task_status.task_description, 'n': n + 1, 'count': count},
+            creator=task_status.creator
+        ))
+
+    async_results = []
+
+    for status, args in zip(statuses, partitions):
+        async_results.append(partition_task.apply_async(
+            args=[parent_id] + list(args),
+            kwargs={},
+            task_id=status.id
+        ))
+
+    results = [None] * count
+    done = [0] * count
+    finished = set()
+    inline = set()
+
+    # When each partition was queued or last reported progress
+    last_progress = [time.time()] * count
+
+    def total_done():
+        return sum(done)
+
+    def check_progress(n):
+        if async_results[n].state == 'PROGRESS':
+            rows = async_results[n].info['done']
+
+            if rows != done[n]:
+                done[n] = rows
+                last_progress[n] = time.time()
+
+                return
+
+        if time.time() - last_progress[n] > settings.PANDA_PARTITION_TIMEOUT:
+            TaskStatus.objects.get(id=statuses[n].id).exception(ugettext('Partition timed out'), None)
+            finished.add(n)
+
+            log.warning('Partition %i timed out, parent: %s' % (n + 1, parent_id))
+
+            raise PartitionTimeoutError(ugettext('Partition %(n)i of %(count)i reported no progress for %(timeout)i seconds.') \
+                % {'n': n + 1, 'count': count, 'timeout': settings.PANDA_PARTITION_TIMEOUT})
+
+    def stop_partitions():
+        # Anything not yet claimed will never run, anything running in a
+        # worker will stop when it next checks the parent
+        AbortableAsyncResult(parent_id).abort()
+
+        for n in range(count):
+            if n in finished or n in inline:
+                continue
+
+            if claim_partition(statuses[n].id):
+                TaskStatus.objects.get(id=statuses[n].id).abort(ugettext('Aborted'))
+            else:
+                try:
+                    async_results[n].get(propagate=False, timeout=settings.PANDA_PARTITION_TIMEOUT)
+                except TimeoutError:
+                    log.warning('Partition %i did not stop, parent: %s' % (n + 1, parent_id))
+
+        log.warning('Partitions stopped, parent: %s' % parent_id)
+
+    try:
+        while len(finished) < count:
+            if parent.is_aborted():
+                stop_partitions()
+
+                return None
+
+            for n in range(count):
+                if n in finished or not claim_partition(statuses[n].id):
+                    continue
+
+                def progress(rows, n=n):
+                    done[n] = rows
+                    update(total_done())
+
+                    return not parent.is_aborted()
+
+                status = TaskStatus.objects.get(id=statuses[n].id)
+                inline.add(n)
+
+                try:
+                    result = partition_task.process(progress, *partitions[n])
+                except Exception, e:
+                    status.exception(ugettext('Partition failed'), u'%s\n\nTraceback:\n%s' % (unicode(e), traceback.format_exc()))
+
+                    raise
+
+                if result is None:
+                    status.abort(ugettext('Aborted'))
+                    stop_partitions()
+
+                    return None
+
+                status.complete(ugettext('Complete'))
+
+                results[n] = result
+                done[n] = result[1]
+                finished.add(n)
+
+                # Other partitions weren't watched while this one was processed
+                last_progress[:] = [time.time()] * count
+
+            for n in range(count):
+                if n in finished or n in inline:
+                    continue
+
+                if not async_results[n].ready():
+                    check_progress(n)
+
+                    continue
+
+                result = async_results[n].get()
+
+                # Partition noticed the abort before this process did
+                if result is None:
+                    stop_partitions()
+
+                    return None
+
+                results[n] = result
+                done[n] = result[1]
+                finished.add(n)
+
+            update(total_done())
+
+            if len(finished) < count:
+                time.sleep(PARTITION_POLL_INTERVAL)
+    except:
+        stop_partitions()
+
+        raise
+
+    return results
@@ -5,7 +5,7 @@ import logging
 from django.conf import settings
 from panda.tasks.base import Task
 
-from panda import solr
+from panda import solr, utils
 
 class PurgeDataTask(Task):
     """
@@ -24,15 +24,20 @@ class PurgeDataTask(Task):
         else:
             q = 'dataset_slug:%s' % dataset_slug
 
+        deleted = solr.count(settings.SOLR_DATA_CORE, q)
+
         solr.delete(settings.SOLR_DATA_CORE, q)
 
+        utils.cache.invalidate_dataset(dataset_slug)
+
         try:
             # If the dataset hasn't been deleted, update its row count
             dataset = Dataset.objects.get(slug=dataset_slug)
-            dataset.row_count = dataset._count_rows()
+            dataset.row_count = max((dataset.row_count or 0) - deleted, 0)
             dataset.save()
         except Dataset.DoesNotExist:
-            pass
+            # Its categories are gone, so any cached search may include its rows
+            utils.cache.invalidate(utils.cache.SEARCH)
 
         log.info('Finished purge, dataset_slug: %s' % dataset_slug)
 
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import logging
+
+from panda.tasks.base import Task
+from django.conf import settings
+
+from panda import solr, utils
+
+class ReconcileRowCountsTask(Task):
+    """
+    Correct dataset row counts which have drifted from the number of rows in Solr.
+
+    Row counts are updated incrementally as rows are written, which can
+    miss overwrites of rows that had not yet been committed.
+    """
+    name = 'panda.tasks.cron.reconcile_row_counts'
+
+    def run(self, *args, **kwargs):
+        from panda.models import Dataset
+
+        log = logging.getLogger(self.name)
+        log.info('Reconciling row counts')
+
+        # Make sure every write so far is counted
+        solr.commit(settings.SOLR_DATA_CORE)
+
+        for dataset in Dataset.objects.filter(locked=False):
+            row_count = dataset._count_rows()
+
+            if row_count == (dataset.row_count or 0):
+                continue
+
+            # Only update if nothing has locked or changed the dataset since it was read
+            updated = Dataset.objects.filter(id=dataset.id, locked=False, row_count=dataset.row_count).update(row_count=row_count)
+
+            if updated:
+                # Updated without saving, so no signal is sent
+                utils.cache.invalidate(utils.cache.DATASETS)
+
+                log.warning('Corrected row count, dataset_slug: %s, was: %s, now: %i' % (dataset.slug, dataset.row_count, row_count))
+
+        log.info('Finished reconciling row counts')
@@ -7,16 +7,113 @@ import traceback
 
 from panda.tasks.base import AbortableTask
 from django.conf import settings
-from django.utils import simplejson as json
 from django.utils.translation import ugettext
 from livesettings import config_value
 
 from panda import solr, utils
+from panda.tasks.apply_queued_writes import ApplyQueuedWritesTask
+from panda.tasks.partitioned import PartitionTask, run_partitions
 from panda.utils.notifications import notify
 from panda.utils.typecoercion import DataTyper 
 
-SOLR_READ_BUFFER_SIZE = 500
-SOLR_ADD_BUFFER_SIZE = 500
+SOLR_BUFFER_SIZE = 500
+
+def get_partitions(dataset, partitions):
+    """
+    Split a dataset into (roughly) equal ranges of ids, one per partition.
+
+    Returns a list of ``(dataset_slug, after, until, by_id)`` tuples. Small
+    datasets are not split, nor are datasets whose ids don't follow the order
+    rows were added, which are read in the order they were indexed instead.
+    """
+    if not dataset.has_row_ids():
+        return [(dataset.slug, None, None, False)]
+
+    row_count = dataset.row_count or 0
+    partitions = min(partitions, row_count / settings.PANDA_REINDEX_PARTITION_MIN_ROWS)
+
+    bounds = []
+    after = None
+
+    for n in range(1, partitions):
+        response = solr.query(
+            settings.SOLR_DATA_CORE,
+            '*:*',
+            offset=row_count * n / partitions,
+            limit=1,
+            sort='id asc',
+            fields=['id'],
+            filters=utils.solr.make_filters([dataset.slug])
+        )
+
+        docs = response['response']['docs']
+
+        if not docs:
+            break
+
+        bounds.append((dataset.slug, after, docs[0]['id'], True))
+        after = docs[0]['id']
+
+    bounds.append((dataset.slug, after, None, True))
+
+    return bounds
+
+class ReindexPartitionTask(PartitionTask):
+    """
+    Task to reindex one range of ids within a dataset.
+    """
+    name = 'panda.tasks.partition.reindex'
+
+    @classmethod
+    def process(cls, progress, dataset_slug, after, until, by_id=True):
+        """
+        Retype and re-add every row in the partition.
+        """
+        from panda.models import Dataset
+
+        dataset = Dataset.objects.get(slug=dataset_slug)
+
+        data_typer = DataTyper(dataset.column_schema)
+        throttle = config_value('PERF', 'TASK_THROTTLE')
+
+        i = 0
+
+        # Each page of documents is decoded, typed and added as one batch
+        pages = utils.solr.iter_data(
+            settings.SOLR_DATA_CORE,
+            '*:*',
+            fields=['id', 'data_upload_id', 'external_id'],
+            page_size=SOLR_BUFFER_SIZE,
+            after=after,
+            until=until,
+            filters=utils.solr.make_filters([dataset_slug]),
+            by_id=by_id
+        )
+
+        encoder = utils.solr.DataBatchEncoder(dataset, data_typer)
+
+        for docs, rows in pages:
+            # Solr can only replace whole documents, but the stored data
+            # doesn't need to be encoded again
+            body = encoder.encode(
+                rows,
+                external_ids=[d.get('external_id', None) for d in docs],
+                row_ids=[d['id'] for d in docs],
+                encoded_data=[d['data'] for d in docs],
+                data_upload_ids=[d.get('data_upload_id', None) for d in docs]
+            )
+
+            solr.add(settings.SOLR_DATA_CORE, body)
+
+            i += len(docs)
+
+            if not progress(i):
+                return None
+        
+            time.sleep(throttle)
+
+        # Results are pickled, so only plain data is returned
+        return data_typer.get_stats(), i
 
 class ReindexTask(AbortableTask):
     """
@@ -24,9 +121,12 @@ class ReindexTask(AbortableTask):
     """
     name = 'panda.tasks.reindex'
 
-    def run(self, dataset_slug, *args, **kwargs):
+    def run(self, dataset_slug, changed_columns=None, *args, **kwargs):
         """
         Execute reindex.
+
+        If ``changed_columns`` is an empty list then no typed fields would
+        change and the data is not touched.
         """
         from panda.models import Dataset
         
@@ -40,6 +140,9 @@ class ReindexTask(AbortableTask):
 
             return
 
+        # Resume the lock taken when this task was queued, renewing its lease
+        dataset.lock(timeout=settings.PANDA_LOCK_WAIT, lock_id=kwargs.get('lock_id'))
+
         task_status = dataset.current_task
         task_status.begin(ugettext('Preparing to reindex'))
 
@@ -50,52 +153,42 @@ class ReindexTask(AbortableTask):
 
             return
 
-        read_buffer = []
-        add_buffer = []
-        data_typer = DataTyper(dataset.column_schema)
-        throttle = config_value('PERF', 'TASK_THROTTLE')
+        if changed_columns == []:
+            task_status.update(ugettext('100% complete'))
 
-        i = 0
+            Dataset.objects.filter(slug=dataset_slug).update(column_schema_indexed=True)
 
-        while i < dataset.row_count:
-            if not read_buffer:
-                query = 'dataset_slug: %s' % (dataset.slug)
-                response = solr.query(settings.SOLR_DATA_CORE, query, limit=SOLR_READ_BUFFER_SIZE, offset=i)
-                read_buffer = response['response']['docs']
+            log.info('Finished reindex, no column filters changed, dataset_slug: %s' % dataset_slug)
 
-            data = read_buffer.pop(0)
-            row = json.loads(data['data'])
+            return DataTyper(dataset.column_schema)
 
-            new_data = utils.solr.make_data_row(dataset, row)
-            new_data['id'] = data['id'] 
-            new_data['data_upload_id'] = data['data_upload_id']
-            new_data = data_typer(new_data, row)
+        partitions = get_partitions(dataset, settings.PANDA_REINDEX_PARTITIONS)
+        percent_complete = [0]
 
-            add_buffer.append(new_data)
+        def update(i):
+            dataset.heartbeat()
 
-            if i % SOLR_ADD_BUFFER_SIZE == 0:
-                solr.add(settings.SOLR_DATA_CORE, add_buffer)
+            percent = floor(float(i) / float(max(dataset.row_count, i, 1)) * 100)
 
-                add_buffer = []
+            if percent != percent_complete[0]:
+                percent_complete[0] = percent
+                task_status.update(ugettext('%.0f%% complete') % percent)
 
-                task_status.update(ugettext('%.0f%% complete') % floor(float(i) / float(dataset.row_count) * 100))
+        results = run_partitions(self, task_status, ReindexPartitionTask, partitions, update)
 
-                if self.is_aborted():
-                    task_status.abort(ugettext('Aborted after reindexing %.0f%%') % floor(float(i) / float(dataset.row_count) * 100))
+        if results is None:
+            task_status.abort(ugettext('Aborted after reindexing %.0f%%') % percent_complete[0])
 
-                    log.warning('Reindex aborted, dataset_slug: %s' % dataset_slug)
+            log.warning('Reindex aborted, dataset_slug: %s' % dataset_slug)
 
-                    return
-            
-                time.sleep(throttle)
+            return
 
-            i += 1
+        data_typer = DataTyper(dataset.column_schema)
 
-        if add_buffer:
-            solr.add(settings.SOLR_DATA_CORE, add_buffer)
-            add_buffer = []
+        for stats, rows in results:
+            data_typer.merge(stats)
 
-        solr.commit(settings.SOLR_DATA_CORE)
+        solr.commit(settings.SOLR_DATA_CORE, settings.SOLR_TASK_COMMIT_POLICY)
 
         task_status.update(ugettext('100% complete'))
 
@@ -108,6 +201,7 @@ class ReindexTask(AbortableTask):
             return
 
         dataset.column_schema = data_typer.schema 
+        dataset.column_schema_indexed = True
         dataset.save()
 
         log.info('Finished reindex, dataset_slug: %s' % dataset_slug)
@@ -133,11 +227,16 @@ class ReindexTask(AbortableTask):
             try:
                 self.send_notifications(dataset, retval, einfo)
             finally:
-                # If reindex failed, clear any data that might be staged
-                if dataset.current_task.status == 'FAILURE':
+                # If reindex failed, clear any data that might be staged, unless
+                # it failed because someone else had taken the lock
+                if dataset.current_task.status == 'FAILURE' and dataset.lock_id == kwargs.get('lock_id'):
                     solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % args[0], commit=True)
         finally:
-            dataset.unlock()
+            dataset.unlock(lock_id=kwargs.get('lock_id'))
+
+            # Apply any writes made via the API while the dataset was locked
+            if dataset.has_queued_writes():
+                ApplyQueuedWritesTask.apply_async(args=[dataset.slug])
 
     def send_notifications(self, dataset, retval, einfo):
         """
@@ -6,7 +6,7 @@ from panda.tasks.base import Task
 from django.conf import settings
 from django.utils.timezone import now 
 
-from panda import solr
+from panda import solr, utils
 from panda.utils.notifications import notify
 
 class RunSubscriptionsTask(Task):
@@ -32,22 +32,14 @@ class RunSubscriptionsTask(Task):
             sub.last_run = now()
             sub.save()
    
-            solr_query = 'last_modified:[%s TO *] AND (%s)' % (since + 'Z', sub.query)
-
             if sub.dataset:
-                solr_query += ' dataset_slug:%s' % (sub.dataset.slug)
+                filters = utils.solr.make_filters([sub.dataset.slug], since)
             elif sub.category:
-                dataset_slugs = sub.category.datasets.values_list('slug', flat=True)
-                solr_query += ' dataset_slug:(%s)' % ' '.join(dataset_slugs)
-
-            response = solr.query(
-                settings.SOLR_DATA_CORE,
-                solr_query,
-                offset=0,
-                limit=0
-            )
+                filters = utils.solr.make_filters(since=since, category_id=sub.category.id)
+            else:
+                filters = utils.solr.make_filters(since=since)
 
-            count = response['response']['numFound'] 
+            count = solr.count(settings.SOLR_DATA_CORE, utils.solr.make_search_query(sub.query), filters)
 
             log.info('Found %i new results' % count)
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import logging
+import time
+import traceback
+
+from panda.tasks.base import Task
+from django.conf import settings
+from django.utils.translation import ugettext
+from livesettings import config_value
+
+from panda import solr, utils
+from panda.exceptions import DatasetLockedError
+from panda.tasks.apply_queued_writes import ApplyQueuedWritesTask
+from panda.utils.typecoercion import DataTyper
+
+SOLR_BUFFER_SIZE = 500
+
+# Given to rows indexed before modification times were stored, so that
+# search subscriptions don't report them as new
+LEGACY_LAST_MODIFIED = '1970-01-01T00:00:00Z'
+
+class UpdateDataCategoriesTask(Task):
+    """
+    Task to bring the categories indexed on a dataset's data up to date
+    after the dataset's categories change.
+
+    Only rows whose categories differ are rewritten, so a task which is
+    interrupted (or repeated) picks up where it left off. Rows keep their
+    modification times.
+
+    The task is tracked by ``Dataset.categories_task``, so the status of the
+    dataset's last import or reindex is left in ``current_task``.
+    """
+    name = 'panda.tasks.update_data_categories'
+
+    # Retried for as long as the dataset is locked
+    max_retries = None
+    default_retry_delay = settings.PANDA_CATEGORIES_UPDATE_RETRY
+
+    def run(self, dataset_slug, *args, **kwargs):
+        from panda.models import Dataset, TaskStatus
+
+        log = logging.getLogger(self.name)
+
+        # Changes made from now on need another update
+        utils.cache.release('data_categories:%s' % dataset_slug)
+
+        try:
+            dataset = Dataset.objects.get(slug=dataset_slug)
+        except Dataset.DoesNotExist:
+            log.warning('Updating categories failed due to Dataset being deleted, dataset_slug: %s' % dataset_slug)
+
+            return
+
+        # Nothing to update until data has been imported
+        if not dataset.row_count and not dataset.locked:
+            return
+
+        try:
+            dataset.lock()
+        except DatasetLockedError:
+            # Any import or reindex that is running may be adding rows with the old categories
+            log.info('Dataset locked, retrying category update, dataset_slug: %s' % dataset_slug)
+
+            self.retry(args=[dataset_slug], kwargs=kwargs)
+
+        try:
+            # Make sure every write so far can be seen
+            solr.commit(settings.SOLR_DATA_CORE)
+
+            category_ids = dataset.get_category_ids()
+            q = utils.solr.make_categories_mismatch_query(category_ids)
+            filters = utils.solr.make_filters([dataset_slug])
+
+            count = solr.count(settings.SOLR_DATA_CORE, q, filters)
+
+            if not count:
+                log.info('Categories already up to date, dataset_slug: %s' % dataset_slug)
+
+                return
+
+            log.info('Updating categories of %i rows, dataset_slug: %s' % (count, dataset_slug))
+
+            # Writes made while the rows are being rewritten are queued
+            task_status = TaskStatus.objects.create(
+                task_name=self.name,
+                task_description=ugettext('Update categories of %s.') % dataset_slug
+            )
+            task_status.begin(ugettext('Updating categories'))
+
+            Dataset.objects.filter(pk=dataset.pk).update(categories_task=task_status)
+
+            try:
+                self.update_rows(dataset, q, filters)
+
+                # Rows left categories which are no longer known
+                utils.cache.invalidate(utils.cache.SEARCH)
+            except Exception, e:
+                task_status.exception(ugettext('Updating categories failed'), u'%s\n\nTraceback:\n%s' % (unicode(e), traceback.format_exc()))
+
+                raise
+
+            task_status.complete(ugettext('Categories updated'))
+
+            log.info('Finished updating categories, dataset_slug: %s' % dataset_slug)
+        finally:
+            dataset.unlock()
+
+            # Apply any writes made via the API while the dataset was locked
+            if dataset.has_queued_writes():
+                ApplyQueuedWritesTask.apply_async(args=[dataset.slug])
+
+    def update_rows(self, dataset, q, filters):
+        """
+        Rewrite every row matching ``q`` with the dataset's current categories.
+        """
+        throttle = config_value('PERF', 'TASK_THROTTLE')
+
+        # Typed columns aren't stored, so rows must be retyped to be rewritten
+        encoder = utils.solr.DataBatchEncoder(dataset, DataTyper(dataset.column_schema))
+
+        # Rows without ordered ids are rewritten in the order they were indexed, to keep it
+        by_id = dataset.has_row_ids()
+
+        while True:
+            pages = utils.solr.iter_data(
+                settings.SOLR_DATA_CORE,
+                q,
+                fields=['id', 'data_upload_id', 'external_id', 'last_modified'],
+                page_size=SOLR_BUFFER_SIZE,
+                filters=filters,
+                by_id=by_id
+            )
+
+            for docs, rows in pages:
+                body = encoder.encode(
+                    rows,
+                    external_ids=[d.get('external_id', None) for d in docs],
+                    row_ids=[d['id'] for d in docs],
+                    encoded_data=[d['data'] for d in docs],
+                    data_upload_ids=[d.get('data_upload_id', None) for d in docs],
+                    last_modified=[d.get('last_modified', None) or LEGACY_LAST_MODIFIED for d in docs]
+                )
+
+                solr.add(settings.SOLR_DATA_CORE, body)
+
+                dataset.heartbeat()
+
+                time.sleep(throttle)
+
+            if by_id:
+                break
+
+            # Rewritten rows leave the query if anything commits while rows are read
+            # by offset, and the rows after them are skipped, so look again
+            solr.commit(settings.SOLR_DATA_CORE)
+
+            if not solr.count(settings.SOLR_DATA_CORE, q, filters):
+                break
+
+        solr.commit(settings.SOLR_DATA_CORE, settings.SOLR_TASK_COMMIT_POLICY)
@@ -81,4 +81,15 @@ class TestAPICategories(TransactionTestCase):
         uncategorized = next(c for c in body['objects'] if c['slug'] == 'uncategorized')
 
         self.assertEqual(uncategorized['dataset_count'], 0)
-        
+
+    def test_list_invalidated_by_save(self):
+        category = Category.objects.get(slug='crime')
+
+        response = self.client.get('/api/1.0/category/', **self.auth_headers)
+        self.assertIn('Crime', [c['name'] for c in json.loads(response.content)['objects']])
+
+        category.name = 'Police'
+        category.save()
+
+        response = self.client.get('/api/1.0/category/', **self.auth_headers)
+        self.assertIn('Police', [c['name'] for c in json.loads(response.content)['objects']])
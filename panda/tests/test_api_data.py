@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
+from datetime import timedelta
 from time import sleep
 
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.test import TransactionTestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.utils import simplejson as json
 from django.utils.timezone import now
 from tastypie.bundle import Bundle
@@ -12,8 +14,11 @@ from tastypie.exceptions import BadRequest
 
 from panda import solr
 from panda.api.data import DataResource, DataValidation
-from panda.models import Category, Dataset
+from panda.api.utils import PandaAuthentication
+from panda.models import Category, Dataset, QueuedWrite, TaskStatus
+from panda.tasks import ApplyQueuedWritesTask
 from panda.tests import utils
+from panda.utils.cache import search_stats
 
 class TestDataValidation(TransactionTestCase):
     fixtures = ['init_panda.json', 'test_users.json']
@@ -157,6 +162,60 @@ class TestAPIData(TransactionTestCase):
 
         self.assertEqual(self.dataset.row_count, 5)
 
+    def test_create_queued(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        # Simulate a long running task
+        task = TaskStatus.objects.create(task_name='panda.tasks.reindex', task_description='Reindex', creator=self.user)
+        Dataset.objects.filter(id=self.dataset.id).update(locked=True, locked_at=now(), current_task=task)
+
+        new_data = {
+            'data': ['5', 'A', 'B', 'C']
+        }
+
+        response = self.client.post('/api/1.0/dataset/%s/data/' % self.dataset.slug, content_type='application/json', data=json.dumps(new_data), **self.auth_headers)
+
+        self.assertEqual(response.status_code, 202)
+        body = json.loads(response.content)
+        self.assertEqual(body['status'], 'PENDING')
+        self.assertIn('resource_uri', body)
+
+        response = self.client.get('/api/1.0/queued_write/?dataset=%i' % self.dataset.id, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['objects']), 1)
+
+        # Later writes are queued behind earlier ones
+        self.assertEqual(self.client.delete('/api/1.0/dataset/%s/data/1/' % self.dataset.slug, **self.auth_headers).status_code, 202)
+
+        task.complete('Complete')
+        Dataset.objects.get(id=self.dataset.id).unlock()
+
+        ApplyQueuedWritesTask.apply_async(args=[self.dataset.slug])
+
+        # Refresh
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(self.dataset.row_count, 4)
+        self.assertEqual(self.dataset.get_row('1'), None)
+        self.assertEqual([w.status for w in QueuedWrite.objects.all()], ['APPLIED', 'APPLIED'])
+
+    def test_create_lock_expired(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        # Simulate a task which died holding the lock
+        task = TaskStatus.objects.create(task_name='panda.tasks.reindex', task_description='Reindex', creator=self.user)
+        Dataset.objects.filter(id=self.dataset.id).update(locked=True, locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1), current_task=task)
+
+        new_data = {
+            'data': ['5', 'A', 'B', 'C']
+        }
+
+        response = self.client.post('/api/1.0/dataset/%s/data/' % self.dataset.slug, content_type='application/json', data=json.dumps(new_data), **self.auth_headers)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(QueuedWrite.objects.count(), 0)
+
     def test_create_bulk(self):
         self.dataset.import_data(self.user, self.upload, 0)
 
@@ -180,6 +239,78 @@ class TestAPIData(TransactionTestCase):
 
         self.assertEqual(self.dataset.row_count, 6)
 
+    def test_ingest_ndjson(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        body = '\n'.join([
+            json.dumps({ 'data': ['5', 'A', 'B', 'C'], 'external_id': '5' }),
+            json.dumps(['6', 'D', 'E', 'F']),
+            '',
+            json.dumps(['7', 'G']),
+            'not json'
+        ])
+
+        response = self.client.put('/api/1.0/dataset/%s/ingest/' % self.dataset.slug, content_type='application/x-ndjson', data=body, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body['added'], 2)
+        self.assertEqual(body['updated'], 0)
+        self.assertEqual(body['failed'], 2)
+        self.assertEqual([e['row'] for e in body['errors']], [3, 4])
+
+        # Refresh
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(self.dataset.row_count, 6)
+        self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'external_id:5')['response']['numFound'], 1)
+
+    def test_ingest_csv(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        body = 'id,first_name,last_name,employer\r\n5,A,B,C\r\n6,D,E,F\r\n5,G,H,I\r\n'
+
+        response = self.client.put('/api/1.0/dataset/%s/ingest/?external_id_field_index=0' % self.dataset.slug, content_type='text/csv', data=body, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body['added'], 2)
+        self.assertEqual(body['updated'], 1)
+        self.assertEqual(body['failed'], 0)
+
+        # Refresh
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(self.dataset.row_count, 6)
+
+        response = solr.query(settings.SOLR_DATA_CORE, 'external_id:5')
+        self.assertEqual(response['response']['numFound'], 1)
+        self.assertEqual(json.loads(response['response']['docs'][0]['data']), ['5', 'G', 'H', 'I'])
+
+    def test_ingest_post_body_not_read_by_authentication(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        body = json.dumps(['5', 'A', 'B', 'C'])
+
+        request = RequestFactory().post('/api/1.0/dataset/%s/ingest/' % self.dataset.slug, content_type='application/x-ndjson', data=body, **self.auth_headers)
+        request.user = AnonymousUser()
+
+        self.assertEqual(PandaAuthentication().is_authenticated(request), True)
+
+        # The body must still be unread when streaming begins
+        self.assertEqual(request._read_started, False)
+
+        response = DataResource().ingest_data(request, dataset_slug=self.dataset.slug)
+
+        self.assertEqual(json.loads(response.content)['added'], 1)
+
+    def test_ingest_unsupported_content_type(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        response = self.client.put('/api/1.0/dataset/%s/ingest/' % self.dataset.slug, content_type='application/json', data='[]', **self.auth_headers)
+
+        self.assertEqual(response.status_code, 400)
+
     def test_create_no_columns(self):
         new_data = {
             'data': ['5', 'A', 'B', 'C']
@@ -409,6 +540,78 @@ class TestAPIData(TransactionTestCase):
             self.assertIn('resource_uri', result_dataset['objects'][0])
             self.assertIn('external_id', result_dataset['objects'][0])
 
+    def test_search_cached(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        url = '/api/1.0/dataset/%s/data/?q=Christopher' % self.dataset.slug
+
+        # Allow results to be cached immediately after a write
+        with self.settings(SOLR_COMMIT_WITHIN=0, SOLR_COMMIT_INTERVAL=0):
+            sleep(0.01)
+
+            stats = search_stats()
+
+            response = self.client.get(url, **self.auth_headers)
+            self.assertEqual(json.loads(response.content)['meta']['total_count'], 1)
+
+            # Writes which bypass the dataset are not seen
+            solr.add(settings.SOLR_DATA_CORE, [{ 'id': 'uncounted', 'dataset_slug': self.dataset.slug, 'full_text': 'Christopher', 'data': '[]' }], commit=True)
+
+            response = self.client.get(url, **self.auth_headers)
+            self.assertEqual(json.loads(response.content)['meta']['total_count'], 1)
+
+            self.assertEqual(search_stats()['hits'], stats['hits'] + 1)
+            self.assertEqual(search_stats()['misses'], stats['misses'] + 1)
+
+            # Saving the dataset invalidates its searches
+            self.dataset.save()
+
+            response = self.client.get(url, **self.auth_headers)
+            self.assertEqual(json.loads(response.content)['meta']['total_count'], 2)
+
+    def test_search_all_cached(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        url = '/api/1.0/data/?q=Christopher'
+
+        with self.settings(SOLR_COMMIT_WITHIN=0, SOLR_COMMIT_INTERVAL=0):
+            sleep(0.01)
+
+            stats = search_stats()
+
+            self.client.get(url, **self.auth_headers)
+            self.client.get(url, **self.auth_headers)
+
+            self.assertEqual(search_stats()['hits'], stats['hits'] + 1)
+
+            # Any dataset changing invalidates searches of every dataset
+            second_dataset = Dataset.objects.create(
+                name='Second dataset',
+                creator=self.dataset.creator)
+
+            second_dataset.import_data(self.user, self.upload, 0)
+
+            response = self.client.get(url, **self.auth_headers)
+            self.assertEqual(json.loads(response.content)['meta']['total_count'], 2)
+
+    def test_search_json_matches_dehydrated(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+        self.dataset.add_row(self.user, ['5', 'Christopher', 'Groskopf', 'PANDA', '', ''], external_id='christopher')
+
+        request = RequestFactory().get('/api/1.0/dataset/%s/data/' % self.dataset.slug, data={ 'q': 'Christopher' })
+        request.user = self.user
+
+        resource = DataResource()
+
+        dehydrated = resource.search_dataset_data(request, dataset_slug=self.dataset.slug)
+        spliced = resource.search_dataset_data(request, as_json=True, dataset_slug=self.dataset.slug)
+
+        body = json.loads(spliced)
+
+        self.assertEqual(body, json.loads(resource._meta.serializer.to_json(dehydrated)))
+        self.assertEqual(body['meta']['total_count'], 2)
+        self.assertEqual(sorted(obj['external_id'] for obj in body['objects']), [None, 'christopher'])
+
     def test_search_category(self):
         category = Category.objects.get(slug='politics')
 
@@ -446,6 +649,67 @@ class TestAPIData(TransactionTestCase):
         self.assertIn('resource_uri', result_dataset['objects'][0])
         self.assertIn('external_id', result_dataset['objects'][0])
 
+    def test_search_category_changed(self):
+        category = Category.objects.get(slug='politics')
+
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        def last_modified():
+            docs = solr.query(settings.SOLR_DATA_CORE, '*:*', sort='id asc', fields=['last_modified'])['response']['docs']
+
+            return [d['last_modified'] for d in docs]
+
+        def search(category_slug):
+            response = self.client.get('/api/1.0/data/?q=Christopher&category=%s' % category_slug, **self.auth_headers)
+
+            return json.loads(response.content)['meta']['total_count']
+
+        imported = last_modified()
+
+        self.assertEqual(search('politics'), 0)
+        self.assertEqual(search('uncategorized'), 1)
+
+        # Rows are updated when the dataset's categories change
+        category.datasets.add(self.dataset)
+
+        self.assertEqual(search('politics'), 1)
+        self.assertEqual(search('uncategorized'), 0)
+
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+        self.dataset.categories.clear()
+
+        self.assertEqual(search('politics'), 0)
+        self.assertEqual(search('uncategorized'), 1)
+
+        # Rewritten rows keep their modification times
+        self.assertEqual(last_modified(), imported)
+
+        # The import's status isn't replaced by the categories update
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(self.dataset.current_task.task_name, 'panda.tasks.import.csv')
+        self.assertEqual(self.dataset.categories_task.status, 'SUCCESS')
+
+    def test_search_category_changed_legacy_rows(self):
+        category = Category.objects.get(slug='politics')
+
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        # Rows indexed before 1.1.2 have no categories or modification time
+        solr.add(settings.SOLR_DATA_CORE, [{
+            'id': 'legacy',
+            'dataset_slug': self.dataset.slug,
+            'full_text': 'Legacy',
+            'data': json.dumps(['5', 'Legacy', 'Row', 'PANDA'])
+        }], commit=True)
+
+        category.datasets.add(self.dataset)
+
+        docs = solr.query(settings.SOLR_DATA_CORE, 'id:legacy', fields=['categories', 'last_modified'])['response']['docs']
+
+        self.assertEqual(docs[0]['categories'], [category.id])
+        self.assertEqual(docs[0]['last_modified'], '1970-01-01T00:00:00Z')
+
     def test_search_since(self):
         self.dataset.import_data(self.user, self.upload, 0)
 
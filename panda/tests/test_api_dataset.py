@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 
+import os
+from StringIO import StringIO
 from time import sleep
 
+from csvkit import CSVKitReader
 from django.conf import settings
 from django.test import TestCase, TransactionTestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.utils import simplejson as json
 from django.utils.timezone import now
 from tastypie.bundle import Bundle
 
 from panda import solr
-from panda.api.datasets import DatasetValidation
+from panda.api.datasets import DatasetResource, DatasetValidation
 from panda.models import Category, Dataset
 from panda.tests import utils
 
@@ -101,6 +104,50 @@ class TestAPIDataset(TransactionTestCase):
         self.assertEqual(body['meta']['next'], None)
         self.assertEqual(body['meta']['previous'], None)
 
+    def test_list_cached(self):
+        response = self.client.get('/api/1.0/dataset/', **self.auth_headers)
+        self.assertEqual(json.loads(response.content)['objects'][0]['name'], self.dataset.name)
+
+        # Updates which bypass signals are not seen
+        Dataset.objects.filter(id=self.dataset.id).update(name='Cached')
+
+        response = self.client.get('/api/1.0/dataset/', **self.auth_headers)
+        self.assertEqual(json.loads(response.content)['objects'][0]['name'], self.dataset.name)
+
+        # Saving invalidates the cache
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+        self.dataset.save()
+
+        response = self.client.get('/api/1.0/dataset/', **self.auth_headers)
+        self.assertEqual(json.loads(response.content)['objects'][0]['name'], 'Cached')
+
+    def test_list_query_count(self):
+        category = Category.objects.get(slug='crime')
+
+        # Ensure distinct creation dates
+        sleep(1)
+        second_dataset = utils.get_test_dataset(self.user)
+
+        for dataset in [self.dataset, second_dataset]:
+            dataset.categories.add(category)
+            utils.get_test_data_upload(self.user, dataset)
+            utils.get_test_related_upload(self.user, dataset)
+
+        request = RequestFactory().get('/api/1.0/dataset/')
+        resource = DatasetResource()
+
+        # One query for the datasets and one for each related set of objects,
+        # however many datasets are on the page
+        with self.assertNumQueries(6):
+            page = resource.get_list_page(request)
+
+        self.assertEqual(page['meta']['total_count'], 2)
+        self.assertEqual(len(page['objects'][0]['data_uploads']), 1)
+        self.assertEqual(len(page['objects'][1]['related_uploads']), 1)
+
+        # Solr's ordering (newest first) is preserved
+        self.assertEqual([d['slug'] for d in page['objects']], [second_dataset.slug, self.dataset.slug])
+
     def test_list_filtered_by_category_miss(self):
         response = self.client.get('/api/1.0/dataset/', data={ 'category': 'crime' }, **self.auth_headers)
 
@@ -443,6 +490,43 @@ class TestAPIDataset(TransactionTestCase):
         self.assertNotEqual(task.end, None)
         self.assertEqual(task.traceback, None)
 
+    def test_download_data(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        response = self.client.get('/api/1.0/dataset/%s/download/' % self.dataset.slug, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        with open(os.path.join(utils.TEST_DATA_PATH, utils.TEST_DATA_FILENAME), 'r') as f:
+            expected = list(CSVKitReader(f))
+
+        self.assertEqual(list(CSVKitReader(StringIO(response.content))), expected)
+
+        # No task is created
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+        self.assertEqual(self.dataset.current_task.task_name, 'panda.tasks.import.csv')
+
+    def test_download_data_search(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        response = self.client.get('/api/1.0/dataset/%s/download/?q=Pitts' % self.dataset.slug, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        rows = list(CSVKitReader(StringIO(response.content)))
+
+        self.assertEqual(rows[0], ['id', 'first_name', 'last_name', 'employer'])
+        self.assertEqual(len(rows), 2)
+
+    def test_download_data_too_large(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        with self.settings(PANDA_STREAM_EXPORT_MAX_ROWS=2):
+            response = self.client.get('/api/1.0/dataset/%s/download/' % self.dataset.slug, **self.auth_headers)
+
+        self.assertEqual(response.status_code, 400)
+
     def test_get_datum(self):
         self.dataset.import_data(self.user, self.upload, 0)
 
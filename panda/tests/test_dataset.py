@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 
+from datetime import timedelta
 import os.path
+import pickle
+import time
+from uuid import uuid4
 
+from celery.contrib.abortable import AbortableAsyncResult
 from django.conf import settings
 from django.test import TransactionTestCase
 from django.utils import simplejson as json
+from django.utils.timezone import now
 
 from panda import solr
-from panda.exceptions import DatasetLockedError, DataImportError, DataSamplingError
+from panda.exceptions import DatasetLockedError, DataImportError, DataSamplingError, PartitionTimeoutError
 from panda.models import Dataset, DataUpload, RelatedUpload, TaskStatus
+from panda.tasks import ImportCSVChunkTask, ReconcileRowCountsTask, ReindexPartitionTask
+from panda.tasks.partitioned import claim_partition, run_partitions
 from panda.tests import utils
+from panda.utils.cache import DATASETS, get_generation
 from panda.utils.column_schema import update_indexed_names
 
 class TestDataset(TransactionTestCase):
@@ -32,6 +41,70 @@ class TestDataset(TransactionTestCase):
         self.dataset.lock()
         self.assertRaises(DatasetLockedError, self.dataset.lock)
 
+    def test_lock_wait(self):
+        self.dataset.lock()
+
+        start = time.time()
+
+        self.assertRaises(DatasetLockedError, self.dataset.lock, timeout=0.5)
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+    def test_lock_expired(self):
+        self.dataset.lock()
+
+        Dataset.objects.filter(id=self.dataset.id).update(locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1))
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.lock()
+
+        self.assertEqual(dataset.locked, True)
+
+    def test_heartbeat(self):
+        self.dataset.lock()
+
+        Dataset.objects.filter(id=self.dataset.id).update(locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1))
+
+        self.dataset._heartbeat_at = 0
+        self.dataset.heartbeat()
+
+        self.assertRaises(DatasetLockedError, Dataset.objects.get(id=self.dataset.id).lock)
+
+    def test_lock_resumed(self):
+        self.dataset.lock()
+
+        # Queued until after the lease ran out
+        Dataset.objects.filter(id=self.dataset.id).update(locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1))
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.lock(lock_id=self.dataset.lock_id)
+
+        self.assertEqual(dataset.lock_id, self.dataset.lock_id)
+        self.assertRaises(DatasetLockedError, Dataset.objects.get(id=self.dataset.id).lock)
+
+    def test_lock_resumed_taken(self):
+        self.dataset.lock()
+
+        Dataset.objects.filter(id=self.dataset.id).update(locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1))
+
+        Dataset.objects.get(id=self.dataset.id).lock()
+
+        self.assertRaises(DatasetLockedError, Dataset.objects.get(id=self.dataset.id).lock, lock_id=self.dataset.lock_id)
+
+    def test_unlock_expired(self):
+        self.dataset.lock()
+
+        Dataset.objects.filter(id=self.dataset.id).update(locked_at=now() - timedelta(seconds=settings.PANDA_LOCK_LEASE + 1))
+
+        other = Dataset.objects.get(id=self.dataset.id)
+        other.lock()
+
+        # Releasing the expired lock leaves the new one alone
+        self.dataset.unlock()
+
+        self.assertEqual(self.dataset.locked, True)
+        self.assertEqual(Dataset.objects.get(id=self.dataset.id).lock_id, other.lock_id)
+        self.assertRaises(DatasetLockedError, Dataset.objects.get(id=self.dataset.id).lock)
+
     def test_unlock(self):
         self.dataset.lock()
         self.dataset.unlock()
@@ -79,6 +152,55 @@ class TestDataset(TransactionTestCase):
 
         self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'Christopher')['response']['numFound'], 1)
 
+    def test_import_csv_partitioned(self):
+        old_partitions = settings.PANDA_IMPORT_PARTITIONS
+        old_min_size = settings.PANDA_IMPORT_PARTITION_MIN_SIZE
+        settings.PANDA_IMPORT_PARTITIONS = 2
+        settings.PANDA_IMPORT_PARTITION_MIN_SIZE = 0
+
+        try:
+            self.dataset.import_data(self.user, self.upload)
+        finally:
+            settings.PANDA_IMPORT_PARTITIONS = old_partitions
+            settings.PANDA_IMPORT_PARTITION_MIN_SIZE = old_min_size
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        task = dataset.current_task
+
+        self.assertEqual(task.status, 'SUCCESS')
+
+        partitions = TaskStatus.objects.filter(task_name='panda.tasks.partition.import.csv')
+
+        self.assertEqual(partitions.count(), 2)
+        self.assertEqual([p.status for p in partitions], ['SUCCESS', 'SUCCESS'])
+
+        self.assertEqual(dataset.row_count, 4)
+        self.assertEqual(dataset.locked, False)
+
+        # Rows are stored in file order
+        rows = [json.loads(d['data']) for d in solr.iter_docs(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % dataset.slug)]
+
+        self.assertEqual([row[0] for row in rows], ['1', '2', '3', '4'])
+
+    def test_import_csv_chunk_result_pickles(self):
+        self.dataset.import_data(self.user, self.upload)
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.column_schema = update_indexed_names([dict(c, indexed=True) for c in dataset.column_schema])
+        dataset.save()
+
+        result = ImportCSVChunkTask.process(lambda i: True, dataset.slug, self.upload.id, 0, None, 0, int(time.time() * 1000000))
+
+        # Chunk results are stored by the (pickled) result backend
+        stats, rows = pickle.loads(pickle.dumps(result))
+
+        self.assertEqual(rows, 4)
+        self.assertEqual(stats['min'], [1, None, None, None])
+        self.assertEqual(stats['max'], [4, None, None, None])
+        self.assertEqual(stats['error_counts'], [0, 0, 0, 0])
+
     def test_import_xls(self):
         xls_upload = utils.get_test_data_upload(self.user, self.dataset, utils.TEST_XLS_FILENAME)
 
@@ -453,6 +575,39 @@ class TestDataset(TransactionTestCase):
         self.assertNotEqual(self.dataset.last_modified, None)
         self.assertEqual(self.dataset._count_rows(), 3)
 
+    def test_add_many_rows_overwrite(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        # Refresh dataset so row_count is available
+        self.dataset = Dataset.objects.get(id=self.dataset.id)
+
+        new_rows = [
+            (['1', 'Brian', 'Boyer', 'PANDA'], '1'),
+            (['5', 'Somebody', 'Else', 'Somewhere'], '5'),
+            (['5', 'Somebody', 'Else', 'Elsewhere'], '5'),
+            (['6', 'Another', 'Person', 'Somewhere'], None)
+        ]
+
+        self.dataset.add_many_rows(self.user, new_rows)
+
+        self.assertEqual(self.dataset.row_count, 6)
+        self.assertEqual(self.dataset.last_modification, '2 rows added and 2 updated')
+        self.assertEqual(self.dataset._count_rows(), 6)
+
+    def test_reconcile_row_counts(self):
+        self.dataset.import_data(self.user, self.upload, 0)
+
+        Dataset.objects.filter(id=self.dataset.id).update(row_count=10)
+
+        generation = get_generation(DATASETS)
+
+        ReconcileRowCountsTask.apply_async()
+
+        self.assertEqual(Dataset.objects.get(id=self.dataset.id).row_count, 4)
+
+        # Cached listings show the corrected count
+        self.assertNotEqual(get_generation(DATASETS), generation)
+
     def test_export_csv(self):
         self.dataset.import_data(self.user, self.upload)
         
@@ -480,6 +635,21 @@ class TestDataset(TransactionTestCase):
 
         self.assertEqual(imported_csv, exported_csv)
 
+    def test_export_legacy_ids_index_order(self):
+        self.dataset.import_data(self.user, self.upload)
+
+        # Rows indexed before 1.1.2 have random ids, so are read in the order they were indexed
+        solr.add(settings.SOLR_DATA_CORE, [{
+            'id': row_id,
+            'dataset_slug': self.dataset.slug,
+            'data': json.dumps([row_id, '', '', ''])
+        } for row_id in ['f0', 'a0']], commit=True)
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(dataset.has_row_ids(), False)
+        self.assertEqual([row[0] for row in dataset.iter_export_rows()], ['id', '1', '2', '3', '4', 'f0', 'a0'])
+
     def test_export_query_csv(self):
         self.dataset.import_data(self.user, self.upload)
         
@@ -537,6 +707,136 @@ class TestDataset(TransactionTestCase):
         self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_unicode_last_name:Germuska')['response']['numFound'], 1)
         self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_unicode_first_name:Joseph')['response']['numFound'], 0)
 
+    def test_reindex_unchanged(self):
+        self.dataset.import_data(self.user, self.upload)
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.reindex_data(self.user, typed_columns=[True, False, True, True])
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.reindex_data(self.user, typed_columns=[True, False, True, True])
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        task = dataset.current_task
+
+        self.assertEqual(task.status, 'SUCCESS')
+        self.assertEqual([c['indexed_name'] for c in dataset.column_schema], ['column_int_id', None, 'column_unicode_last_name', 'column_unicode_employer'])
+        self.assertEqual(dataset.locked, False)
+
+        self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_int_id:2')['response']['numFound'], 1)
+
+    def test_reindex_after_abort(self):
+        self.dataset.import_data(self.user, self.upload)
+
+        # Simulate a reindex which saved its schema but was aborted before typing any rows
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.column_schema = update_indexed_names([dict(c, indexed=t) for c, t in zip(dataset.column_schema, [True, False, True, True])])
+        dataset.column_schema_indexed = False
+        dataset.save()
+
+        self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_int_id:2')['response']['numFound'], 0)
+
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.reindex_data(self.user, typed_columns=[True, False, True, True])
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+
+        self.assertEqual(dataset.current_task.status, 'SUCCESS')
+        self.assertEqual(dataset.column_schema_indexed, True)
+
+        self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_int_id:2')['response']['numFound'], 1)
+
+    def test_reindex_partitioned(self):
+        old_partitions = settings.PANDA_REINDEX_PARTITIONS
+        old_min_rows = settings.PANDA_REINDEX_PARTITION_MIN_ROWS
+        settings.PANDA_REINDEX_PARTITIONS = 2
+        settings.PANDA_REINDEX_PARTITION_MIN_ROWS = 1
+
+        try:
+            self.dataset.import_data(self.user, self.upload)
+
+            # Refresh from database
+            dataset = Dataset.objects.get(id=self.dataset.id)
+
+            dataset.reindex_data(self.user, typed_columns=[True, False, True, True])
+        finally:
+            settings.PANDA_REINDEX_PARTITIONS = old_partitions
+            settings.PANDA_REINDEX_PARTITION_MIN_ROWS = old_min_rows
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        task = dataset.current_task
+
+        self.assertEqual(task.status, 'SUCCESS')
+
+        partitions = TaskStatus.objects.filter(task_name='panda.tasks.partition.reindex')
+
+        self.assertEqual(partitions.count(), 2)
+        self.assertEqual([p.status for p in partitions], ['SUCCESS', 'SUCCESS'])
+
+        self.assertEqual([c['min'] for c in dataset.column_schema], [1, None, None, None])
+        self.assertEqual([c['max'] for c in dataset.column_schema], [4, None, None, None])
+        self.assertEqual(dataset.row_count, 4)
+        self.assertEqual(dataset.locked, False)
+
+        self.assertEqual(solr.query(settings.SOLR_DATA_CORE, 'column_int_id:[1 TO 4]')['response']['numFound'], 4)
+
+    def test_reindex_partition_result_pickles(self):
+        self.dataset.import_data(self.user, self.upload)
+
+        # Refresh from database
+        dataset = Dataset.objects.get(id=self.dataset.id)
+        dataset.column_schema = update_indexed_names([dict(c, indexed=t) for c, t in zip(dataset.column_schema, [True, False, True, True])])
+        dataset.save()
+
+        result = ReindexPartitionTask.process(lambda i: True, dataset.slug, None, None)
+
+        # Partition results are stored by the (pickled) result backend
+        stats, rows = pickle.loads(pickle.dumps(result))
+
+        self.assertEqual(rows, 4)
+        self.assertEqual(stats['min'], [1, None, None, None])
+        self.assertEqual(stats['max'], [4, None, None, None])
+        self.assertEqual(stats['error_counts'], [0, 0, 0, 0])
+
+    def test_partition_timeout(self):
+        class Request(object):
+            id = str(uuid4())
+
+        class Parent(object):
+            request = Request()
+
+            def is_aborted(self):
+                return False
+
+        class LostPartitionTask(object):
+            name = 'panda.tasks.partition.lost'
+
+            @classmethod
+            def apply_async(cls, args, kwargs, task_id):
+                # Claimed by a worker whose result never arrives
+                claim_partition(task_id)
+
+                return AbortableAsyncResult(task_id)
+
+        task_status = TaskStatus.objects.create(task_name='panda.tasks.test', creator=self.user)
+
+        old_timeout = settings.PANDA_PARTITION_TIMEOUT
+        settings.PANDA_PARTITION_TIMEOUT = 0
+
+        try:
+            with self.assertRaises(PartitionTimeoutError):
+                run_partitions(Parent(), task_status, LostPartitionTask, [()], lambda i: None)
+        finally:
+            settings.PANDA_PARTITION_TIMEOUT = old_timeout
+
+        partition = TaskStatus.objects.get(task_name='panda.tasks.partition.lost')
+
+        self.assertEqual(partition.status, 'FAILURE')
+        self.assertEqual(AbortableAsyncResult(Request.id).is_aborted(), True)
+
     def test_reindex_complex(self):
         upload = utils.get_test_data_upload(self.user, self.dataset, filename=utils.TEST_CSV_TYPES_FILENAME)
         self.dataset.import_data(self.user, upload)
@@ -1,10 +1,19 @@
 #!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
+from copy import deepcopy
 import datetime
+import time
+from uuid import uuid4
 
+from django.conf import settings
 from django.test import TestCase
 
 from panda import solr as solrjson
+from panda.models import Dataset, DataUpload
+from panda.tests import utils
+from panda.utils.solr import DataBatchEncoder, decode_data, has_row_ids, iter_data, make_categories_mismatch_query, make_data_row, make_filters, make_row_id, make_search_query
+from panda.utils.typecoercion import DataTyper
 
 class TestSolrJSONEncoder(TestCase):
     def test_datetime(self):
@@ -23,3 +32,256 @@ class TestSolrJSONEncoder(TestCase):
         v = { 'int': 123 }
         self.assertEqual(solrjson.dumps(v), '{"int": 123}')
 
+class TestSolrConnectionPool(TestCase):
+    def test_url(self):
+        url = solrjson.get_url('data_test', 'select')
+
+        self.assertEqual(url, 'http://localhost:8983/solr/data_test/select')
+        self.assertIs(solrjson.get_url('data_test', 'select'), url)
+
+    def test_session_reused(self):
+        self.assertIs(solrjson.get_session(), solrjson.get_session())
+
+    def test_connection_stats(self):
+        solrjson.query('data_test', '*:*', limit=0)
+        solrjson.query('data_test', '*:*', limit=0)
+
+        stats = solrjson.connection_stats()
+
+        self.assertGreaterEqual(stats['requests'], 2)
+        self.assertLess(stats['connections'], stats['requests'])
+        self.assertGreater(stats['reuse_rate'], 0)
+
+class TestIterDocs(TestCase):
+    def setUp(self):
+        utils.setup_test_solr()
+
+        solrjson.add('data_test', [{ 'id': 'row-%i' % i, 'dataset_slug': 'iter-docs', 'data': '["%i"]' % i } for i in range(5)], commit=True)
+
+    def test_iter_docs(self):
+        ids = [doc['id'] for doc in solrjson.iter_docs('data_test', 'dataset_slug:iter-docs', fields=['data'], page_size=2)]
+
+        self.assertEqual(ids, ['row-0', 'row-1', 'row-2', 'row-3', 'row-4'])
+
+    def test_iter_docs_bounds(self):
+        ids = [doc['id'] for doc in solrjson.iter_docs('data_test', 'dataset_slug:iter-docs', page_size=2, after='row-0', until='row-3')]
+
+        self.assertEqual(ids, ['row-1', 'row-2', 'row-3'])
+
+    def test_iter_docs_index_order(self):
+        solrjson.add('data_test', [{ 'id': i, 'dataset_slug': 'iter-docs-legacy', 'data': '[]' } for i in ['c', 'a', 'b']], commit=True)
+
+        ids = [doc['id'] for doc in solrjson.iter_docs('data_test', 'dataset_slug:iter-docs-legacy', page_size=2, by_id=False)]
+
+        self.assertEqual(ids, ['c', 'a', 'b'])
+
+        with self.assertRaises(ValueError):
+            list(solrjson.iter_docs('data_test', 'dataset_slug:iter-docs-legacy', after='a', by_id=False))
+
+    def test_iter_docs_no_results(self):
+        self.assertEqual(list(solrjson.iter_docs('data_test', 'dataset_slug:foobar')), [])
+
+    def test_iter_pages(self):
+        pages = list(solrjson.iter_pages('data_test', 'dataset_slug:iter-docs', page_size=2))
+
+        self.assertEqual([len(docs) for docs in pages], [2, 2, 1])
+
+    def test_iter_data(self):
+        pages = list(iter_data('data_test', 'dataset_slug:iter-docs', page_size=2))
+
+        self.assertEqual([rows for docs, rows in pages], [[['0'], ['1']], [['2'], ['3']], [['4']]])
+        self.assertEqual([doc['id'] for doc in pages[0][0]], ['row-0', 'row-1'])
+
+    def test_query_fields(self):
+        response = solrjson.query('data_test', 'dataset_slug:iter-docs', fields=['id'])
+
+        self.assertNotIn('responseHeader', response)
+        self.assertEqual(response['response']['docs'][0].keys(), ['id'])
+
+    def test_query_filters(self):
+        response = solrjson.query('data_test', 'dataset_slug:iter-docs', filters=['id:(row-1 OR row-2)', 'id:row-2'])
+
+        self.assertEqual([doc['id'] for doc in response['response']['docs']], ['row-2'])
+
+    def test_query_raw(self):
+        response = solrjson.query('data_test', 'dataset_slug:iter-docs', wt='xml')
+
+        self.assertTrue(response.startswith('<?xml'))
+
+    def test_count(self):
+        self.assertEqual(solrjson.count('data_test', 'dataset_slug:iter-docs'), 5)
+        self.assertEqual(solrjson.count('data_test', 'dataset_slug:iter-docs', filters=['id:row-1']), 1)
+
+    def test_decode_data_invalid(self):
+        with self.assertRaises(ValueError):
+            decode_data([{ 'data': '["1"]' }, { 'data': '["2"' }])
+
+class TestCommitPolicy(TestCase):
+    def setUp(self):
+        utils.setup_test_solr()
+
+    def count(self):
+        return solrjson.query('data_test', 'dataset_slug:commit-policy', limit=0)['response']['numFound']
+
+    def test_get_commit_policy(self):
+        self.assertEqual(solrjson.get_commit_policy(True), solrjson.COMMIT_IMMEDIATE)
+        self.assertEqual(solrjson.get_commit_policy(False), solrjson.COMMIT_NONE)
+        self.assertEqual(solrjson.get_commit_policy(solrjson.COMMIT_WITHIN), solrjson.COMMIT_WITHIN)
+
+        with self.assertRaises(ValueError):
+            solrjson.get_commit_policy('sometimes')
+
+    def test_within(self):
+        solrjson.add('data_test', [{ 'id': 'row-%i' % i, 'dataset_slug': 'commit-policy', 'data': '[]' } for i in range(3)], commit=solrjson.COMMIT_WITHIN)
+
+        time.sleep(settings.SOLR_COMMIT_WITHIN / 1000.0 + 1)
+
+        self.assertEqual(self.count(), 3)
+
+    def test_deferred(self):
+        solrjson.add('data_test', [{ 'id': 'row-%i' % i, 'dataset_slug': 'commit-policy', 'data': '[]' } for i in range(3)], commit=solrjson.COMMIT_DEFERRED)
+
+        self.assertIn('data_test', solrjson.committer.pending)
+
+        solrjson.committer.flush()
+
+        self.assertEqual(self.count(), 3)
+
+        solrjson.delete('data_test', 'dataset_slug:commit-policy', commit=solrjson.COMMIT_WITHIN)
+        solrjson.committer.flush()
+
+        self.assertEqual(self.count(), 0)
+
+class TestFilters(TestCase):
+    def setUp(self):
+        utils.setup_test_solr()
+
+        solrjson.add('data_test', [
+            { 'id': 'a-1', 'dataset_slug': 'filters-a', 'data': '[]', 'full_text': 'Brian', 'last_modified': datetime.datetime(2012, 1, 1, 10, 0, 10), 'categories': [1, 2] },
+            { 'id': 'a-2', 'dataset_slug': 'filters-a', 'data': '[]', 'full_text': 'Brian', 'last_modified': datetime.datetime(2012, 1, 1, 10, 0, 50), 'categories': [1] },
+            { 'id': 'b-1', 'dataset_slug': 'filters-b', 'data': '[]', 'full_text': 'Brian', 'last_modified': datetime.datetime(2012, 1, 1, 10, 0, 50), 'categories': [0] },
+            { 'id': 'b-2', 'dataset_slug': 'filters-b', 'data': '[]', 'full_text': 'Brian', 'last_modified': datetime.datetime(2012, 1, 1, 10, 0, 50) }
+        ], commit=True)
+
+    def search(self, query=None, dataset_slugs=None, since=None, category_id=None):
+        response = solrjson.query('data_test', make_search_query(query), filters=make_filters(dataset_slugs, since, category_id), sort='id asc')
+
+        return [doc['id'] for doc in response['response']['docs']]
+
+    def test_make_search_query(self):
+        self.assertEqual(make_search_query('Brian'), '(Brian)')
+        self.assertEqual(make_search_query(''), '*:*')
+
+    def test_dataset_slugs(self):
+        self.assertEqual(self.search('Brian', ['filters-a']), ['a-1', 'a-2'])
+        self.assertEqual(self.search(None, ['filters-a', 'filters-b']), ['a-1', 'a-2', 'b-1', 'b-2'])
+        self.assertEqual(self.search('Brian', []), [])
+
+    def test_since_exact(self):
+        self.assertEqual(self.search('Brian', since='2012-01-01T10:00:30'), ['a-2', 'b-1', 'b-2'])
+        self.assertEqual(self.search(None, ['filters-a'], since='2012-01-01T10:00:30'), ['a-2'])
+
+    def test_category(self):
+        self.assertEqual(self.search('Brian', category_id=1), ['a-1', 'a-2'])
+        self.assertEqual(self.search('Brian', category_id=2), ['a-1'])
+        self.assertEqual(self.search(None, category_id=0, since='2012-01-01T10:00:30'), ['b-1'])
+
+    def test_categories_mismatch(self):
+        def mismatched(category_ids):
+            return [doc['id'] for doc in solrjson.query('data_test', make_categories_mismatch_query(category_ids), sort='id asc')['response']['docs']]
+
+        self.assertEqual(mismatched([1]), ['a-1', 'b-1', 'b-2'])
+        self.assertEqual(mismatched([2, 1]), ['a-2', 'b-1', 'b-2'])
+        self.assertEqual(mismatched([0]), ['a-1', 'a-2', 'b-2'])
+
+class TestMakeRowId(TestCase):
+    def test_ordered(self):
+        ids = [make_row_id() for i in range(1000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 1000)
+
+    def test_has_row_ids(self):
+        utils.setup_test_solr()
+
+        filters = make_filters(['row-ids'])
+
+        solrjson.add('data_test', [{ 'id': make_row_id(), 'dataset_slug': 'row-ids', 'data': '[]' } for i in range(3)], commit=True)
+
+        self.assertEqual(has_row_ids('data_test', filters), True)
+
+        # Rows indexed before 1.1.2 have random ids
+        solrjson.add('data_test', [{ 'id': str(uuid4()), 'dataset_slug': 'row-ids', 'data': '[]' }], commit=True)
+
+        self.assertEqual(has_row_ids('data_test', filters), False)
+
+class TestDataBatchEncoder(TestCase):
+    def setUp(self):
+        self.dataset = Dataset(slug='encoder', name='Encoder')
+        self.upload = DataUpload(id=7)
+
+        self.schema = [
+            { 'indexed': True, 'type': 'int', 'indexed_name': 'column_int_id', 'min': None, 'max': None },
+            { 'indexed': False, 'type': 'unicode', 'indexed_name': None, 'min': None, 'max': None },
+            { 'indexed': True, 'type': 'datetime', 'indexed_name': 'column_datetime_date', 'min': None, 'max': None },
+            { 'indexed': True, 'type': 'float', 'indexed_name': 'column_float_salary', 'min': None, 'max': None },
+            { 'indexed': True, 'type': 'bool', 'indexed_name': 'column_bool_active', 'min': None, 'max': None }
+        ]
+
+        self.rows = [
+            [u'1', u'Brian "B"', u'2012-04-13', u'$171,000.59', u'true'],
+            [u'n/a', u'Joseph\nGermuska', u'', u'', u''],
+            [u'3', u'☃', u'13/13/2012', u'1.5', u'maybe']
+        ]
+
+    def test_same_as_documents(self):
+        external_ids = [None, u'joe', None]
+        row_ids = [u'row-1', None, u'row-3']
+
+        typer = DataTyper(deepcopy(self.schema))
+        documents = [make_data_row(self.dataset, row, data_upload=self.upload, external_id=external_id, row_id=row_id) for row, external_id, row_id in zip(self.rows, external_ids, row_ids)]
+        documents = solrjson.loads(solrjson.dumps(typer.type_batch(documents, self.rows)))
+
+        encoder_typer = DataTyper(deepcopy(self.schema))
+        encoder = DataBatchEncoder(self.dataset, encoder_typer, data_upload=self.upload)
+        encoded = solrjson.loads(encoder.encode(self.rows, external_ids=external_ids, row_ids=row_ids))
+
+        # Modification times may be a second apart
+        for document in documents + encoded:
+            self.assertIn('last_modified', document)
+            del document['last_modified']
+
+        self.assertEqual(encoded, documents)
+        self.assertEqual(encoder_typer.schema, typer.schema)
+        self.assertEqual([len(e) for e in encoder_typer.errors], [len(e) for e in typer.errors])
+
+    def test_encoded_data(self):
+        encoder = DataBatchEncoder(self.dataset, DataTyper(deepcopy(self.schema)))
+        encoded_data = [solrjson.dumps(row) for row in self.rows]
+
+        encoded = solrjson.loads(encoder.encode(self.rows, row_ids=['a', 'b', 'c'], encoded_data=encoded_data, data_upload_ids=[1, None, 3], last_modified=['2012-01-01T10:00:00Z', None, '2012-01-02T10:00:00Z']))
+
+        self.assertEqual([d['id'] for d in encoded], ['a', 'b', 'c'])
+        self.assertEqual([d['data'] for d in encoded], encoded_data)
+        self.assertEqual([d['data_upload_id'] for d in encoded], [1, None, 3])
+        self.assertEqual(encoded[0]['last_modified'], '2012-01-01T10:00:00Z')
+        self.assertNotEqual(encoded[1]['last_modified'], None)
+        self.assertEqual(encoded[2]['last_modified'], '2012-01-02T10:00:00Z')
+        self.assertEqual([d['categories'] for d in encoded], [[settings.PANDA_UNCATEGORIZED_ID]] * 3)
+
+    def test_empty(self):
+        encoder = DataBatchEncoder(self.dataset, DataTyper(deepcopy(self.schema)))
+
+        self.assertEqual(encoder.encode([]), '[]')
+
+    def test_add_encoded(self):
+        utils.setup_test_solr()
+
+        encoder = DataBatchEncoder(self.dataset, DataTyper(deepcopy(self.schema)))
+
+        solrjson.add('data_test', encoder.encode(self.rows), commit=True)
+
+        self.assertEqual(solrjson.query('data_test', 'dataset_slug:encoder', limit=0)['response']['numFound'], 3)
+
+        with self.assertRaises(ValueError):
+            solrjson.add('data_test', encoder.encode(self.rows), commit=solrjson.COMMIT_WITHIN)
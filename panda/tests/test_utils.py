@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
 from datetime import date, time, datetime
-import os.path
+import os
+import pickle
+from StringIO import StringIO
+import tempfile
+from zipfile import ZipFile
 
+from csvkit import CSVKitReader
 from django.test import TestCase
 
 from panda import utils
@@ -62,6 +67,53 @@ class TestCSV(TestCase):
 
         self.assertEqual(guessed_types, ['int', 'unicode', 'unicode', 'unicode'])
 
+    def test_csv_find_chunks(self):
+        chunks, row_count = utils.csv.find_chunks(self.path, self.dialect, 2)
+
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(row_count, 4)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[0][1], chunks[1][0])
+        self.assertEqual(chunks[1][1], None)
+
+        rows = []
+
+        with open(self.path, 'r') as f:
+            for start, end, first_row in chunks:
+                self.assertEqual(first_row, len(rows))
+
+                chunk = list(CSVKitReader(utils.csv.FileRange(f, start, end), **self.dialect))
+
+                if start == 0:
+                    chunk = chunk[1:]
+
+                rows.extend(chunk)
+
+        self.assertEqual([row[0] for row in rows], ['1', '2', '3', '4'])
+
+    def test_csv_find_chunks_quoted_newlines(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write('a,b\n1,"x\n2,y\n3,z"\n4,"w"""\n5,v\n')
+
+        try:
+            chunks, row_count = utils.csv.find_chunks(path, dict(self.dialect, doublequote=True), 4)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(row_count, 3)
+        self.assertEqual([first_row for start, end, first_row in chunks], range(len(chunks)))
+        self.assertNotIn(len('a,b\n1,"x\n'), [start for start, end, first_row in chunks])
+
+    def test_csv_iter_csv_chunks(self):
+        rows = [[u'id', u'name']] + [[unicode(i), u'caf\xe9, %i' % i] for i in range(5)]
+
+        chunks = list(utils.csv.iter_csv_chunks(rows, rows_per_chunk=2))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(list(CSVKitReader(StringIO(''.join(chunks)))), rows)
+
 class TestXLS(TestCase):
     def setUp(self):
         self.path = os.path.join(test_utils.TEST_DATA_PATH, test_utils.TEST_XLS_FILENAME)
@@ -175,3 +227,117 @@ class TestTypeCoercion(TestCase):
     def test_coerce_time_from_str(self):
         self.assertEqual(self.coerce_type('8:28 AM', time), datetime(9999, 12, 31, 8, 28, 0))
 
+    def test_type_batch(self):
+        schema = utils.column_schema.make_column_schema(['id', 'name', 'date'], indexed=[True, False, True], types=['int', 'unicode', 'date'])
+        rows = [['1', 'Brian', '2011-4-13'], ['x', 'Joseph', ''], ['3', 'Ryan', '2010-1-1']]
+
+        row_typer = utils.typecoercion.DataTyper(schema)
+        row_data = [row_typer({}, row) for row in rows]
+
+        batch_typer = utils.typecoercion.DataTyper(utils.column_schema.make_column_schema(['id', 'name', 'date'], indexed=[True, False, True], types=['int', 'unicode', 'date']))
+        batch_data = batch_typer.type_batch([{} for row in rows], rows)
+
+        self.assertEqual(batch_data, row_data)
+        self.assertEqual(batch_typer.schema, row_typer.schema)
+        self.assertEqual([len(e) for e in batch_typer.errors], [1, 0, 1])
+        self.assertEqual(batch_typer.schema[0]['min'], 1)
+        self.assertEqual(batch_typer.schema[0]['max'], 3)
+
+    def test_pickle(self):
+        schema = utils.column_schema.make_column_schema(['id', 'name', 'date'], indexed=[True, False, True], types=['int', 'unicode', 'date'])
+        data_typer = utils.typecoercion.DataTyper(schema)
+        data_typer.type_batch([{}, {}], [['1', 'Brian', '2011-4-13'], ['x', 'Joseph', '']])
+
+        unpickled = pickle.loads(pickle.dumps(data_typer))
+
+        self.assertEqual(unpickled.schema, data_typer.schema)
+        self.assertEqual([len(e) for e in unpickled.errors], [1, 0, 1])
+        self.assertEqual(unpickled({}, ['3', 'Ryan', '2010-1-1']), data_typer({}, ['3', 'Ryan', '2010-1-1']))
+        self.assertEqual(unpickled.schema[0]['max'], 3)
+
+    def test_date_parser(self):
+        parse_date = utils.typecoercion.DateParser()
+        values = ['2011-4-%i' % (i % 28 + 1) for i in range(utils.typecoercion.DATE_LEARN_SAMPLES * 2)]
+        values.extend(['2011-2-30', '4/13/2011', '8:28 AM', '2011-4-13 8:28', 'foo'])
+
+        for value in values:
+            try:
+                expected = self.coerce_type(value, datetime)
+            except TypeCoercionError:
+                expected = None
+
+            try:
+                result = parse_date(value)
+            except ValueError:
+                result = None
+
+            self.assertEqual(result, expected)
+
+        self.assertNotEqual(parse_date.format, None)
+        self.assertIn('foo', parse_date.memo)
+
+class TestColumnSchema(TestCase):
+    def setUp(self):
+        self.schema = utils.column_schema.make_column_schema(['id', 'name'], indexed=[True, False], types=['int', 'unicode'])
+
+    def test_diff_unchanged(self):
+        new_schema = utils.column_schema.make_column_schema(['id', 'name'], indexed=[True, False], types=['int', 'unicode'])
+
+        self.assertEqual(utils.column_schema.diff_column_schemas(self.schema, new_schema), [])
+
+    def test_diff_indexed(self):
+        new_schema = utils.column_schema.make_column_schema(['id', 'name'], indexed=[True, True], types=['int', 'unicode'])
+
+        self.assertEqual(utils.column_schema.diff_column_schemas(self.schema, new_schema), [1])
+
+    def test_diff_type(self):
+        new_schema = utils.column_schema.make_column_schema(['id', 'name'], indexed=[True, False], types=['float', 'unicode'])
+
+        self.assertEqual(utils.column_schema.diff_column_schemas(self.schema, new_schema), [0])
+
+    def test_diff_no_old_schema(self):
+        self.assertEqual(utils.column_schema.diff_column_schemas(None, self.schema), [0, 1])
+
+class TestZipStream(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.zip')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_write_entry(self):
+        chunks = ['%i,Brian,Boyer,Chicago Tribune\n' % i for i in range(1000)]
+
+        with ZipFile(self.path, 'w', allowZip64=True) as z:
+            utils.zipstream.write_entry(z, 'a.csv', iter(chunks))
+            utils.zipstream.write_entry(z, 'b.csv', iter([]))
+
+        with ZipFile(self.path) as z:
+            self.assertEqual(z.testzip(), None)
+            self.assertEqual(z.namelist(), ['a.csv', 'b.csv'])
+            self.assertEqual(z.read('a.csv'), ''.join(chunks))
+            self.assertEqual(z.read('b.csv'), '')
+
+    def test_ordered_producers(self):
+        def generate(n):
+            for i in range(n):
+                yield '%i,%i\n' % (n, i)
+
+        producers = utils.zipstream.OrderedProducers([generate(n) for n in range(10)], threads=3, queue_size=2)
+
+        self.assertEqual([list(chunks) for chunks in producers], [list(generate(n)) for n in range(10)])
+
+    def test_ordered_producers_error(self):
+        def generate():
+            yield 'a'
+
+            raise ValueError()
+
+        producers = utils.zipstream.OrderedProducers([generate()], threads=2)
+        chunks = iter(producers).next()
+
+        self.assertEqual(chunks.next(), 'a')
+
+        with self.assertRaises(ValueError):
+            chunks.next()
@@ -4,6 +4,7 @@ import os.path
 from shutil import copyfile
 
 from django.conf import settings
+from django.core.cache import cache
 from livesettings import config_get
 
 from panda import solr
@@ -24,10 +25,14 @@ TEST_MONEY = 'test_money.csv'
 def setup_test_solr():
     settings.SOLR_DATA_CORE = 'data_test'
     settings.SOLR_DATASETS_CORE = 'datasets_test'
+    settings.SOLR_API_COMMIT_POLICY = 'immediate'
     config_get('PERF', 'TASK_THROTTLE').update(0.0) 
     solr.delete(settings.SOLR_DATA_CORE, '*:*')
     solr.delete(settings.SOLR_DATASETS_CORE, '*:*')
 
+    # Cached listings may describe objects from previous tests
+    cache.clear()
+
 def get_auth_headers(email='user@pandaproject.net'):
     user = UserProxy.objects.get(email=email)
 
@@ -2,14 +2,17 @@
 
 from django.conf import settings
 
+import cache
 import column_schema
 import csvdata as csv
 import email
+import ingest
 import notifications
 import solr
 import typecoercion
 import xls
 import xlsx
+import zipstream
 
 def sniff_dialect(data_type, path, encoding='utf-8'):
     return globals()[data_type].sniff_dialect(path, encoding=encoding) 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Caching for expensive listings, built on Django's cache framework.
+
+Cached values are grouped into namespaces (``DATASETS`` and
+``CATEGORIES``). Each namespace has a generation number which is part of
+every key in it, so the whole namespace is invalidated at once by
+incrementing its generation (see ``invalidate``). Old entries are never
+read again and simply expire.
+
+Search results are cached in the same way, but keyed on the generation
+of the data a search covers: one dataset, one category or every dataset
+(see ``get_search``).
+"""
+
+from hashlib import md5
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Dataset listings: invalidated by any change to a dataset or the objects embedded in it
+DATASETS = 'datasets'
+
+# Categories and their dataset counts: invalidated when datasets are created,
+# deleted or (un)categorized, or when categories change
+CATEGORIES = 'categories'
+
+# Search results
+SEARCH = 'search'
+
+def _now():
+    return int(time.time() * 1000)
+
+def _generation_key(namespace):
+    return 'panda:%s:generation' % namespace
+
+def _data_generation_key(dataset_slug=None, category_id=None):
+    if dataset_slug is not None:
+        return 'panda:data:dataset:%s:generation' % dataset_slug
+
+    if category_id is not None:
+        return 'panda:data:category:%i:generation' % category_id
+
+    return 'panda:data:generation'
+
+def _get_generation(key):
+    generation = cache.get(key)
+
+    if generation is None:
+        # Start after any generation which may have expired, so stale
+        # entries can never be mistaken for current ones
+        generation = _now()
+
+        if not cache.add(key, generation, settings.PANDA_CACHE_GENERATION_TIMEOUT):
+            generation = cache.get(key, generation)
+
+    return generation
+
+def _bump_generation(key):
+    # Generations are also the time (in milliseconds) they were last
+    # incremented, see ``get_search``
+    generation = max(cache.get(key, 0) + 1, _now())
+
+    cache.set(key, generation, settings.PANDA_CACHE_GENERATION_TIMEOUT)
+
+def get_generation(namespace):
+    """
+    Get the current generation of a namespace.
+    """
+    return _get_generation(_generation_key(namespace))
+
+def invalidate(*namespaces):
+    """
+    Invalidate everything cached in the given namespaces.
+    """
+    for namespace in namespaces:
+        _bump_generation(_generation_key(namespace))
+
+def invalidate_dataset(dataset_slug, category_ids=()):
+    """
+    Invalidate cached searches which cover a dataset's data: searches of
+    the dataset, of each of ``category_ids`` (the categories indexed on its
+    rows) and of every dataset. Should be called whenever data is
+    imported, written, deleted or reindexed.
+    """
+    _bump_generation(_data_generation_key(dataset_slug=dataset_slug))
+
+    for category_id in category_ids:
+        _bump_generation(_data_generation_key(category_id=category_id))
+
+    _bump_generation(_data_generation_key())
+
+def make_key(namespace, *parts):
+    """
+    Build a key for a value in a namespace, which depends on ``parts``.
+    """
+    digest = md5(repr(parts)).hexdigest()
+
+    return 'panda:%s:%i:%s' % (namespace, get_generation(namespace), digest)
+
+def get_or_set(namespace, parts, func):
+    """
+    Get a cached value, or call ``func`` to create (and cache) it.
+    """
+    key = make_key(namespace, *parts)
+    value = cache.get(key)
+
+    if value is None:
+        value = func()
+
+        cache.set(key, value, settings.PANDA_CACHE_TIMEOUT)
+
+    return value
+
+def claim(name, timeout):
+    """
+    Claim a named flag for up to ``timeout`` seconds. Returns ``False`` if
+    it is already claimed, so that work is only scheduled once until the
+    flag is released (see ``release``).
+    """
+    return cache.add('panda:claim:%s' % name, True, timeout)
+
+def release(name):
+    """
+    Release a flag taken with ``claim``.
+    """
+    cache.delete('panda:claim:%s' % name)
+
+def normalize_query(query):
+    """
+    Normalize whitespace in a query, so trivially different searches share
+    cache entries.
+    """
+    return u' '.join(query.split())
+
+def _count(name):
+    key = 'panda:%s:%s' % (SEARCH, name)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, settings.PANDA_CACHE_GENERATION_TIMEOUT):
+            cache.incr(key)
+
+def get_search(parts, func, dataset_slug=None, category_id=None):
+    """
+    Get a cached Solr response for a search of one dataset, one category
+    or (if neither is given) every dataset, or call ``func`` to run (and
+    cache) it. ``parts`` must include everything else that affects the
+    response, such as the normalized query and paging.
+
+    Results are not cached if the data changed so recently that the change
+    may not yet be visible in Solr (see ``SOLR_COMMIT_WITHIN``).
+    """
+    generation = _get_generation(_data_generation_key(dataset_slug, category_id))
+    key = make_key(SEARCH, dataset_slug, category_id, generation, parts)
+    response = cache.get(key)
+
+    if response is not None:
+        _count('hits')
+
+        return response
+
+    _count('misses')
+
+    response = func()
+
+    settle = settings.SOLR_COMMIT_WITHIN + settings.SOLR_COMMIT_INTERVAL * 1000
+
+    if _now() - generation > settle:
+        cache.set(key, response, settings.PANDA_SEARCH_CACHE_TIMEOUT)
+
+    return response
+
+def search_stats():
+    """
+    Report how often searches have been answered from the cache, across
+    all processes.
+    """
+    found = cache.get_many(['panda:%s:hits' % SEARCH, 'panda:%s:misses' % SEARCH])
+
+    hits = found.get('panda:%s:hits' % SEARCH, 0)
+    misses = found.get('panda:%s:misses' % SEARCH, 0)
+
+    if hits + misses:
+        hit_rate = float(hits) / (hits + misses)
+    else:
+        hit_rate = 0.0
+
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hit_rate
+    }
@@ -66,3 +66,22 @@ def make_column_schema(columns, indexed=None, types=None):
 
     return column_schema
 
+
+def diff_column_schemas(old_schema, new_schema):
+    """
+    Find the columns whose typed (indexed) field would change when
+    reindexing a dataset from one column schema to another.
+
+    Returns a list of column indices. An empty list means every document
+    would be reindexed exactly as it is.
+    """
+    def indexed_name(c):
+        if c['indexed'] and c['type']:
+            return (c['indexed_name'], c['type'])
+
+        return None
+
+    if old_schema is None or len(old_schema) != len(new_schema):
+        return range(len(new_schema))
+
+    return [i for i, (old, new) in enumerate(zip(old_schema, new_schema)) if indexed_name(old) != indexed_name(new)]
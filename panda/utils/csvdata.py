@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import codecs
+import csv
+from cStringIO import StringIO
 from itertools import islice
+import os.path
 from types import NoneType
 
-from csvkit import CSVKitReader
+from csvkit import CSVKitReader, CSVKitWriter
 from csvkit.sniffer import sniff_dialect as csvkit_sniff
 from csvkit.typeinference import normalize_table
 from django.conf import settings
@@ -82,3 +85,153 @@ def guess_column_types(path, dialect, sample_size, encoding='utf-8'):
 
         return type_names 
 
+
+# Encodings in which the delimiter, quote character and newlines are always
+# encoded as single ASCII bytes, so a file can be split on those bytes
+SPLITTABLE_ENCODINGS = ['utf_8', 'ascii', 'latin_1', 'iso8859_15', 'cp1252', 'cp1250', 'mac_roman']
+
+def is_splittable(encoding, dialect_parameters):
+    """
+    Determine if a CSV file can safely be split by ``find_chunks``.
+    """
+    try:
+        name = codecs.lookup(encoding).name.replace('-', '_')
+    except LookupError:
+        return False
+
+    if name not in SPLITTABLE_ENCODINGS:
+        return False
+
+    # Escaped quotes can't be found without parsing every field
+    if dialect_parameters.get('escapechar'):
+        return False
+
+    return True
+
+def find_chunks(path, dialect_parameters, chunk_count):
+    """
+    Split a CSV file into (roughly) ``chunk_count`` byte ranges, each of which
+    begins at the start of a record.
+
+    Returns a tuple of ``(chunks, row_count)``. ``chunks`` is a list of
+    ``(start, end, first_row)`` tuples, where ``first_row`` is the number of
+    data rows (not counting the header) before the chunk. ``end`` is ``None``
+    for the last chunk. Files which contain no newlines outside of quoted
+    fields are returned as a single chunk. ``row_count`` is the number of
+    newline-terminated data rows, which is suitable for estimating progress.
+
+    Quoted fields are tracked the same way the csv module does: a quote only
+    opens a field at the start of the field and an escaped (doubled) quote
+    does not close it.
+    """
+    size = os.path.getsize(path)
+    targets = [size * n / chunk_count for n in range(1, chunk_count)]
+
+    delimiter = dialect_parameters.get('delimiter', ',')
+    quotechar = dialect_parameters.get('quotechar', '"')
+    doublequote = dialect_parameters.get('doublequote', True)
+    skipinitialspace = dialect_parameters.get('skipinitialspace', False)
+
+    if dialect_parameters.get('quoting') == csv.QUOTE_NONE:
+        quotechar = None
+
+    chunks = []
+    start = 0
+    first_row = 0
+    records = 0
+    position = 0
+    in_quotes = False
+
+    with open(path, 'rb') as f:
+        for line in f:
+            position += len(line)
+
+            if quotechar and (in_quotes or quotechar in line):
+                i = line.find(quotechar)
+
+                while i != -1:
+                    if in_quotes:
+                        if doublequote and line[i + 1:i + 2] == quotechar:
+                            i = line.find(quotechar, i + 2)
+
+                            continue
+
+                        in_quotes = False
+                    else:
+                        before = line[:i]
+
+                        if skipinitialspace:
+                            before = before.rstrip(' ')
+
+                        if not before or before[-1] in (delimiter, '\r'):
+                            in_quotes = True
+
+                    i = line.find(quotechar, i + 1)
+
+            # Newlines within quoted fields don't end a record
+            if in_quotes or not line.endswith('\n'):
+                continue
+
+            records += 1
+
+            if targets and position >= targets[0] and position < size:
+                chunks.append((start, position, first_row))
+
+                start = position
+                first_row = records - 1 # Header
+
+                while targets and position >= targets[0]:
+                    targets.pop(0)
+
+    chunks.append((start, None, first_row))
+
+    return chunks, max(records - 1, 0)
+
+class FileRange(object):
+    """
+    A read-only, file-like view of a range of bytes within a file.
+    """
+    def __init__(self, f, start, end=None):
+        self.f = f
+        self.f.seek(start)
+        self.end = end
+
+    def read(self, size=-1):
+        if self.end is None:
+            return self.f.read(size)
+
+        remaining = self.end - self.f.tell()
+
+        if size < 0 or size > remaining:
+            size = remaining
+
+        if size <= 0:
+            return ''
+
+        return self.f.read(size)
+
+    def tell(self):
+        return self.f.tell()
+
+def iter_csv_chunks(rows, rows_per_chunk=500):
+    """
+    Encode an iterable of rows as CSV, yielding the output every
+    ``rows_per_chunk`` rows. Suitable as the content of a streaming
+    ``HttpResponse``.
+    """
+    buf = StringIO()
+    writer = CSVKitWriter(buf)
+    n = 0
+
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+
+        if n % rows_per_chunk == 0:
+            yield buf.getvalue()
+
+            buf = StringIO()
+            writer = CSVKitWriter(buf)
+
+    if n % rows_per_chunk or not n:
+        yield buf.getvalue()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Incremental parsers for data pushed to the ingest API.
+
+Each parser reads from an iterable of lines (such as a request) and yields
+one ``(row_number, data, external_id, error)`` tuple per row, so the body
+is never held in memory. If a row could not be parsed ``error`` is a
+message describing why and ``data`` is ``None``.
+"""
+
+import csv
+import re
+
+from django.utils import simplejson as json
+from django.utils.translation import ugettext as _
+
+EXTERNAL_ID_REGEX = re.compile('^[\w\d_-]+$')
+
+def validate_external_id(external_id):
+    """
+    Return an error message if ``external_id`` is not valid, otherwise ``None``.
+    """
+    if not isinstance(external_id, basestring):
+        return _('external_id must be a string.')
+
+    if not EXTERNAL_ID_REGEX.match(external_id):
+        return _('external_id can only contain letters, numbers, underscores and dashes.')
+
+    return None
+
+def iter_ndjson(lines):
+    """
+    Parse newline-delimited JSON. Each line may be an array of values or
+    an object in the same format as the data API: ``{"data": [...], "external_id": "..."}``.
+    Blank lines are ignored.
+    """
+    row_number = 0
+
+    for line in lines:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        row_number += 1
+
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            yield row_number, None, None, _('Invalid JSON.')
+
+            continue
+
+        if isinstance(obj, dict):
+            data = obj.get('data', None)
+            external_id = obj.get('external_id', None)
+        else:
+            data = obj
+            external_id = None
+
+        if not isinstance(data, list) or not data:
+            yield row_number, None, None, _('The data field is required.')
+
+            continue
+
+        if external_id is not None:
+            error = validate_external_id(external_id)
+
+            if error:
+                yield row_number, None, None, error
+
+                continue
+
+        yield row_number, data, external_id, None
+
+def iter_csv(lines, external_id_field_index=None, header=True):
+    """
+    Parse UTF-8 encoded CSV with the default dialect. If ``header`` is
+    ``True`` the first row is skipped. If ``external_id_field_index`` is
+    given that column is used as each row's external id.
+    """
+    reader = csv.reader(lines)
+    row_number = 0
+
+    if header:
+        try:
+            reader.next()
+        except StopIteration:
+            return
+        except csv.Error:
+            pass
+
+    while True:
+        row_number += 1
+
+        try:
+            row = reader.next()
+        except StopIteration:
+            break
+        except csv.Error, e:
+            yield row_number, None, None, unicode(e)
+
+            continue
+
+        try:
+            row = [c.decode('utf-8') for c in row]
+        except UnicodeDecodeError:
+            yield row_number, None, None, _('This row is not UTF-8 encoded.')
+
+            continue
+
+        if not row:
+            row_number -= 1
+
+            continue
+
+        external_id = None
+
+        if external_id_field_index is not None:
+            try:
+                external_id = row[external_id_field_index]
+            except IndexError:
+                yield row_number, None, None, _('This row has no external_id field.')
+
+                continue
+
+            error = validate_external_id(external_id)
+
+            if error:
+                yield row_number, None, None, error
+
+                continue
+
+        yield row_number, row, external_id, None
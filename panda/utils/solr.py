@@ -1,11 +1,140 @@
 #!/usr/bin/env python
 
+from datetime import datetime
+from itertools import count, izip
+from json.encoder import encode_basestring_ascii, INFINITY
+from Queue import Queue
+import re
+import sys
+from threading import Thread
+import time
 from uuid import uuid4
 
+from django.conf import settings
+from django.utils import datetime_safe
 from django.utils import simplejson as json
 from django.utils.timezone import now
 
-def make_data_row(dataset, data, data_upload=None, external_id=None):
+from panda import solr
+from panda.utils.typecoercion import TYPE_ERROR
+
+_row_counter = count()
+
+# Ids generated by make_row_id
+ROW_ID_PATTERN = re.compile(r'^[0-9a-f]{14}-[0-9a-f]{8}-[0-9a-f]{12}$')
+
+def make_search_query(query=None):
+    """
+    Build the main query for a search, which matches everything if
+    ``query`` is empty. Scoping belongs in filters (see ``make_filters``).
+    """
+    if query:
+        return '(%s)' % query
+
+    return '*:*'
+
+def make_filters(dataset_slugs=None, since=None, category_id=None):
+    """
+    Build Solr filter queries limiting a search to ``dataset_slugs``, to
+    rows in the category ``category_id`` (``PANDA_UNCATEGORIZED_ID`` for
+    uncategorized datasets) and to rows modified since ``since`` (an ISO
+    8601 UTC datetime, without a timezone).
+
+    Filters are cached by Solr independently of the main query and don't
+    affect scoring. Nearly every ``since`` is different, so it is split in
+    two: a cached filter rounded down to the minute, which searches made
+    at different times can share, and an exact filter which is not cached
+    and only has to check the rows the other filters let through.
+    """
+    filters = []
+
+    if dataset_slugs is not None:
+        if dataset_slugs:
+            filters.append('dataset_slug:(%s)' % ' '.join([solr.quote(slug) for slug in dataset_slugs]))
+        else:
+            # Match nothing
+            filters.append('-*:*')
+
+    if category_id is not None:
+        filters.append('categories:%i' % category_id)
+
+    if since:
+        filters.append('last_modified:[%sZ/MINUTE TO *]' % since)
+        filters.append('{!cache=false}last_modified:[%sZ TO *]' % since)
+
+    return filters
+
+def make_categories_mismatch_query(category_ids):
+    """
+    Build a query matching rows whose indexed ``categories`` are not
+    exactly ``category_ids``: rows missing any of them (including rows
+    indexed before categories were) and rows with any other category.
+    """
+    category_ids = sorted(category_ids)
+
+    clauses = ['(*:* -categories:%i)' % i for i in category_ids]
+
+    # Any other category must fall between (or beyond) the expected ones
+    bounds = ['*'] + [str(i) for i in category_ids] + ['*']
+
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        clauses.append('categories:{%s TO %s}' % (lower, upper))
+
+    return ' OR '.join(clauses)
+
+def has_row_ids(core, filters):
+    """
+    Are the rows matching ``filters`` (e.g. a dataset) all identified by
+    ``make_row_id``, so they can be read in order of id?
+
+    Rows indexed before 1.1.2 have random ids and rows with external ids
+    are identified by them, so their ids don't follow the order rows were
+    added. As ids are sorted, only the first and last are checked.
+    """
+    for sort in ('id asc', 'id desc'):
+        docs = solr.query(core, '*:*', limit=1, sort=sort, fields=['id'], filters=filters)['response']['docs']
+
+        if docs and not ROW_ID_PATTERN.match(docs[0]['id']):
+            return False
+
+    return True
+
+def make_row_id(timestamp=None, sequence=None):
+    """
+    Generate a unique id for a row which sorts after every id previously
+    generated by this process.
+
+    Bulk readers page through datasets in order of id (see
+    ``panda.solr.iter_docs``), so ordered ids keep rows in the order they
+    were added. The random suffix keeps ids unique across processes. Rows
+    indexed before these ids were used don't have them (see
+    ``has_row_ids``).
+
+    Processes which add parts of the same file in parallel may instead pass
+    a shared ``timestamp`` (in microseconds) and each row's ``sequence``
+    number within the file, so that ids sort in file order.
+    """
+    if timestamp is None:
+        timestamp = int(time.time() * 1000000)
+
+    if sequence is None:
+        sequence = next(_row_counter)
+
+    return u'%014x-%08x-%s' % (timestamp, sequence & 0xffffffff, uuid4().hex[:12])
+
+def make_data_row(dataset, data, data_upload=None, external_id=None, encoded_data=None, row_id=None, category_ids=None):
+    """
+    Build a Solr document for a row of data. ``encoded_data`` may be passed
+    if ``data`` has already been serialized (e.g. when reindexing), so that
+    it is not encoded again. ``row_id`` is used as the id of rows without an
+    ``external_id``, in place of a new one from ``make_row_id``.
+
+    ``category_ids`` defaults to ``dataset.get_category_ids()``, which is a
+    query, so callers building many rows should look it up once.
+    """
+    if category_ids is None:
+        category_ids = dataset.get_category_ids()
+
     last_modified = now().replace(microsecond=0, tzinfo=None)
     last_modified = last_modified.isoformat('T') + 'Z' 
 
@@ -13,15 +142,262 @@ def make_data_row(dataset, data, data_upload=None, external_id=None):
         'dataset_slug': dataset.slug,
         'data_upload_id': data_upload.id if data_upload else None,
         'full_text': '\n'.join([unicode(d) for d in data]),
-        'data': json.dumps(data),
-        'last_modified': last_modified 
+        'data': encoded_data or json.dumps(data),
+        'last_modified': last_modified,
+        'categories': category_ids
     }
 
     if external_id:
         solr_row['id'] = '%s-%s' % (dataset.slug, external_id)
         solr_row['external_id'] = external_id
     else:
-        solr_row['id'] = unicode(uuid4())
+        solr_row['id'] = row_id or make_row_id()
 
     return solr_row
 
+def _encode_datetime(value):
+    return '"%s"' % datetime_safe.new_datetime(value).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _encode_float(value):
+    # Non-finite floats are encoded the way json does
+    if value != value or value in (INFINITY, -INFINITY):
+        return json.dumps(value)
+
+    return repr(value)
+
+# JSON encoders for the types of values in Solr documents, which are much
+# cheaper to call once per value than ``json.dumps``
+_VALUE_ENCODERS = {
+    unicode: encode_basestring_ascii,
+    str: encode_basestring_ascii,
+    int: str,
+    long: str,
+    float: _encode_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    datetime: _encode_datetime
+}
+
+def _encode_value(value):
+    try:
+        return _VALUE_ENCODERS[type(value)](value)
+    except KeyError:
+        if isinstance(value, datetime):
+            return _encode_datetime(value)
+
+        return json.dumps(value)
+
+class DataBatchEncoder(object):
+    """
+    Encodes batches of rows from one dataset directly as the body of a Solr
+    update request, which may be passed to ``panda.solr.add`` (or a
+    ``SolrWriter``) in place of a list of documents.
+
+    The documents are the same as those built by ``make_data_row`` and
+    ``DataTyper.type_batch``, but no intermediate dicts are built and
+    values which are the same for every row in a batch (such as the dataset
+    slug and modification time) are only encoded once.
+    """
+    def __init__(self, dataset, data_typer, data_upload=None):
+        self.data_typer = data_typer
+        self.slug = dataset.slug
+        self.dataset_slug = '"dataset_slug":%s' % _encode_value(dataset.slug)
+        self.data_upload_id = '"data_upload_id":%s' % _encode_value(data_upload.id if data_upload else None)
+        self.categories = '"categories":[%s]' % ','.join([str(i) for i in dataset.get_category_ids()])
+
+        # Reused for every batch
+        self.buffer = []
+
+    def encode_columns(self, rows):
+        """
+        Type the rows and encode the typed columns of each as a fragment
+        of a JSON object (which is empty if the row has no typed values).
+        """
+        columns = []
+
+        for indexed_name, values in self.data_typer.type_columns(rows):
+            prefix = ',%s:' % encode_basestring_ascii(indexed_name)
+            encoded = []
+
+            for value in values:
+                if value is TYPE_ERROR:
+                    encoded.append('')
+                else:
+                    encoded.append(prefix + _encode_value(value))
+
+            columns.append(encoded)
+
+        if not columns:
+            return [''] * len(rows)
+
+        return [''.join(fragments) for fragments in izip(*columns)]
+
+    def encode(self, rows, external_ids=None, row_ids=None, encoded_data=None, data_upload_ids=None, last_modified=None):
+        """
+        Encode a batch of rows. All optional arguments are lists with one
+        item per row:
+
+        * ``external_ids``: as for ``make_data_row``.
+        * ``row_ids``: ids for rows without an external id (in place of
+          new ones from ``make_row_id``).
+        * ``encoded_data``: each row's data, already serialized.
+        * ``data_upload_ids``: in place of the encoder's ``data_upload``.
+        * ``last_modified``: modification times to keep (as stored by
+          Solr), for rows which are being rewritten without changing
+          their data. Rows with no time are modified now.
+        """
+        slug = self.slug
+        encode_string = encode_basestring_ascii
+
+        modified_now = now().replace(microsecond=0, tzinfo=None)
+        modified_now = '"%sZ"' % modified_now.isoformat('T')
+
+        constant = [self.dataset_slug, self.categories]
+
+        if data_upload_ids is None:
+            constant.append(self.data_upload_id)
+
+        if last_modified is None:
+            constant.append('"last_modified":%s' % modified_now)
+
+        constant = ','.join(constant)
+
+        typed = self.encode_columns(rows)
+
+        buffer = self.buffer
+        del buffer[:]
+
+        for i, row in enumerate(rows):
+            external_id = external_ids[i] if external_ids else None
+
+            if external_id:
+                buffer.append('{"id":%s,"external_id":%s,' % (_encode_value(u'%s-%s' % (slug, external_id)), _encode_value(external_id)))
+            else:
+                buffer.append('{"id":%s,' % encode_string((row_ids and row_ids[i]) or make_row_id()))
+
+            buffer.append(constant)
+
+            if data_upload_ids is not None:
+                buffer.append(',"data_upload_id":%s' % _encode_value(data_upload_ids[i]))
+
+            if last_modified is not None:
+                buffer.append(',"last_modified":%s' % (encode_string(last_modified[i]) if last_modified[i] else modified_now))
+
+            buffer.append(',"full_text":')
+            buffer.append(encode_string(u'\n'.join([unicode(d) for d in row])))
+            buffer.append(',"data":')
+            buffer.append(encode_string(encoded_data[i] if encoded_data else json.dumps(row)))
+            buffer.append(typed[i])
+            buffer.append('},')
+
+        # Drop the trailing comma
+        if buffer:
+            buffer[-1] = '}'
+
+        body = '[%s]' % ''.join(buffer)
+        del buffer[:]
+
+        return body
+
+def decode_data(docs):
+    """
+    Decode the stored ``data`` of a list of Solr documents.
+
+    The fields are joined into a single JSON array and decoded in one
+    call, which is much cheaper than decoding each row separately.
+    """
+    try:
+        return json.loads('[%s]' % ','.join([doc['data'] for doc in docs]))
+    except ValueError:
+        # Find (and raise the error for) the row that can't be decoded
+        return [json.loads(doc['data']) for doc in docs]
+
+def iter_data(core, q, fields=None, page_size=500, after=None, until=None, filters=None, by_id=True):
+    """
+    Iterate over every document matching a query, in order of ``id``,
+    yielding a ``(docs, rows)`` tuple for each page, where ``rows`` is the
+    decoded ``data`` of each document. Accepts the same arguments as
+    ``panda.solr.iter_pages``.
+    """
+    fields = set(fields or []) | set(['data'])
+
+    for docs in solr.iter_pages(core, q, fields, page_size, after, until, filters, by_id):
+        yield docs, decode_data(docs)
+
+class SolrWriter(object):
+    """
+    Adds batches of documents to Solr from background threads, so the
+    caller can keep parsing and typing rows while earlier batches are
+    being indexed.
+
+    ``add`` blocks once ``queue_size`` batches are waiting to be sent. If
+    sending a batch fails the error is re-raised in the calling thread by
+    the next call to ``add`` or ``close``.
+    """
+    def __init__(self, core, threads=None, queue_size=None):
+        self.core = core
+        self.queue = Queue(queue_size or settings.SOLR_WRITER_QUEUE_SIZE)
+        self.exc_info = None
+        self.aborted = False
+
+        self.threads = []
+
+        for i in range(threads or settings.SOLR_WRITER_THREADS):
+            thread = Thread(target=self._send)
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+    def _send(self):
+        """
+        Sender thread loop. A ``None`` batch tells the thread to exit.
+        """
+        while True:
+            documents = self.queue.get()
+
+            if documents is None:
+                return
+
+            # After a failure or abort remaining batches are discarded
+            if self.exc_info or self.aborted:
+                continue
+
+            try:
+                solr.add(self.core, documents)
+            except:
+                self.exc_info = sys.exc_info()
+
+    def _raise_error(self):
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+    def _stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def add(self, documents):
+        """
+        Queue a batch of documents to be added.
+        """
+        self._raise_error()
+        self.queue.put(documents)
+
+    def close(self):
+        """
+        Wait for all queued batches to be added.
+        """
+        self._stop()
+        self._raise_error()
+
+    def abort(self):
+        """
+        Discard any batches which have not yet been sent and stop.
+        """
+        self.aborted = True
+        self._stop()
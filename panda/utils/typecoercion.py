@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from datetime import date, time, datetime
+from itertools import izip
+import re
 
 from csvkit.typeinference import NULL_VALUES, TRUE_VALUES, FALSE_VALUES, DEFAULT_DATETIME
 from dateutil.parser import parse
@@ -19,11 +22,211 @@ TYPE_NAMES_MAPPING = {
     'time': time
 }
 
+# Types for which min/max values are tracked
+RANGE_TYPES = (int, float, date, time, datetime)
+
 CURRENCY_SYMBOLS_ASCII = '$,'
 
 # Via http://en.wikipedia.org/wiki/Currency_sign
 CURRENCY_SYMBOLS_UNICODE_TRANSLATE_TABLE = dict([(ord(c), None) for c in '$,€£₱؋฿₵₡₫ƒ₣₲₴₭ლ₥₦£៛₹₪৳₮₩¥'])
 
+# Marks a value which could not be typed, see ``DataTyper.type_columns``
+TYPE_ERROR = object()
+
+# Number of values which must agree with dateutil before a date format is trusted
+DATE_LEARN_SAMPLES = 20
+
+# Number of distinct values per column whose dateutil results are remembered
+DATE_MEMO_SIZE = 1000
+
+# Strict patterns for common date formats. A value matching one of these is
+# parsed by building a datetime from its groups, with any missing fields
+# taken from DEFAULT_DATETIME, the same as dateutil does.
+DATE_FORMATS = [re.compile(p) for p in [
+    r'^(?P<year>[1-9]\d{3})-(?P<month>\d{1,2})-(?P<day>\d{1,2})$',
+    r'^(?P<year>[1-9]\d{3})-(?P<month>\d{1,2})-(?P<day>\d{1,2})[ T](?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?$',
+    r'^(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>[1-9]\d{3})$',
+    r'^(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>[1-9]\d{3}) (?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?$',
+    r'^(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?$'
+]]
+
+def build_date(match):
+    """
+    Build a datetime from a match against one of ``DATE_FORMATS``.
+    """
+    fields = {}
+
+    for k, v in match.groupdict().iteritems():
+        if v is not None:
+            fields[k] = int(v)
+
+    return DEFAULT_DATETIME.replace(**fields)
+
+class DateParser(object):
+    """
+    A callable that parses the values of a single date, time or datetime
+    column. Returns the same results as ``parse(value, default=DEFAULT_DATETIME)``
+    or raises ``ValueError``.
+
+    While learning, every value is parsed with dateutil and checked against
+    each of ``DATE_FORMATS`` it matches. The first format to agree with
+    dateutil ``DATE_LEARN_SAMPLES`` times (without ever disagreeing) is used
+    for all remaining values. Values which don't match it, or build an
+    invalid date, fall back to dateutil. dateutil results are memoized.
+    """
+    def __init__(self):
+        self.format = None
+        self.candidates = dict((f, 0) for f in DATE_FORMATS)
+        self.memo = OrderedDict()
+
+    def __call__(self, value):
+        if self.format is not None:
+            match = self.format.match(value)
+
+            if match:
+                try:
+                    return build_date(match)
+                except ValueError:
+                    pass
+
+            result = self.parse(value)
+        else:
+            result = self.parse(value)
+            self.learn(value, result)
+
+        if result is None:
+            raise ValueError()
+
+        return result
+
+    def learn(self, value, result):
+        """
+        Check the result dateutil produced for a value against every
+        candidate format that matches it.
+        """
+        for f in self.candidates.keys():
+            match = f.match(value)
+
+            if not match:
+                continue
+
+            try:
+                fast_result = build_date(match)
+            except ValueError:
+                fast_result = None
+
+            if fast_result != result:
+                del self.candidates[f]
+            elif result is not None:
+                self.candidates[f] += 1
+
+                if self.candidates[f] >= DATE_LEARN_SAMPLES:
+                    self.format = f
+
+    def parse(self, value):
+        """
+        Parse a value with dateutil, or return ``None`` if it can't be parsed.
+        """
+        memo = self.memo
+
+        if value in memo:
+            result = memo.pop(value)
+            memo[value] = result
+
+            return result
+
+        try:
+            result = parse(value, default=DEFAULT_DATETIME)
+        except (ValueError, OverflowError, TypeError):
+            result = None
+
+        memo[value] = result
+
+        if len(memo) > DATE_MEMO_SIZE:
+            memo.popitem(last=False)
+
+        return result
+
+def compile_converter(normal_type):
+    """
+    Build a function that coerces a single value into ``normal_type``.
+
+    The result is always the same as ``DataTyper.coerce_type``, but the
+    choice of conversion is made once per column rather than once per value.
+    """
+    if normal_type is unicode:
+        def convert(value):
+            try:
+                return unicode(value)
+            except ValueError:
+                raise TypeCoercionError(value, unicode)
+    elif normal_type is int:
+        def convert(value):
+            # Filter currency symbols
+            if isinstance(value, str):
+                value = value.translate(None, CURRENCY_SYMBOLS_ASCII)
+            elif isinstance(value, unicode):
+                value = value.translate(CURRENCY_SYMBOLS_UNICODE_TRANSLATE_TABLE)
+
+            try:
+                return int(value)
+            except ValueError:
+                raise TypeCoercionError(value, int)
+    elif normal_type is bool:
+        def convert(value):
+            if isinstance(value, basestring):
+                lcase = value.lower()
+
+                if lcase in TRUE_VALUES:
+                    value = True
+                elif lcase in FALSE_VALUES:
+                    value = False
+                else:
+                    raise TypeCoercionError(value, bool)
+
+            return bool(value)
+    elif normal_type is float:
+        def convert(value):
+            # Filter currency symbols
+            if isinstance(value, str):
+                value = value.translate(None, CURRENCY_SYMBOLS_ASCII)
+            elif isinstance(value, unicode):
+                value = value.translate(CURRENCY_SYMBOLS_UNICODE_TRANSLATE_TABLE)
+
+            try:
+                return float(value)
+            except ValueError:
+                raise TypeCoercionError(value, float)
+    elif normal_type in (date, time, datetime):
+        parse_date = DateParser()
+
+        def convert(value):
+            # Don't parse empty strings!
+            if not value:
+                raise TypeCoercionError(value, normal_type)
+
+            try:
+                if isinstance(value, basestring):
+                    return parse_date(value)
+
+                return parse(value, default=DEFAULT_DATETIME)
+            except (ValueError, OverflowError, TypeError):
+                raise TypeCoercionError(value, normal_type)
+    else:
+        raise ValueError('Unsupported type: %s' % normal_type)
+
+    def coerce(value):
+        if isinstance(value, basestring) and value.lower() in NULL_VALUES:
+            return None
+
+        # All types support nulls
+        if value is None:
+            return None
+
+        return convert(value)
+
+    return coerce
+
 class DataTyper(object):
     """
     A callable object that adds typed columns to a Solr object based on a Dataset schema.
@@ -42,30 +245,159 @@ class DataTyper(object):
                     self.schema[n]['max'] = self.coerce_type(c['max'], datetime)
 
         self.errors = [[] for c in self.schema]
+        self.merged_error_counts = [0 for c in self.schema]
+        self.columns = self.compile_columns()
+
+    def __getstate__(self):
+        """
+        Compiled converters are closures and can't be pickled, so they are
+        left out and rebuilt from the schema when unpickled.
+        """
+        state = self.__dict__.copy()
+        del state['columns']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.columns = self.compile_columns()
+
+    def compile_columns(self):
+        """
+        Compile the schema once: (index, indexed name, converter, track min/max)
+        for each column that is typed.
+        """
+        columns = []
+
+        for n, c in enumerate(self.schema):
+            if c['indexed'] and c['type']:
+                t = TYPE_NAMES_MAPPING[c['type']]
+
+                columns.append((n, c['indexed_name'], compile_converter(t), t in RANGE_TYPES))
+
+        return columns
 
     def __call__(self, data, row):
         """
         Given a Solr data object and a row of data, will ad typed columns to the data
         object and then return it.
         """
-        for n, c in enumerate(self.schema):
-            if c['indexed'] and c['type']:
-                try:
-                    t = TYPE_NAMES_MAPPING[c['type']]
-                    value = self.coerce_type(row[n], t)
-                    data[c['indexed_name']] = value
+        schema = self.schema
 
-                    if t in [int, float, date, time, datetime] and value is not None:
-                        if c['min'] is None or value < c['min']:
-                            self.schema[n]['min'] = value
+        for n, indexed_name, convert, track_range in self.columns:
+            try:
+                value = convert(row[n])
+                data[indexed_name] = value
 
-                        if c['max'] is None or value > c['max']:
-                            self.schema[n]['max'] = value
-                except TypeCoercionError, e:
-                    self.errors[n].append(e)
+                if track_range and value is not None:
+                    c = schema[n]
+
+                    if c['min'] is None or value < c['min']:
+                        c['min'] = value
+
+                    if c['max'] is None or value > c['max']:
+                        c['max'] = value
+            except TypeCoercionError, e:
+                self.errors[n].append(e)
 
         return data
+
+    def type_batch(self, documents, rows):
+        """
+        Add typed columns to a batch of Solr data objects, given the rows they
+        were made from. Equivalent to calling the typer on each pair, but
+        works one column at a time. Returns the data objects.
+        """
+        for indexed_name, values in self.type_columns(rows):
+            for data, value in izip(documents, values):
+                if value is not TYPE_ERROR:
+                    data[indexed_name] = value
+
+        return documents
+
+    def type_columns(self, rows):
+        """
+        Type a batch of rows one column at a time, recording errors and
+        min/max values as ``type_batch`` does. Returns a list of
+        ``(indexed_name, values)`` for each typed column, with one value per
+        row, which is ``TYPE_ERROR`` if the row's value couldn't be typed.
+        """
+        columns = []
+
+        for n, indexed_name, convert, track_range in self.columns:
+            errors = self.errors[n]
+            typed = []
+            values = []
+
+            for row in rows:
+                try:
+                    value = convert(row[n])
+                except TypeCoercionError, e:
+                    errors.append(e)
+                    typed.append(TYPE_ERROR)
+
+                    continue
+
+                typed.append(value)
+
+                if track_range and value is not None:
+                    values.append(value)
+
+            columns.append((indexed_name, typed))
+
+            if values:
+                c = self.schema[n]
+                lo = c['min']
+                hi = c['max']
+
+                for value in values:
+                    if lo is None or value < lo:
+                        lo = value
+
+                    if hi is None or value > hi:
+                        hi = value
+
+                c['min'] = lo
+                c['max'] = hi
+
+        return columns
     
+    def get_stats(self):
+        """
+        Get the min/max values and the number of errors found for each
+        column as plain data, which (unlike a DataTyper) can be returned
+        from a task and merged with ``merge``.
+        """
+        return {
+            'min': [c['min'] for c in self.schema],
+            'max': [c['max'] for c in self.schema],
+            'error_counts': [self.count_errors(n) for n in range(len(self.schema))]
+        }
+
+    def merge(self, stats):
+        """
+        Merge the stats found by another DataTyper (see ``get_stats``), for
+        instance one that typed a different partition of the same dataset.
+        """
+        for n, c in enumerate(self.schema):
+            if c['indexed'] and c['type']:
+                lo = stats['min'][n]
+                hi = stats['max'][n]
+
+                if lo is not None and (c['min'] is None or lo < c['min']):
+                    self.schema[n]['min'] = lo
+
+                if hi is not None and (c['max'] is None or hi > c['max']):
+                    self.schema[n]['max'] = hi
+
+            self.merged_error_counts[n] += stats['error_counts'][n]
+
+    def count_errors(self, n):
+        """
+        Count the errors found in a column, including merged errors.
+        """
+        return len(self.errors[n]) + self.merged_error_counts[n]
+
     def summarize(self):
         """
         Generate a plain-text summary of typing, suitable for an email notification.
@@ -75,7 +407,7 @@ class DataTyper(object):
 
             for n, c in enumerate(self.schema):
                 if c['indexed'] and c['type']:
-                    error_count = len(self.errors[n])
+                    error_count = self.count_errors(n)
 
                     if not error_count:
                         summary += _('%(name)s: all values succesfully converted to type "%(type)s"\n') \
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Helpers for writing zip archives from data as it is produced, rather than
+from files already on disk.
+"""
+
+from Queue import Queue, Full
+import sys
+from threading import Thread
+import time
+import zlib
+from zipfile import ZipInfo, ZIP_DEFLATED
+
+# Seconds a producer waits on a full queue before checking if it was aborted
+PRODUCER_POLL_INTERVAL = 0.1
+
+# Marks the end of a generator's output
+_DONE = object()
+
+def write_entry(zipfile, arcname, chunks, compress_type=ZIP_DEFLATED):
+    """
+    Write an iterable of byte strings to ``zipfile`` as a single entry,
+    compressing each chunk as it arrives.
+
+    This is the same as ``ZipFile.write``, except that the data need not be
+    in a file. Because the size isn't known in advance every entry has a
+    zip64 header, so ``zipfile`` must be opened with ``allowZip64=True``.
+    """
+    zinfo = ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.external_attr = 0600 << 16
+    zinfo.compress_type = compress_type
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zipfile.fp.tell()
+    zinfo.file_size = 0
+    zinfo.compress_size = 0
+    zinfo.CRC = 0
+
+    zipfile._writecheck(zinfo)
+    zipfile._didModify = True
+
+    # Sizes and CRC are rewritten once all the data has been written
+    zipfile.fp.write(zinfo.FileHeader(True))
+
+    if compress_type == ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+
+    crc = 0
+    file_size = 0
+    compress_size = 0
+
+    for chunk in chunks:
+        file_size += len(chunk)
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+
+        if compressor:
+            chunk = compressor.compress(chunk)
+
+        compress_size += len(chunk)
+        zipfile.fp.write(chunk)
+
+    if compressor:
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        zipfile.fp.write(chunk)
+
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+
+    position = zipfile.fp.tell()
+    zipfile.fp.seek(zinfo.header_offset, 0)
+    zipfile.fp.write(zinfo.FileHeader(True))
+    zipfile.fp.seek(position, 0)
+
+    zipfile.filelist.append(zinfo)
+    zipfile.NameToInfo[zinfo.filename] = zinfo
+
+class OrderedProducers(object):
+    """
+    Runs a list of generators from background threads, up to ``threads``
+    at a time, while the caller consumes their output in order.
+
+    Each generator may run at most ``queue_size`` items ahead of the
+    caller. Generators are started in order, so the one the caller is
+    waiting on is always running. If a generator raises, the error is
+    re-raised in the calling thread when it reaches that generator.
+    """
+    def __init__(self, generators, threads=1, queue_size=4):
+        self.generators = generators
+        self.queues = [Queue(queue_size) for g in generators]
+        self.work = Queue()
+        self.aborted = False
+
+        for i in range(len(generators)):
+            self.work.put(i)
+
+        self.threads = []
+
+        for i in range(min(threads, len(generators))):
+            self.work.put(None)
+
+            thread = Thread(target=self._produce)
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+    def _put(self, queue, item):
+        """
+        Put an item on a queue, giving up if the producers are aborted.
+        """
+        while not self.aborted:
+            try:
+                queue.put(item, timeout=PRODUCER_POLL_INTERVAL)
+
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def _produce(self):
+        """
+        Producer thread loop. A ``None`` index tells the thread to exit.
+        """
+        while True:
+            i = self.work.get()
+
+            if i is None or self.aborted:
+                return
+
+            queue = self.queues[i]
+
+            try:
+                for item in self.generators[i]:
+                    if not self._put(queue, (item, None)):
+                        return
+            except:
+                self._put(queue, (None, sys.exc_info()))
+
+                continue
+
+            self._put(queue, (_DONE, None))
+
+    def __iter__(self):
+        """
+        Iterate over the generators, in order, yielding an iterator over
+        the output of each.
+        """
+        for queue in self.queues:
+            yield self._consume(queue)
+
+    def _consume(self, queue):
+        while True:
+            item, exc_info = queue.get()
+
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            if item is _DONE:
+                return
+
+            yield item
+
+    def abort(self):
+        """
+        Stop all producers.
+        """
+        self.aborted = True
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Measure cold and warm latency of the cached listings: the client page
+shell (which bootstraps categories), the category list and the dataset
+list.
+
+Requests are made in-process with the Django test client against the
+configured database and Solr, authenticated as the given user. Each
+listing is requested once after invalidating the cache (cold) and then
+repeatedly (warm). Run from the PANDA root:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_listing_cache.py panda@pandaproject.net 20
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from django.test.client import Client
+
+from panda.models import UserProxy
+from panda.utils import cache
+
+URLS = [
+    ('index', '/'),
+    ('categories', '/api/1.0/category/'),
+    ('datasets', '/api/1.0/dataset/?limit=20'),
+    ('datasets (simple)', '/api/1.0/dataset/?limit=20&simple=true')
+]
+
+def timed(client, url, headers):
+    start = time.time()
+    response = client.get(url, **headers)
+    elapsed = time.time() - start
+
+    if response.status_code != 200:
+        raise Exception('%s returned %i' % (url, response.status_code))
+
+    return elapsed
+
+def main():
+    email = sys.argv[1] if len(sys.argv) > 1 else 'panda@pandaproject.net'
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    user = UserProxy.objects.get(email=email)
+    headers = {
+        'HTTP_PANDA_EMAIL': email,
+        'HTTP_PANDA_API_KEY': user.api_key.key
+    }
+
+    client = Client()
+
+    for name, url in URLS:
+        cache.invalidate(cache.DATASETS, cache.CATEGORIES)
+
+        cold = timed(client, url, headers)
+        warm = sorted(timed(client, url, headers) for i in range(repeat))
+
+        print '%-20s cold %7.1fms   warm median %7.1fms   warm max %7.1fms' % (name, cold * 1000, warm[len(warm) / 2] * 1000, warm[-1] * 1000)
+
+if __name__ == '__main__':
+    main()
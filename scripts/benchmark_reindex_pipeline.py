@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark the per-row overhead of reading documents back for a
+reindex or export, excluding the time spent in Solr itself.
+
+Compares the original loop, which took each document off a page with
+list.pop(0) and decoded its data with one json.loads call per row, with
+the page-at-a-time pipeline in panda.utils.solr.iter_data. A single page
+of synthetic documents is reused, so memory use is constant however many
+rows are run. Run from the PANDA root:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_reindex_pipeline.py 10000000
+"""
+
+from itertools import izip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from django.utils import simplejson as json
+
+from panda.utils.solr import decode_data, make_row_id
+
+PAGE_SIZE = 500
+
+def make_page():
+    return [{
+        'id': make_row_id(),
+        'data': json.dumps([unicode(i), u'Brian', u'Boyer', u'Chicago Tribune', u'2012-04-13', u'$171,000.59'])
+    } for i in xrange(PAGE_SIZE)]
+
+def pages(page, rows):
+    for i in xrange(rows / PAGE_SIZE):
+        # A new list, as each response from Solr would be
+        yield list(page)
+
+def run_legacy(page, rows):
+    n = 0
+
+    for read_buffer in pages(page, rows):
+        while read_buffer:
+            doc = read_buffer.pop(0)
+            row = json.loads(doc['data'])
+
+            n += 1
+
+    return n
+
+def run_pipeline(page, rows):
+    n = 0
+
+    for docs in pages(page, rows):
+        for doc, row in izip(docs, decode_data(docs)):
+            n += 1
+
+    return n
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    page = make_page()
+
+    for name, run in [('legacy', run_legacy), ('pipeline', run_pipeline)]:
+        start = time.time()
+        n = run(page, rows)
+        elapsed = time.time() - start
+
+        print '%-10s %i rows in %.2fs (%.2f us/row)' % (name, n, elapsed, elapsed / n * 1000000)
+
+if __name__ == '__main__':
+    main()
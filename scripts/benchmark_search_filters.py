@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Compare search latency with scoping clauses (dataset and modification
+time) glued into the main query, as PANDA used to do, and with them sent
+as filter queries.
+
+Each variant is run once to warm Solr's caches and then repeatedly with a
+different ``since`` each time (as real searches have), reporting Solr's
+own query time (QTime) and the time to the response. Run from the PANDA
+root against a populated data core:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_search_filters.py <dataset_slug> <query> 50
+"""
+
+from datetime import datetime, timedelta
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from django.conf import settings
+
+from panda import solr
+from panda.utils.solr import make_filters, make_search_query
+
+def sinces(repeat):
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(days=30)
+
+    return [(start + timedelta(seconds=i)).isoformat('T') for i in range(repeat)]
+
+def glued(dataset_slug, query, since):
+    q = '(%s) AND dataset_slug:%s AND last_modified:[%sZ TO *]' % (query, dataset_slug, since)
+
+    return q, None
+
+def filtered(dataset_slug, query, since):
+    return make_search_query(query), make_filters([dataset_slug], since)
+
+def timed(q, filters):
+    start = time.time()
+    response = solr.query(settings.SOLR_DATA_CORE, q, limit=50, filters=filters, omit_header=False)
+    elapsed = time.time() - start
+
+    return response['responseHeader']['QTime'], elapsed * 1000
+
+def main():
+    dataset_slug = sys.argv[1]
+    query = sys.argv[2]
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    for name, build in [('glued', glued), ('filtered', filtered)]:
+        # Warm up, with a since that isn't measured
+        timed(*build(dataset_slug, query, sinces(repeat + 1)[-1]))
+
+        results = [timed(*build(dataset_slug, query, since)) for since in sinces(repeat)]
+        qtimes = sorted(r[0] for r in results)
+        totals = sorted(r[1] for r in results)
+
+        print '%-10s QTime median %4ims max %4ims   response median %7.1fms max %7.1fms' % (name, qtimes[len(qtimes) / 2], qtimes[-1], totals[len(totals) / 2], totals[-1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark building Solr update bodies for imported rows, excluding
+the time spent in Solr itself.
+
+Compares the original path, which built a dict per row with
+make_data_row, added typed columns with DataTyper.type_batch and encoded
+the batch with panda.solr.dumps, with panda.utils.solr.DataBatchEncoder.
+One batch of synthetic rows is reused, so memory use is constant however
+many rows are run. Run from the PANDA root:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_solr_encoder.py 1000000
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from panda import solr
+from panda.utils.solr import DataBatchEncoder, make_data_row
+from panda.utils.typecoercion import DataTyper
+
+BATCH_SIZE = 500
+
+class FakeDataset(object):
+    slug = 'benchmark'
+
+    def get_category_ids(self):
+        return [0]
+
+def make_schema():
+    names = ['id', 'first_name', 'last_name', 'employer', 'date', 'salary']
+    types = ['int', 'unicode', 'unicode', 'unicode', 'datetime', 'float']
+
+    return [{
+        'name': name,
+        'indexed': True,
+        'type': t,
+        'indexed_name': 'column_%s_%s' % (t, name),
+        'min': None,
+        'max': None
+    } for name, t in zip(names, types)]
+
+def make_batch():
+    return [[unicode(i), u'Brian', u'Boyer', u'Chicago Tribune', u'2012-04-13', u'$171,000.59'] for i in xrange(BATCH_SIZE)]
+
+def run_legacy(dataset, rows, n):
+    data_typer = DataTyper(make_schema())
+    size = 0
+
+    for i in xrange(n / BATCH_SIZE):
+        documents = [make_data_row(dataset, row, category_ids=[0]) for row in rows]
+        size += len(solr.dumps(data_typer.type_batch(documents, rows)))
+
+    return size
+
+def run_encoder(dataset, rows, n):
+    encoder = DataBatchEncoder(dataset, DataTyper(make_schema()))
+    size = 0
+
+    for i in xrange(n / BATCH_SIZE):
+        size += len(encoder.encode(rows))
+
+    return size
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dataset = FakeDataset()
+    rows = make_batch()
+
+    for name, run in [('legacy', run_legacy), ('encoder', run_encoder)]:
+        start = time.time()
+        size = run(dataset, rows, n)
+        elapsed = time.time() - start
+
+        print '%-10s %i rows in %.2fs (%.2f us/row, %.1f MB)' % (name, n, elapsed, elapsed / n * 1000000, size / 1048576.0)
+
+if __name__ == '__main__':
+    main()
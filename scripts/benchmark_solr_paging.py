@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Compare offset paging with id range paging (panda.solr.iter_docs) when
+reading every row of a large dataset out of Solr.
+
+Loads synthetic rows into the data core under a throwaway dataset slug,
+times both strategies and then deletes the rows. Run from the PANDA root:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_solr_paging.py 1000000
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from django.conf import settings
+
+from panda import solr
+from panda.utils.solr import make_row_id
+
+DATASET_SLUG = 'benchmark-solr-paging'
+PAGE_SIZE = 500
+ADD_BUFFER_SIZE = 5000
+
+def load(rows):
+    buffer = []
+
+    for i in xrange(rows):
+        buffer.append({
+            'id': make_row_id(),
+            'dataset_slug': DATASET_SLUG,
+            'data': '["%i", "benchmark"]' % i
+        })
+
+        if len(buffer) == ADD_BUFFER_SIZE:
+            solr.add(settings.SOLR_DATA_CORE, buffer)
+            buffer = []
+
+    if buffer:
+        solr.add(settings.SOLR_DATA_CORE, buffer)
+
+    solr.commit(settings.SOLR_DATA_CORE)
+
+def read_offset(rows):
+    n = 0
+    slowest = 0.0
+
+    while n < rows:
+        start = time.time()
+        response = solr.query(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % DATASET_SLUG, offset=n, limit=PAGE_SIZE)
+        slowest = max(slowest, time.time() - start)
+
+        n += len(response['response']['docs'])
+
+    return n, slowest
+
+def read_iter_docs():
+    n = 0
+    slowest = 0.0
+    start = time.time()
+
+    for doc in solr.iter_docs(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % DATASET_SLUG, fields=['data'], page_size=PAGE_SIZE):
+        n += 1
+
+        if n % PAGE_SIZE == 0:
+            slowest = max(slowest, time.time() - start)
+            start = time.time()
+
+    return n, slowest
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    print 'Loading %i rows...' % rows
+    load(rows)
+
+    try:
+        for name, read in [('offset', lambda: read_offset(rows)), ('iter_docs', read_iter_docs)]:
+            start = time.time()
+            n, slowest = read()
+            elapsed = time.time() - start
+
+            print '%-10s %i rows in %.1fs (%.0f rows/s, slowest page %.3fs)' % (name, n, elapsed, n / elapsed, slowest)
+    finally:
+        solr.delete(settings.SOLR_DATA_CORE, 'dataset_slug:%s' % DATASET_SLUG)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark DataTyper coercion in rows per second.
+
+Compares the original per-cell coerce_type loop with the compiled
+per-row typer and the column-wise batch API. Run from the PANDA root:
+
+    DJANGO_SETTINGS_MODULE=config.settings python scripts/benchmark_typecoercion.py 100000
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+from panda.exceptions import TypeCoercionError
+from panda.utils.column_schema import make_column_schema
+from panda.utils.typecoercion import DataTyper, TYPE_NAMES_MAPPING, RANGE_TYPES
+
+BATCH_SIZE = 500
+
+COLUMNS = ['name', 'amount', 'price', 'active', 'date', 'employer']
+TYPES = ['unicode', 'int', 'float', 'bool', 'date', 'unicode']
+
+def make_rows(count):
+    rows = []
+
+    for i in xrange(count):
+        rows.append([
+            u'Name %i' % i,
+            unicode(random.randint(-1000, 1000)),
+            u'$%.2f' % random.uniform(0, 5000),
+            random.choice([u'true', u'false', u'']),
+            u'2012-%02i-%02i' % (random.randint(1, 12), random.randint(1, 28)),
+            random.choice([u'Chicago Tribune', u'PANDA', u'n/a'])
+        ])
+
+    return rows
+
+def make_typer():
+    return DataTyper(make_column_schema(COLUMNS, indexed=[True] * len(COLUMNS), types=TYPES))
+
+def legacy(typer, data, row):
+    """
+    The per-cell loop DataTyper used before columns were compiled.
+    """
+    for n, c in enumerate(typer.schema):
+        if c['indexed'] and c['type']:
+            try:
+                t = TYPE_NAMES_MAPPING[c['type']]
+                value = typer.coerce_type(row[n], t)
+                data[c['indexed_name']] = value
+
+                if t in list(RANGE_TYPES) and value is not None:
+                    if c['min'] is None or value < c['min']:
+                        typer.schema[n]['min'] = value
+
+                    if c['max'] is None or value > c['max']:
+                        typer.schema[n]['max'] = value
+            except TypeCoercionError, e:
+                typer.errors[n].append(e)
+
+    return data
+
+def run_legacy(rows):
+    typer = make_typer()
+
+    return [legacy(typer, {}, row) for row in rows]
+
+def run_compiled(rows):
+    typer = make_typer()
+
+    return [typer({}, row) for row in rows]
+
+def run_batch(rows):
+    typer = make_typer()
+    documents = []
+
+    for i in xrange(0, len(rows), BATCH_SIZE):
+        batch = rows[i:i + BATCH_SIZE]
+        documents.extend(typer.type_batch([{} for row in batch], batch))
+
+    return documents
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = make_rows(count)
+
+    expected = None
+
+    for name, run in [('legacy', run_legacy), ('compiled', run_compiled), ('batch', run_batch)]:
+        start = time.time()
+        documents = run(rows)
+        elapsed = time.time() - start
+
+        if expected is None:
+            expected = documents
+        elif documents != expected:
+            print '%s produced different results!' % name
+
+        print '%-10s %i rows in %.2fs (%.0f rows/s)' % (name, count, elapsed, count / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/bin/bash
+
+# PANDA Project migration script to ugprade version 1.1.1 to version 1.1.2.
+# Must be executed with sudo!
+
+set -x
+exec 1> >(tee /var/log/panda-upgrade-1.1.2.log) 2>&1
+
+echo "PANDA upgrade beginning."
+
+# Setup environment variables
+export DEPLOYMENT_TARGET="deployed"
+
+# Shutdown services
+service celeryd stop
+service nginx stop
+service uwsgi stop
+service solr stop
+
+# Fetch updated source code
+cd /opt/panda
+git pull
+git checkout 1.1.2
+
+# Update Python requirements (always do this)
+pip install -U -r requirements.txt
+
+# Migrate database (always do this)
+sudo -u panda -E python manage.py migrate panda --noinput
+
+# Regenerate assets (always do this)
+sudo -u panda -E python manage.py collectstatic --noinput
+
+# Install new Solr configuration (categories are indexed and modification times are stored on data)
+cp setup_panda/data_schema.xml /opt/solr/panda/solr/pandadata/conf/schema.xml
+
+# Restart services
+service solr start 
+service uwsgi start
+service nginx start
+service celeryd start
+
+# Wait for Solr to load the new schema
+sleep 10
+
+# Index categories on existing data (runs in the background)
+sudo -u panda -E python manage.py update_data_categories
+
+echo "PANDA upgrade complete."